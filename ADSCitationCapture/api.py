@@ -3,7 +3,10 @@ import os
 import requests
 import urllib.request, urllib.parse, urllib.error
 import math
+from concurrent.futures import ThreadPoolExecutor
 from adsputils import setup_logging
+from ADSCitationCapture import db
+from ADSCitationCapture.cache import LRUCache
 
 # ============================= INITIALIZATION ==================================== #
 # - Use app logger:
@@ -17,6 +20,10 @@ logger = setup_logging(__name__, proj_home=proj_home,
                         level=config.get('LOGGING_LEVEL', 'INFO'),
                         attach_stdout=config.get('LOG_STDOUT', False))
 
+# Worker-local tier of the canonical bibcode cache (the shared tier is in the database)
+canonical_bibcodes_cache = LRUCache(maxsize=config.get('CANONICAL_BIBCODE_CACHE_SIZE', 100000))
+_missing = object()
+
 
 # =============================== FUNCTIONS ======================================= #
 def _request_citations_page(app, bibcode, start, rows):
@@ -80,36 +87,109 @@ def request_existing_citations(app, bibcode):
     existing_citation_bibcodes = [b['bibcode'] for b in existing_citation_bibcodes]
     return existing_citation_bibcodes
 
-def get_canonical_bibcodes(app, bibcodes, timeout=30):
+def get_canonical_bibcodes(app, bibcodes, timeout=30, refresh=False):
     """
     Convert input bibcodes into their canonical form if they exist, hence
     the returned list can be smaller than the input bibcode list
     """
-    chunk_size = 2000 # Max number of records supported by bigquery
-    bibcodes_chunks = [bibcodes[i * chunk_size:(i + 1) * chunk_size] for i in range(int(round(((len(bibcodes) + chunk_size - 1))) / chunk_size ))]
+    canonical_bibcodes_mapping = get_canonical_bibcodes_mapping(app, bibcodes, timeout=timeout, refresh=refresh)
     canonical_bibcodes = []
+    seen = set()
+    for bibcode in bibcodes:
+        canonical_bibcode = canonical_bibcodes_mapping.get(bibcode)
+        if canonical_bibcode is not None and canonical_bibcode not in seen:
+            seen.add(canonical_bibcode)
+            canonical_bibcodes.append(canonical_bibcode)
+    return canonical_bibcodes
+
+def get_canonical_bibcodes_mapping(app, bibcodes, timeout=30, refresh=False, n_workers=1):
+    """
+    Return a dict that maps the input bibcodes to their canonical form (None
+    if they do not exist). Mappings are looked up in the in-process cache,
+    then in the database cache and only the remaining bibcodes are requested
+    to the API. If `refresh` is True, the caches are ignored and all the
+    bibcodes are requested to the API (the caches are updated with the answer).
+    Up to `n_workers` chunks of bibcodes are requested to the API in parallel.
+    """
+    ttl = app.conf.get('CANONICAL_BIBCODE_CACHE_TTL', 7*24*60*60)
+    not_found_ttl = app.conf.get('CANONICAL_BIBCODE_CACHE_NOT_FOUND_TTL', 24*60*60)
+    unique_bibcodes = list(dict.fromkeys(bibcodes)) # Remove duplicates preserving order
+    canonical_bibcodes_mapping = {}
+    if refresh:
+        missing_bibcodes = unique_bibcodes
+    else:
+        missing_bibcodes = []
+        for bibcode in unique_bibcodes:
+            canonical_bibcode = canonical_bibcodes_cache.get(bibcode, default=_missing)
+            if canonical_bibcode is _missing:
+                missing_bibcodes.append(bibcode)
+            else:
+                canonical_bibcodes_mapping[bibcode] = canonical_bibcode
+        if missing_bibcodes:
+            cached_canonical_bibcodes = db.get_cached_canonical_bibcodes(app, missing_bibcodes, ttl, not_found_ttl)
+            for bibcode, canonical_bibcode in cached_canonical_bibcodes.items():
+                canonical_bibcodes_cache.set(bibcode, canonical_bibcode, ttl=ttl if canonical_bibcode is not None else not_found_ttl)
+            canonical_bibcodes_mapping.update(cached_canonical_bibcodes)
+            missing_bibcodes = [bibcode for bibcode in missing_bibcodes if bibcode not in cached_canonical_bibcodes]
+    if missing_bibcodes:
+        requested_canonical_bibcodes = _request_canonical_bibcodes(app, missing_bibcodes, timeout, n_workers=n_workers)
+        db.store_canonical_bibcodes(app, requested_canonical_bibcodes)
+        for bibcode, canonical_bibcode in requested_canonical_bibcodes.items():
+            canonical_bibcodes_cache.set(bibcode, canonical_bibcode, ttl=ttl if canonical_bibcode is not None else not_found_ttl)
+        canonical_bibcodes_mapping.update(requested_canonical_bibcodes)
+    return canonical_bibcodes_mapping
+
+def invalidate_canonical_bibcodes(app, bibcodes=None):
+    """
+    Remove bibcodes from the canonical bibcode caches (all of them if no
+    bibcodes are specified)
+    """
+    if bibcodes is None:
+        canonical_bibcodes_cache.clear()
+    else:
+        for bibcode in bibcodes:
+            canonical_bibcodes_cache.pop(bibcode)
+    return db.invalidate_canonical_bibcodes(app, bibcodes)
+
+def _request_canonical_bibcodes(app, bibcodes, timeout, n_workers=1):
+    """
+    Request to the API the canonical form of the input bibcodes, it returns
+    a dict that maps each input bibcode to its canonical form (None if it does
+    not exist). Chunks are requested in parallel if `n_workers` is larger than 1.
+    """
+    chunk_size = 2000 # Max number of records supported by bigquery
+    bibcodes_chunks = [bibcodes[i:i + chunk_size] for i in range(0, len(bibcodes), chunk_size)]
+    canonical_bibcodes_mapping = {}
     total_n_chunks = len(bibcodes_chunks)
     # Execute multiple requests to bigquery if the list of bibcodes is longer than the accepted maximum
-    for n_chunk, bibcodes_chunk in enumerate(bibcodes_chunks):
-        retries = 0
-        while True:
-            try:
-                canonical_bibcodes += _get_canonical_bibcodes(app, n_chunk, total_n_chunks, bibcodes_chunk, timeout)
-            except:
-                if retries < 3:
-                    logger.info("Retrying BigQuery API request for bibcodes (chunk: %i/%i): %s", n_chunk+1, total_n_chunks, " ".join(bibcodes_chunk))
-                    retries += 1
-                else:
-                    logger.exception("Failed BigQuery API request for bibcodes (chunk: %i/%i): %s", n_chunk+1, total_n_chunks, " ".join(bibcodes_chunk))
-                    raise
+    if n_workers > 1 and total_n_chunks > 1:
+        with ThreadPoolExecutor(max_workers=min(n_workers, total_n_chunks)) as executor:
+            futures = [executor.submit(_get_canonical_bibcodes_with_retries, app, n_chunk, total_n_chunks, bibcodes_chunk, timeout) for n_chunk, bibcodes_chunk in enumerate(bibcodes_chunks)]
+            for future in futures:
+                canonical_bibcodes_mapping.update(future.result())
+    else:
+        for n_chunk, bibcodes_chunk in enumerate(bibcodes_chunks):
+            canonical_bibcodes_mapping.update(_get_canonical_bibcodes_with_retries(app, n_chunk, total_n_chunks, bibcodes_chunk, timeout))
+    return canonical_bibcodes_mapping
+
+def _get_canonical_bibcodes_with_retries(app, n_chunk, total_n_chunks, bibcodes_chunk, timeout):
+    retries = 0
+    while True:
+        try:
+            return _get_canonical_bibcodes(app, n_chunk, total_n_chunks, bibcodes_chunk, timeout)
+        except:
+            if retries < 3:
+                logger.info("Retrying BigQuery API request for bibcodes (chunk: %i/%i): %s", n_chunk+1, total_n_chunks, " ".join(bibcodes_chunk))
+                retries += 1
             else:
-                break
-    return canonical_bibcodes
+                logger.exception("Failed BigQuery API request for bibcodes (chunk: %i/%i): %s", n_chunk+1, total_n_chunks, " ".join(bibcodes_chunk))
+                raise
 
 def _get_canonical_bibcodes(app, n_chunk, total_n_chunks, bibcodes_chunk, timeout):
-    canonical_bibcodes = []
+    # Bibcodes not found in the answer do not exist in the system
+    canonical_bibcodes_mapping = dict.fromkeys(bibcodes_chunk)
     params = urllib.parse.urlencode({
-                'fl': 'bibcode',
+                'fl': 'bibcode,identifier',
                 'q': '*:*',
                 'wt': 'json',
                 'fq':'{!bitset}',
@@ -139,15 +219,14 @@ def _get_canonical_bibcodes(app, n_chunk, total_n_chunks, bibcodes_chunk, timeou
             raise Exception(msg)
         else:
             for paper in r_json.get('response', {}).get('docs', []):
-                canonical_bibcodes.append(paper['bibcode'])
-    return canonical_bibcodes
+                # The input bibcode can be the canonical or any of the alternative ones
+                for identifier in [paper['bibcode']] + paper.get('identifier', []):
+                    if identifier in canonical_bibcodes_mapping:
+                        canonical_bibcodes_mapping[identifier] = paper['bibcode']
+    return canonical_bibcodes_mapping
 
 def get_canonical_bibcode(app, bibcode, timeout=30):
     """
     Convert input bibcodes into their canonical form if they exist
     """
-    canonical = get_canonical_bibcodes(app, [bibcode], timeout=timeout)
-    if len(canonical) == 0:
-        return None
-    else:
-        return canonical[0]
+    return get_canonical_bibcodes_mapping(app, [bibcode], timeout=timeout).get(bibcode)
@@ -0,0 +1,75 @@
+import time
+import threading
+from collections import OrderedDict
+
+_missing = object()
+
+
+# =============================== FUNCTIONS ======================================= #
+class LRUCache(object):
+    """
+    Bounded in-process least recently used cache with optional per-entry time
+    to live (in seconds). It is local to the worker process, hence it should
+    only be used to avoid repeated requests/queries for data that is allowed
+    to be slightly outdated (or that can be validated by the caller).
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        """
+        :param maxsize: Maximum number of entries, the least recently used
+            entry is evicted when the limit is reached. If zero, nothing is
+            cached.
+        :param ttl: Default time to live in seconds, None for no expiration.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, default=_missing) is not _missing
+
+    def get(self, key, default=None):
+        """
+        Return the cached value or `default` if the key is not cached or if
+        it has expired.
+        """
+        with self._lock:
+            entry = self._data.get(key, _missing)
+            if entry is _missing:
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value, `ttl` overrides the default time to live of the cache.
+        """
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _missing)
+        if entry is _missing:
+            return default
+        return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
@@ -1,9 +1,20 @@
 import os
+import re
+import copy
+import time
+import datetime
+from contextlib import contextmanager
 from psycopg2 import IntegrityError
 from dateutil.tz import tzutc
-from ADSCitationCapture.models import Citation, CitationTarget, Event
+from sqlalchemy import and_, or_, any_, select, func, literal_column, case, cast, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.dialects.postgresql import insert, array, aggregate_order_by
+from sqlalchemy_continuum import versioning_manager, version_class
+from sqlalchemy_continuum.operation import Operation
+from ADSCitationCapture.models import Citation, CitationTarget, Event, EmittedRelation, CanonicalBibcode, ForwardedRecord, OutputRequest, MaintenanceRun, MaintenanceRunChunk
 from adsmsg import CitationChange
-from adsputils import setup_logging
+from ADSCitationCapture.cache import LRUCache
+from adsputils import setup_logging, get_date
 
 # ============================= INITIALIZATION ==================================== #
 # - Use app logger:
@@ -17,16 +28,84 @@ logger = setup_logging(__name__, proj_home=proj_home,
                         level=config.get('LOGGING_LEVEL', 'INFO'),
                         attach_stdout=config.get('LOG_STDOUT', False))
 
+# Worker-local cache of citation target metadata, entries are validated
+# against the creation/update dates of the database row before being used
+citation_target_metadata_cache = LRUCache(maxsize=config.get('CITATION_TARGET_METADATA_CACHE_SIZE', 1000))
+
+# Monthly partitions of the event table (e.g., event_202610)
+_event_partition_name = re.compile(r'^event_(\d{4})(\d{2})$')
+# SQLSTATE raised when a new partition conflicts with rows of the default one
+_check_violation_pgcode = '23514'
+
+# Advisory locks are identified by two integers: this namespace and the hash of the citation target content
+_citation_target_lock_namespace = 1
+
 
 # =============================== FUNCTIONS ======================================= #
-def store_event(app, data):
+@contextmanager
+def unit_of_work(app):
+    """
+    Transactional session to be passed to the functions of this module (i.e.,
+    `session` argument) so that all their reads and writes are committed
+    together at the end of the block (or rolled back if an exception is raised).
+    It is independent from the thread-local session used by `app.session_scope`,
+    hence functions that are not part of the unit of work can still be called.
+    The registered citations of the citation targets whose citations changed
+    are refreshed once, right before committing (see `_refresh_registered_citations`).
+    """
+    session = app._session_factory()
+    session.info['deferred_registered_citations'] = set()
+    try:
+        yield session
+        _refresh_deferred_registered_citations(session)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+@contextmanager
+def _session_scope(app, session=None, savepoint=True):
+    """
+    Session used by the functions of this module:
+    - If no session is provided, a new session scope is opened (functions commit it)
+    - If a session is provided (see `unit_of_work`), the caller controls the
+      transaction and function commits only release a savepoint, so that
+      a failed write (e.g., integrity error) does not abort the whole transaction
+    """
+    if session is None:
+        with app.session_scope() as session:
+            yield session
+    elif not savepoint:
+        yield session
+    else:
+        nested = session.begin_nested()
+        try:
+            yield session
+        except:
+            if session.transaction is nested:
+                nested.rollback()
+            raise
+        else:
+            if session.transaction is nested:
+                if nested.is_active:
+                    nested.commit()
+                else:
+                    nested.rollback()
+
+def store_event(app, data, dump_prefix=None, session=None):
     """
-    Stores a new event in the DB
+    Stores a new pending event in the DB (outbox), it will be sent to the
+    broker by 'task_send_events'
     """
     stored = False
-    with app.session_scope() as session:
+    with _session_scope(app, session) as session:
         event = Event()
         event.data = data
+        event.status = 'PENDING'
+        event.attempts = 0
+        event.dump_prefix = dump_prefix
         session.add(event)
         try:
             session.commit()
@@ -36,12 +115,224 @@ def store_event(app, data):
             stored = True
     return stored
 
-def store_citation_target(app, citation_change, content_type, raw_metadata, parsed_metadata, status):
+def register_emitted_relation(app, relationship, source_id, target_id, session=None):
     """
-    Stores a new citation target in the DB
+    Register that a relation is going to be emitted, return False if it was
+    already registered (i.e., the event should not be emitted again)
+    """
+    with _session_scope(app, session) as session:
+        statement = insert(EmittedRelation).values(relationship=relationship, source_id=source_id, target_id=target_id, created=get_date())
+        statement = statement.on_conflict_do_nothing(index_elements=[EmittedRelation.relationship, EmittedRelation.source_id, EmittedRelation.target_id])
+        statement = statement.returning(EmittedRelation.relationship)
+        registered = session.execute(statement).first() is not None
+        session.commit()
+    return registered
+
+def get_pending_events(app, session, after_id=0, limit=100):
+    """
+    Lock and return the oldest pending events with an identifier greater than
+    `after_id`. Events locked by other senders are skipped, the locks are
+    held until the transaction of the `session` ends.
+    """
+    events = session.query(Event).filter(Event.status == 'PENDING', Event.id > after_id) \
+        .order_by(Event.id).limit(limit).with_for_update(skip_locked=True).all()
+    return [{'id': event.id, 'created': event.created, 'data': event.data, 'dump_prefix': event.dump_prefix, 'attempts': event.attempts} for event in events]
+
+def mark_events_as_sent(app, ids, session):
+    """
+    Mark events as sent
+    """
+    if ids:
+        session.query(Event).filter(Event.id.in_(ids)).update({'status': 'SENT'}, synchronize_session=False)
+
+def mark_events_as_failed(app, ids, max_attempts, session):
+    """
+    Increase the number of attempts of events that could not be sent, they
+    stay pending until they reach `max_attempts`
+    """
+    if ids:
+        session.query(Event).filter(Event.id.in_(ids)).update({
+            'attempts': Event.attempts + 1,
+            'status': cast(case([(Event.attempts + 1 >= max_attempts, 'FAILED')], else_='PENDING'), Event.status.type),
+        }, synchronize_session=False)
+
+def retry_failed_events(app):
+    """
+    Mark failed events as pending again, return the number of events
+    """
+    with app.session_scope() as session:
+        n_events = session.query(Event).filter(Event.status == 'FAILED').update({'status': 'PENDING', 'attempts': 0}, synchronize_session=False)
+        session.commit()
+    return n_events
+
+def get_pending_event_count(app):
+    """
+    Return the number of events waiting to be sent
+    """
+    with app.session_scope() as session:
+        return session.query(Event).filter(Event.status == 'PENDING').count()
+
+def get_events_by_identifier(app, identifier):
+    """
+    Return the data of the events (not yet archived) whose source or target
+    is the identifier
+    """
+    with app.session_scope() as session:
+        events = session.query(Event.data).filter(or_(Event.data[('Source', 'Identifier', 'ID')].astext == identifier,
+                                                      Event.data[('Target', 'Identifier', 'ID')].astext == identifier)).order_by(Event.id).all()
+        return [event.data for event in events]
+
+def _month_start(date, months=0):
+    """
+    First day of the month of `date` shifted by a number of `months`
+    """
+    month = date.year * 12 + date.month - 1 + months
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+def get_event_partitions(app):
+    """
+    Return a dict with the monthly partitions of the event table (name ->
+    first day of the month), the default partition is not included
+    """
+    partitions = {}
+    with app.session_scope() as session:
+        rows = session.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'public.event'::regclass")
+        for row in rows:
+            match = _event_partition_name.match(row[0])
+            if match:
+                partitions[row[0]] = datetime.date(int(match.group(1)), int(match.group(2)), 1)
+    return partitions
+
+def create_event_partitions(app, months_ahead=2):
+    """
+    Create the monthly partitions of the event table from the current month
+    up to `months_ahead` months later (events are stored in the default
+    partition when their month does not have a partition). Return the names
+    of the created partitions.
+    """
+    existing_partitions = get_event_partitions(app)
+    created_partitions = []
+    today = get_date().date()
+    for months in range(months_ahead + 1):
+        start = _month_start(today, months)
+        name = start.strftime("event_%Y%m")
+        if name in existing_partitions:
+            continue
+        with app.session_scope() as session:
+            try:
+                # Bounds in UTC, independently of the session time zone
+                session.execute("CREATE TABLE public.{} PARTITION OF public.event FOR VALUES FROM ('{} 00:00:00+00') TO ('{} 00:00:00+00')".format(name, start, _month_start(start, 1)))
+                session.commit()
+            except DBAPIError as e:
+                # The default partition already contains events of this month
+                # (check_violation), they have to be moved by hand
+                if getattr(e.orig, 'pgcode', None) != _check_violation_pgcode:
+                    raise
+                session.rollback()
+                logger.error("Impossible to create the event partition '%s' because the default partition contains events of that month: '%s'", name, str(e))
+            else:
+                created_partitions.append(name)
+    return created_partitions
+
+def get_expired_event_partitions(app, retention_months):
+    """
+    Return the names of the monthly partitions older than `retention_months`
+    """
+    oldest_month = _month_start(get_date().date(), -retention_months)
+    return sorted(name for name, month in get_event_partitions(app).items() if month < oldest_month)
+
+def archive_event_partition(app, name, archive):
+    """
+    Detach a monthly partition of the event table, append its rows to the
+    archive (see output.JSONLinesArchive) and drop it. Partitions with pending
+    events are kept. Return the number of archived events (None if the
+    partition was kept).
+    """
+    if not _event_partition_name.match(name):
+        raise ValueError("Invalid event partition name '{}'".format(name))
+    n_events = 0
+    with app.session_scope() as session:
+        n_pending = session.execute("SELECT count(*) FROM public.{} WHERE status = 'PENDING'".format(name)).scalar()
+        if n_pending:
+            logger.warning("Event partition '%s' cannot be archived because it has '%i' pending events", name, n_pending)
+            return None
+        session.execute("ALTER TABLE public.event DETACH PARTITION public.{}".format(name))
+        # Server-side cursor, partitions can be too large to be fetched at once
+        rows = session.connection().execution_options(stream_results=True).execute(text("SELECT id, data, status, attempts, dump_prefix, created, updated FROM public.{} ORDER BY id".format(name)))
+        for row in rows:
+            document = {key: value.isoformat() if isinstance(value, datetime.datetime) else value for key, value in row.items()}
+            identifiers = [(document['data'] or {}).get(side, {}).get('Identifier', {}).get('ID') or '' for side in ('Source', 'Target')]
+            archive.append(('partitions', name), document, identifiers)
+            n_events += 1
+        archive.close()
+        session.execute("DROP TABLE public.{}".format(name))
+        session.commit()
+    return n_events
+
+def _chunks(elements, chunk_size):
+    """
+    Split a list in chunks of a given size
+    """
+    return [elements[i:i+chunk_size] for i in range(0, len(elements), chunk_size)]
+
+def get_cached_canonical_bibcodes(app, bibcodes, ttl, not_found_ttl):
+    """
+    Return a dict with the cached canonical bibcode for the requested bibcodes
+    (None if the bibcode was not found in the system), ignoring cached entries
+    older than `ttl` seconds (or `not_found_ttl` seconds if it was not found)
+    """
+    cached_canonical_bibcodes = {}
+    if bibcodes:
+        now = get_date()
+        with app.session_scope() as session:
+            for bibcodes_chunk in _chunks(list(bibcodes), 1000):
+                records_db = session.query(CanonicalBibcode).filter(CanonicalBibcode.bibcode.in_(bibcodes_chunk)).all()
+                for record_db in records_db:
+                    max_age = ttl if record_db.canonical is not None else not_found_ttl
+                    if record_db.updated and (now - record_db.updated).total_seconds() < max_age:
+                        cached_canonical_bibcodes[record_db.bibcode] = record_db.canonical
+    return cached_canonical_bibcodes
+
+def store_canonical_bibcodes(app, canonical_bibcodes):
+    """
+    Insert or refresh cached canonical bibcodes, the input is a dict that maps
+    bibcodes to their canonical form (or None if they were not found)
     """
     stored = False
+    if canonical_bibcodes:
+        now = get_date()
+        rows = [{'bibcode': bibcode, 'canonical': canonical, 'created': now, 'updated': now} for bibcode, canonical in canonical_bibcodes.items()]
+        with app.session_scope() as session:
+            for rows_chunk in _chunks(rows, 1000):
+                statement = insert(CanonicalBibcode).values(rows_chunk)
+                statement = statement.on_conflict_do_update(index_elements=[CanonicalBibcode.bibcode],
+                                                            set_={'canonical': statement.excluded.canonical, 'updated': statement.excluded.updated})
+                session.execute(statement)
+            session.commit()
+            stored = True
+    return stored
+
+def invalidate_canonical_bibcodes(app, bibcodes=None):
+    """
+    Delete cached canonical bibcodes (all of them if no bibcodes are specified)
+    """
     with app.session_scope() as session:
+        if bibcodes is None:
+            n_deleted = session.query(CanonicalBibcode).delete(synchronize_session=False)
+        else:
+            n_deleted = 0
+            for bibcodes_chunk in _chunks(list(bibcodes), 1000):
+                n_deleted += session.query(CanonicalBibcode).filter(CanonicalBibcode.bibcode.in_(bibcodes_chunk)).delete(synchronize_session=False)
+        session.commit()
+    logger.info("Invalidated %i cached canonical bibcodes", n_deleted)
+    return n_deleted
+
+def store_citation_target(app, citation_change, content_type, raw_metadata, parsed_metadata, status, session=None):
+    """
+    Stores a new citation target in the DB
+    """
+    stored = False
+    with _session_scope(app, session) as session:
         citation_target = CitationTarget()
         citation_target.content = citation_change.content
         citation_target.content_type = content_type
@@ -59,12 +350,12 @@ def store_citation_target(app, citation_change, content_type, raw_metadata, pars
             stored = True
     return stored
 
-def update_citation_target_metadata(app, content, raw_metadata, parsed_metadata, status=None):
+def update_citation_target_metadata(app, content, raw_metadata, parsed_metadata, status=None, session=None):
     """
     Update metadata for a citation target
     """
     metadata_updated = False
-    with app.session_scope() as session:
+    with _session_scope(app, session) as session:
         citation_target = session.query(CitationTarget).filter(CitationTarget.content == content).first()
         if type(raw_metadata) is bytes:
             try:
@@ -84,12 +375,12 @@ def update_citation_target_metadata(app, content, raw_metadata, parsed_metadata,
     return metadata_updated
 
 
-def store_citation(app, citation_change, content_type, raw_metadata, parsed_metadata, status):
+def store_citation(app, citation_change, content_type, raw_metadata, parsed_metadata, status, session=None):
     """
     Stores a new citation in the DB
     """
     stored = False
-    with app.session_scope() as session:
+    with _session_scope(app, session) as session:
         citation = Citation()
         citation.citing = citation_change.citing
         citation.cited = citation_change.cited
@@ -99,6 +390,8 @@ def store_citation(app, citation_change, content_type, raw_metadata, parsed_meta
         citation.status = status
         session.add(citation)
         try:
+            session.flush()
+            _refresh_registered_citations(session, [citation.content])
             session.commit()
         except IntegrityError as e:
             # IntegrityError: (psycopg2.IntegrityError) duplicate key value violates unique constraint "citing_content_unique_constraint"
@@ -108,6 +401,125 @@ def store_citation(app, citation_change, content_type, raw_metadata, parsed_meta
             stored = True
     return stored
 
+def _store_versions(session, model, records, operation_type):
+    """
+    Store SQLAlchemy-Continuum version rows for records (list of dict with all
+    the columns) written with bulk statements, which are not tracked by
+    Continuum (it only tracks changes done via the ORM). Previous versions are
+    closed following the validity strategy.
+    """
+    if not records:
+        return
+    uow = versioning_manager.unit_of_work(session)
+    transaction = uow.current_transaction or uow.create_transaction(session)
+    version_table = version_class(model).__table__
+    primary_key = model.__table__.primary_key.columns.values()[0].name
+    keys = [record[primary_key] for record in records]
+    for keys_chunk in _chunks(keys, 1000):
+        statement = version_table.update().where(version_table.c[primary_key].in_(keys_chunk))
+        statement = statement.where(version_table.c.end_transaction_id.is_(None)).where(version_table.c.transaction_id != transaction.id)
+        session.execute(statement.values(end_transaction_id=transaction.id))
+    # Columns excluded from versioning are ignored
+    columns = [column for column in records[0] if column in version_table.c]
+    version_records = [dict({column: record[column] for column in columns}, transaction_id=transaction.id, end_transaction_id=None, operation_type=operation_type) for record in records]
+    for version_records_chunk in _chunks(version_records, 1000):
+        statement = insert(version_table).values(version_records_chunk)
+        # Records modified more than once in the same transaction have only one version
+        statement = statement.on_conflict_do_update(index_elements=[primary_key, 'transaction_id'],
+                                                    set_={column: statement.excluded[column] for column in columns if column != primary_key})
+        session.execute(statement)
+
+def store_citation_targets(app, citation_targets, update=False, session=None):
+    """
+    Stores new citation targets in the DB in bulk (list of dict with content,
+    content_type, raw_metadata, parsed_metadata and status)
+    - Citation targets that already exist are ignored, unless `update` is
+      True (then their metadata and status are updated)
+    - Return the list of contents that were inserted or updated
+    """
+    stored_contents = []
+    # Only the last citation target is kept if it appears more than once
+    citation_targets = list({citation_target['content']: citation_target for citation_target in citation_targets}.values())
+    with _session_scope(app, session) as session:
+        table = CitationTarget.__table__
+        now = get_date()
+        inserted_records, updated_records = [], []
+        for citation_targets_chunk in _chunks(citation_targets, 1000):
+            values = [
+                {
+                    'content': citation_target['content'],
+                    'content_type': citation_target['content_type'],
+                    'raw_cited_metadata': citation_target['raw_metadata'],
+                    'parsed_cited_metadata': citation_target['parsed_metadata'],
+                    'status': citation_target['status'],
+                    'created': now,
+                }
+                for citation_target in citation_targets_chunk
+            ]
+            statement = insert(table).values(values)
+            if update:
+                statement = statement.on_conflict_do_update(index_elements=[table.c.content],
+                                                            set_={
+                                                                'raw_cited_metadata': statement.excluded.raw_cited_metadata,
+                                                                'parsed_cited_metadata': statement.excluded.parsed_cited_metadata,
+                                                                'status': statement.excluded.status,
+                                                                'updated': now,
+                                                            })
+            else:
+                statement = statement.on_conflict_do_nothing(index_elements=[table.c.content])
+            # xmax is zero for inserted rows and non-zero for updated ones
+            statement = statement.returning(*(list(table.c) + [literal_column('(xmax = 0)').label('inserted')]))
+            for row in session.execute(statement):
+                record = {column.name: row[column.name] for column in table.c}
+                if row['inserted']:
+                    inserted_records.append(record)
+                else:
+                    updated_records.append(record)
+        _store_versions(session, CitationTarget, inserted_records, Operation.INSERT)
+        _store_versions(session, CitationTarget, updated_records, Operation.UPDATE)
+        session.commit()
+        stored_contents = [record['content'] for record in inserted_records + updated_records]
+    logger.info("Stored '%i' new and updated '%i' citation targets (out of '%i')", len(inserted_records), len(updated_records), len(citation_targets))
+    return stored_contents
+
+def store_citations(app, citation_changes, status, session=None):
+    """
+    Stores new citations in the DB in bulk with a given status, citations that
+    already exist are ignored. Return the list of (citing, content) tuples
+    that were stored.
+    """
+    stored_citations = []
+    with _session_scope(app, session) as session:
+        table = Citation.__table__
+        now = get_date()
+        records = []
+        for citation_changes_chunk in _chunks(list(citation_changes), 1000):
+            values = [
+                {
+                    'citing': citation_change.citing,
+                    'cited': citation_change.cited,
+                    'content': citation_change.content,
+                    'resolved': citation_change.resolved,
+                    'timestamp': citation_change.timestamp.ToDatetime().replace(tzinfo=tzutc()),
+                    'status': status,
+                    'created': now,
+                }
+                for citation_change in citation_changes_chunk
+            ]
+            statement = insert(table).values(values)
+            statement = statement.on_conflict_do_nothing(constraint='citing_content_unique_constraint')
+            statement = statement.returning(*table.c)
+            records += [{column.name: row[column.name] for column in table.c} for row in session.execute(statement)]
+        _store_versions(session, Citation, records, Operation.INSERT)
+        _refresh_registered_citations(session, [record['content'] for record in records])
+        session.commit()
+        stored_citations = [(record['citing'], record['content']) for record in records]
+    n_ignored = len(citation_changes) - len(stored_citations)
+    if n_ignored > 0:
+        logger.error("Ignoring '%i' new citations because they already exist in the database when they are not supposed to (race condition?)", n_ignored)
+    logger.info("Stored '%i' new citations", len(stored_citations))
+    return stored_citations
+
 def get_citation_target_count(app):
     """
     Return the number of citation targets registered in the database
@@ -142,18 +554,41 @@ def _extract_key_citation_target_data(records_db, disable_filter=False):
     ]
     return records
 
-def get_citation_targets_by_bibcode(app, bibcodes, only_status='REGISTERED'):
+def get_citation_targets_by_bibcode(app, bibcodes, only_status='REGISTERED', session=None, not_found=None):
     """
-    Return a list of dict with the requested citation targets based on their bibcode
+    Return a list of dict with the requested citation targets based on their
+    bibcode or alternate bibcodes, in the order of the input bibcodes
+    - Bibcodes are resolved in chunks with one query per chunk
+    - Bibcodes that do not match any citation target (with the requested
+      status) are appended to the `not_found` list if it is specified
     """
-    with app.session_scope() as session:
+    bibcodes = list(dict.fromkeys(bibcodes)) # Remove duplicates preserving order
+    with _session_scope(app, session, savepoint=False) as session:
+        records_db_by_content = {}
+        for bibcodes_chunk in _chunks(bibcodes, 1000):
+            query = session.query(CitationTarget).filter(or_(
+                        CitationTarget.parsed_cited_metadata['bibcode'].astext == any_(array(bibcodes_chunk)),
+                        CitationTarget.parsed_cited_metadata['alternate_bibcode'].has_any(array(bibcodes_chunk))
+                    ))
+            if only_status:
+                query = query.filter_by(status=only_status)
+            for record_db in query:
+                records_db_by_content[record_db.content] = record_db
+
+        # Sort records following the input order and identify the missing bibcodes
+        records_db_by_bibcode = {}
+        for record_db in records_db_by_content.values():
+            for bibcode in [record_db.parsed_cited_metadata.get('bibcode')] + record_db.parsed_cited_metadata.get('alternate_bibcode', []):
+                records_db_by_bibcode.setdefault(bibcode, record_db)
         records_db = []
+        seen = set()
         for bibcode in bibcodes:
-            if only_status:
-                record_db = session.query(CitationTarget).filter(CitationTarget.parsed_cited_metadata["bibcode"].astext == bibcode).filter_by(status=only_status).first()
-            else:
-                record_db = session.query(CitationTarget).filter(CitationTarget.parsed_cited_metadata["bibcode"].astext == bibcode).first()
-            if record_db:
+            record_db = records_db_by_bibcode.get(bibcode)
+            if record_db is None:
+                if not_found is not None:
+                    not_found.append(bibcode)
+            elif record_db.content not in seen:
+                seen.add(record_db.content)
                 records_db.append(record_db)
 
         if only_status:
@@ -163,12 +598,12 @@ def get_citation_targets_by_bibcode(app, bibcodes, only_status='REGISTERED'):
         records = _extract_key_citation_target_data(records_db, disable_filter=disable_filter)
     return records
 
-def get_citation_targets_by_doi(app, dois, only_status='REGISTERED'):
+def get_citation_targets_by_doi(app, dois, only_status='REGISTERED', session=None):
     """
     Return a list of dict with the requested citation targets based on their DOI
     - Records without a bibcode in the database will not be returned
     """
-    with app.session_scope() as session:
+    with _session_scope(app, session, savepoint=False) as session:
         if only_status:
             records_db = session.query(CitationTarget).filter(CitationTarget.content.in_(dois)).filter_by(status=only_status).all()
             disable_filter = only_status == 'DISCARDED'
@@ -184,135 +619,517 @@ def get_citation_targets(app, only_status='REGISTERED'):
     Return a list of dict with all citation targets (or only the registered ones)
     - Records without a bibcode in the database will not be returned
     """
-    with app.session_scope() as session:
-        if only_status:
-            records_db = session.query(CitationTarget).filter_by(status=only_status).all()
-            disable_filter = only_status == 'DISCARDED'
-        else:
-            records_db = session.query(CitationTarget).all()
-            disable_filter = True
-        records = _extract_key_citation_target_data(records_db, disable_filter=disable_filter)
-    return records
+    return list(iter_citation_targets(app, only_status=only_status))
+
+def iter_citation_targets(app, only_status='REGISTERED', batch_size=1000):
+    """
+    Generator of dict with all citation targets (or only the registered ones)
+    - Only the key columns are selected (i.e., not the raw metadata) and rows
+      are fetched in batches using a server-side cursor
+    - It uses its own database connection, thus it can be consumed while other
+      operations are committed to the database
+    - Records without a bibcode in the database will not be returned
+    """
+    query = select([
+                CitationTarget.content,
+                CitationTarget.content_type,
+                CitationTarget.parsed_cited_metadata['bibcode'].astext.label('bibcode'),
+                CitationTarget.parsed_cited_metadata['alternate_bibcode'].label('alternate_bibcode'),
+            ])
+    if only_status:
+        query = query.where(CitationTarget.status == only_status)
+        disable_filter = only_status == 'DISCARDED'
+    else:
+        disable_filter = True
+    with app._engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                if disable_filter or row['bibcode'] is not None:
+                    yield {
+                        'bibcode': row['bibcode'],
+                        'alternate_bibcode': row['alternate_bibcode'] or [],
+                        'content': row['content'],
+                        'content_type': row['content_type'],
+                    }
 
-def get_citation_target_metadata(app, doi):
+def lock_citation_target(app, content, session, timeout=30):
+    """
+    Acquire a transaction-level advisory lock for a citation target content,
+    it is released when the session transaction is committed or rolled back.
+    It waits for the lock up to `timeout` seconds and it returns False if it
+    could not be acquired.
+    """
+    start = time.time()
+    statement = select([func.pg_try_advisory_xact_lock(_citation_target_lock_namespace, func.hashtext(content))])
+    while True:
+        locked = session.execute(statement).scalar()
+        if locked or time.time() - start >= timeout:
+            break
+        time.sleep(0.1)
+    return locked
+
+def _get_citation_target_record(session, content):
+    """
+    Return a dict with the raw and parsed metadata, status and entry date of a
+    citation target (None if it does not exist). If the worker-local cache
+    has the same version of the row (same creation and update dates), only
+    the dates are queried. The returned dict is a copy that can be modified.
+    """
+    version = session.query(CitationTarget.created, CitationTarget.updated).filter_by(content=content).first()
+    if version is None:
+        citation_target_metadata_cache.pop(content)
+        return None
+    record = citation_target_metadata_cache.get(content)
+    if record is None or record['version'] != tuple(version):
+        citation_target = session.query(CitationTarget.raw_cited_metadata, CitationTarget.parsed_cited_metadata, CitationTarget.status,
+                                         CitationTarget.created, CitationTarget.updated).filter_by(content=content).first()
+        if citation_target is None:
+            citation_target_metadata_cache.pop(content)
+            return None
+        record = {
+            'version': (citation_target.created, citation_target.updated),
+            'raw': citation_target.raw_cited_metadata,
+            'parsed': citation_target.parsed_cited_metadata if citation_target.parsed_cited_metadata is not None else {},
+            'status': citation_target.status,
+            'created': citation_target.created,
+        }
+        citation_target_metadata_cache.set(content, record)
+    return copy.deepcopy(record)
+
+def get_citation_target_metadata(app, doi, session=None):
     """
     If the citation target already exists in the database, return the raw and
     parsed metadata together with the status of the citation target in the
     database.
     If not, return an empty dictionary.
     """
-    citation_in_db = False
     metadata = {}
-    with app.session_scope() as session:
-        citation_target = session.query(CitationTarget).filter_by(content=doi).first()
-        citation_target_in_db = citation_target is not None
-        if citation_target_in_db:
-            metadata['raw'] = citation_target.raw_cited_metadata
-            metadata['parsed'] = citation_target.parsed_cited_metadata if citation_target.parsed_cited_metadata is not None else {}
-            metadata['status'] = citation_target.status
+    with _session_scope(app, session, savepoint=False) as session:
+        record = _get_citation_target_record(session, doi)
+        if record is not None:
+            metadata['raw'] = record['raw']
+            metadata['parsed'] = record['parsed']
+            metadata['status'] = record['status']
     return metadata
 
-def get_citation_target_entry_date(app, doi):
+def get_citation_target_entry_date(app, doi, session=None):
     """
     If the citation target already exists in the database, return the entry date.
     If not, return None.
     """
-    citation_in_db = False
     entry_date = None
-    with app.session_scope() as session:
-        citation_target = session.query(CitationTarget).filter_by(content=doi).first()
-        citation_target_in_db = citation_target is not None
-        if citation_target_in_db:
-            entry_date = citation_target.created
+    with _session_scope(app, session, savepoint=False) as session:
+        record = _get_citation_target_record(session, doi)
+        if record is not None:
+            entry_date = record['created']
     return entry_date
 
-def get_citations_by_bibcode(app, bibcode):
+def get_forwarded_record_fingerprint(app, content, session=None):
+    """
+    Return the fingerprint of the last records forwarded to master for a given
+    citation target, or None if they were never forwarded.
+    """
+    fingerprint = None
+    with _session_scope(app, session, savepoint=False) as session:
+        forwarded_record = session.query(ForwardedRecord).filter_by(content=content).first()
+        if forwarded_record is not None:
+            fingerprint = forwarded_record.fingerprint
+    return fingerprint
+
+def store_forwarded_record_fingerprint(app, content, fingerprint, session=None):
+    """
+    Insert or update the fingerprint of the last records forwarded to master
+    for a given citation target
+    """
+    with _session_scope(app, session) as session:
+        now = get_date()
+        statement = insert(ForwardedRecord).values(content=content, fingerprint=fingerprint, created=now)
+        statement = statement.on_conflict_do_update(index_elements=[ForwardedRecord.content],
+                                                    set_={'fingerprint': statement.excluded.fingerprint, 'updated': now})
+        session.execute(statement)
+        session.commit()
+    return True
+
+def store_output_request(app, citation_change, parsed_metadata, citations, bibcode_replaced={}, force=False):
+    """
+    Insert or replace the pending output request of a citation target with the
+    latest state (bibcode replacements and forced requests are accumulated).
+    Return True if there was no pending request for the citation target.
+    """
+    inserted = False
+    with app.session_scope() as session:
+        table = OutputRequest.__table__
+        now = get_date()
+        statement = insert(table).values(content=citation_change.content, citation_change=citation_change.serialize(),
+                                         parsed_metadata=parsed_metadata, citations=citations,
+                                         bibcode_replaced=bibcode_replaced or {}, force=force, created=now)
+        excluded = statement.excluded
+        no_replacement = literal_column("'{}'::jsonb")
+        # If the bibcode was replaced several times, the record with the first previous bibcode has to be deleted
+        accumulated_bibcode_replaced = case([
+                (excluded.bibcode_replaced == no_replacement, table.c.bibcode_replaced),
+                (table.c.bibcode_replaced == no_replacement, excluded.bibcode_replaced),
+            ], else_=func.jsonb_build_object('previous', table.c.bibcode_replaced['previous'], 'new', excluded.bibcode_replaced['new']))
+        statement = statement.on_conflict_do_update(index_elements=[table.c.content],
+                                                    set_={
+                                                        'citation_change': excluded.citation_change,
+                                                        'parsed_metadata': excluded.parsed_metadata,
+                                                        'citations': excluded.citations,
+                                                        'bibcode_replaced': accumulated_bibcode_replaced,
+                                                        'force': or_(table.c.force, excluded.force),
+                                                        'updated': now,
+                                                    })
+        # xmax is zero for inserted rows and non-zero for updated ones
+        statement = statement.returning(literal_column('(xmax = 0)').label('inserted'))
+        inserted = session.execute(statement).scalar()
+        session.commit()
+    return inserted
+
+def pop_output_request(app, content):
+    """
+    Delete and return the pending output request of a citation target as a
+    dict with the arguments for forwarding it, or None if there is none.
+    """
+    output_request = None
+    with app.session_scope() as session:
+        table = OutputRequest.__table__
+        row = session.execute(table.delete().where(table.c.content == content).returning(*table.c)).first()
+        session.commit()
+        if row is not None:
+            output_request = {
+                'citation_change': CitationChange.deserializer(bytes(row['citation_change'])),
+                'parsed_metadata': row['parsed_metadata'],
+                'citations': row['citations'],
+                'bibcode_replaced': row['bibcode_replaced'],
+                'force': row['force'],
+            }
+    return output_request
+
+def get_citations_by_bibcode(app, bibcode, session=None):
     """
     Transform bibcode into content and get all the citations by content.
     It will ignore DELETED and DISCARDED citations and citations targets.
     """
     citations = []
     if bibcode is not None:
-        with app.session_scope() as session:
+        with _session_scope(app, session, savepoint=False) as session:
+            # Changes of the unit of work must be visible
+            _refresh_deferred_registered_citations(session)
             #bibcode = "2015zndo.....14475J"
-            citation_target = session.query(CitationTarget).filter(CitationTarget.parsed_cited_metadata['bibcode'].astext == bibcode).filter_by(status="REGISTERED").first()
+            citation_target = session.query(CitationTarget.content, CitationTarget.registered_citing).filter(CitationTarget.parsed_cited_metadata['bibcode'].astext == bibcode).filter_by(status="REGISTERED").first()
             if citation_target:
-                dummy_citation_change = CitationChange(content=citation_target.content)
-                citations = get_citations(app, dummy_citation_change)
+                if citation_target.registered_citing is not None:
+                    citations = list(citation_target.registered_citing)
+                else:
+                    # Registered citations not computed yet (see rebuild_registered_citations)
+                    dummy_citation_change = CitationChange(content=citation_target.content)
+                    citations = get_citations(app, dummy_citation_change, session=session)
     return citations
 
-def get_citations(app, citation_change):
+def _registered_citations_values(table):
+    """
+    Correlated subqueries that compute the registered citations of each
+    citation target (count and sorted citing bibcodes)
+    """
+    citation = Citation.__table__
+    registered = and_(citation.c.content == table.c.content, citation.c.status == "REGISTERED")
+    return {
+        'registered_citation_count': select([func.count()]).where(registered).as_scalar(),
+        'registered_citing': select([func.coalesce(func.array_agg(aggregate_order_by(citation.c.citing, citation.c.citing)), literal_column("'{}'::text[]"))]).where(registered).as_scalar(),
+    }
+
+def _refresh_registered_citations(session, contents):
+    """
+    Recompute the registered citations stored in the given citation targets,
+    it must be called in the same transaction that modifies their citations
+    (the 'updated' date is preserved since the target itself did not change).
+    In a unit of work, the targets are only refreshed (and locked) once, when
+    it is committed or before they are read.
+    """
+    deferred_contents = session.info.get('deferred_registered_citations')
+    if deferred_contents is not None:
+        deferred_contents.update(contents)
+    else:
+        _update_registered_citations(session, contents)
+
+def _refresh_deferred_registered_citations(session):
+    """
+    Recompute the registered citations deferred in a unit of work
+    """
+    deferred_contents = session.info.get('deferred_registered_citations')
+    if deferred_contents:
+        contents = list(deferred_contents)
+        deferred_contents.clear()
+        _update_registered_citations(session, contents)
+
+def _update_registered_citations(session, contents):
+    table = CitationTarget.__table__
+    for contents_chunk in _chunks(sorted(set(contents)), 1000):
+        # Lock the targets first (sorted to avoid deadlocks): an UPDATE that
+        # waits for a concurrent transaction keeps the snapshot taken before
+        # its citations were committed, the next statement sees them
+        session.execute(select([table.c.content]).where(table.c.content == any_(array(contents_chunk))).order_by(table.c.content).with_for_update())
+        statement = table.update().where(table.c.content == any_(array(contents_chunk)))
+        statement = statement.values(updated=table.c.updated, **_registered_citations_values(table))
+        session.execute(statement)
+
+def rebuild_registered_citations(app, contents=None):
+    """
+    Consistency check: recompute the registered citations stored in the
+    citation targets (all of them if no contents are specified) that do not
+    match the citation table. Return the list of fixed contents.
+    """
+    fixed_contents = []
+    if contents is not None and len(contents) == 0:
+        return fixed_contents
+    with app.session_scope() as session:
+        table = CitationTarget.__table__
+        values = _registered_citations_values(table)
+        statement = table.update().where(or_(table.c.registered_citation_count.is_distinct_from(values['registered_citation_count']),
+                                             table.c.registered_citing.is_distinct_from(values['registered_citing'])))
+        if contents is not None:
+            statement = statement.where(table.c.content == any_(array(list(contents))))
+        statement = statement.values(updated=table.c.updated, **values).returning(table.c.content)
+        fixed_contents = [row['content'] for row in session.execute(statement)]
+        session.commit()
+    logger.info("Rebuilt the registered citations of '%i' citation targets", len(fixed_contents))
+    return fixed_contents
+
+def get_citations(app, citation_change, session=None):
     """
     Return all the citations (bibcodes) to a given content.
     It will ignore DELETED and DISCARDED citations.
     """
-    with app.session_scope() as session:
+    with _session_scope(app, session, savepoint=False) as session:
         citation_bibcodes = [r.citing for r in session.query(Citation).filter_by(content=citation_change.content, status="REGISTERED").all()]
     return citation_bibcodes
 
 
-def citation_already_exists(app, citation_change):
+def get_citations_by_content(app, contents=None, session=None):
+    """
+    Return a dict that maps citation targets (content) to all their citations
+    (bibcodes) using one single query. If no contents are specified, all the
+    citation targets are considered.
+    It will ignore DELETED and DISCARDED citations and citations targets.
+    """
+    citations = {}
+    with _session_scope(app, session, savepoint=False) as session:
+        query = session.query(Citation.content, Citation.citing).join(CitationTarget, CitationTarget.content == Citation.content)
+        query = query.filter(CitationTarget.status == "REGISTERED").filter(Citation.status == "REGISTERED")
+        if contents is None:
+            queries = [query]
+        else:
+            queries = [query.filter(Citation.content.in_(contents_chunk)) for contents_chunk in _chunks(list(contents), 1000)]
+        for query in queries:
+            for content, citing in query.yield_per(10000):
+                citations.setdefault(content, []).append(citing)
+    return citations
+
+def citation_already_exists(app, citation_change, session=None):
     """
     Is this citation already stored in the DB?
     """
     citation_in_db = False
-    with app.session_scope() as session:
+    with _session_scope(app, session, savepoint=False) as session:
         citation = session.query(Citation).filter_by(citing=citation_change.citing, content=citation_change.content).first()
         citation_in_db = citation is not None
     return citation_in_db
 
-def update_citation(app, citation_change):
+def update_citation(app, citation_change, session=None):
     """
-    Update cited information
+    Update cited information if the change is newer than the stored citation
+    (atomic conditional update, no row is locked while comparing timestamps)
     """
     updated = False
-    with app.session_scope() as session:
-        citation = session.query(Citation).with_for_update().filter_by(citing=citation_change.citing, content=citation_change.content).first()
+    with _session_scope(app, session) as session:
+        table = Citation.__table__
         change_timestamp = citation_change.timestamp.ToDatetime().replace(tzinfo=tzutc()) # Consider it as UTC to be able to compare it
-        if citation.timestamp < change_timestamp:
-            #citation.citing = citation_change.citing # This should not change
-            #citation.content = citation_change.content # This should not change
-            citation.cited = citation_change.cited
-            citation.resolved = citation_change.resolved
-            citation.timestamp = change_timestamp
-            session.add(citation)
-            session.commit()
+        statement = table.update().where(table.c.citing == citation_change.citing).where(table.c.content == citation_change.content)
+        statement = statement.where(table.c.timestamp < change_timestamp)
+        # citing and content should not change
+        statement = statement.values(cited=citation_change.cited, resolved=citation_change.resolved, timestamp=change_timestamp)
+        statement = statement.returning(*table.c)
+        records = [{column.name: row[column.name] for column in table.c} for row in session.execute(statement)]
+        _store_versions(session, Citation, records, Operation.UPDATE)
+        session.commit()
+        if records:
             updated = True
             logger.info("Updated citation (citting '%s', content '%s' and timestamp '%s')", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
         else:
             logger.info("Ignoring citation update (citting '%s', content '%s' and timestamp '%s') because received timestamp is equal/older than timestamp in database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
     return updated
 
-def mark_citation_as_deleted(app, citation_change):
+def mark_citation_as_deleted(app, citation_change, session=None):
     """
-    Update status to DELETED for a given citation
+    Update status to DELETED for a given citation if the change is newer than
+    the stored citation (atomic conditional update, no row is locked while
+    comparing timestamps). Return if it was marked as deleted and the status
+    that the citation had before.
     """
     marked_as_deleted = False
     previous_status = None
-    with app.session_scope() as session:
-        citation = session.query(Citation).with_for_update().filter_by(citing=citation_change.citing, content=citation_change.content).first()
-        previous_status = citation.status
+    with _session_scope(app, session) as session:
+        table = Citation.__table__
+        # Self-join to return the status previous to the update
+        previous = table.alias('previous')
         change_timestamp = citation_change.timestamp.ToDatetime().replace(tzinfo=tzutc()) # Consider it as UTC to be able to compare it
-        if citation.timestamp < change_timestamp:
-            citation.status = "DELETED"
-            citation.timestamp = change_timestamp
-            session.add(citation)
-            session.commit()
+        statement = table.update().where(table.c.id == previous.c.id)
+        statement = statement.where(table.c.citing == citation_change.citing).where(table.c.content == citation_change.content)
+        statement = statement.where(table.c.timestamp < change_timestamp)
+        statement = statement.values(status="DELETED", timestamp=change_timestamp)
+        statement = statement.returning(*(list(table.c) + [previous.c.status.label('previous_status')]))
+        rows = session.execute(statement).fetchall()
+        records = [{column.name: row[column.name] for column in table.c} for row in rows]
+        _store_versions(session, Citation, records, Operation.UPDATE)
+        _refresh_registered_citations(session, [record['content'] for record in records])
+        session.commit()
+        if rows:
             marked_as_deleted = True
+            previous_status = rows[0]['previous_status']
             logger.info("Marked citation as deleted (citting '%s', content '%s' and timestamp '%s')", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
         else:
+            previous_status = session.query(Citation.status).filter_by(citing=citation_change.citing, content=citation_change.content).scalar()
             logger.info("Ignoring citation deletion (citting '%s', content '%s' and timestamp '%s') because received timestamp is equal/older than timestamp in database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
     return marked_as_deleted, previous_status
 
-def mark_all_discarded_citations_as_registered(app, content):
+def mark_all_discarded_citations_as_registered(app, content, session=None):
     """
     Update status to REGISTERED for all discarded citations of a given content
+    using one single statement, and return their citing bibcodes
+    """
+    with _session_scope(app, session) as session:
+        table = Citation.__table__
+        statement = table.update().where(table.c.content == content).where(table.c.status == 'DISCARDED').values(status='REGISTERED')
+        statement = statement.returning(*table.c)
+        records = [{column.name: row[column.name] for column in table.c} for row in session.execute(statement)]
+        _store_versions(session, Citation, records, Operation.UPDATE)
+        _refresh_registered_citations(session, [record['content'] for record in records])
+        session.commit()
+    logger.info("Marked '%i' discarded citations as registered (content '%s')", len(records), content)
+    return [record['citing'] for record in records]
+
+def create_maintenance_run(app, task, arguments):
+    """
+    Register a new maintenance run and return its identifier
+    """
+    with app.session_scope() as session:
+        maintenance_run = MaintenanceRun(task=task, arguments=arguments, status='DISPATCHING', n_targets=0, n_done=0, n_failed=0, n_skipped=0)
+        session.add(maintenance_run)
+        session.commit()
+        run_id = maintenance_run.id
+    return run_id
+
+def _extract_maintenance_run_data(maintenance_run):
+    return {
+        'id': maintenance_run.id,
+        'task': maintenance_run.task,
+        'arguments': maintenance_run.arguments,
+        'status': maintenance_run.status,
+        'n_targets': maintenance_run.n_targets,
+        'n_done': maintenance_run.n_done,
+        'n_failed': maintenance_run.n_failed,
+        'n_skipped': maintenance_run.n_skipped,
+        'created': maintenance_run.created,
+        'updated': maintenance_run.updated,
+    }
+
+def get_maintenance_run(app, run_id):
+    """
+    Return a dict with the maintenance run or an empty dict if it does not exist
+    """
+    maintenance_run_data = {}
+    with app.session_scope() as session:
+        maintenance_run = session.query(MaintenanceRun).filter_by(id=run_id).first()
+        if maintenance_run is not None:
+            maintenance_run_data = _extract_maintenance_run_data(maintenance_run)
+    return maintenance_run_data
+
+def store_maintenance_run_chunk(app, run_id, contents):
+    """
+    Register a chunk of citation targets (contents) to be processed by one
+    maintenance subtask and return its identifier
+    """
+    with app.session_scope() as session:
+        maintenance_run_chunk = MaintenanceRunChunk(run_id=run_id, contents=contents, status='PENDING')
+        session.add(maintenance_run_chunk)
+        session.commit()
+        chunk_id = maintenance_run_chunk.id
+    return chunk_id
+
+def get_maintenance_run_chunk(app, chunk_id):
+    """
+    Return a dict with the maintenance run chunk or an empty dict if it does not exist
+    """
+    maintenance_run_chunk_data = {}
+    with app.session_scope() as session:
+        maintenance_run_chunk = session.query(MaintenanceRunChunk).filter_by(id=chunk_id).first()
+        if maintenance_run_chunk is not None:
+            maintenance_run_chunk_data = {
+                'id': maintenance_run_chunk.id,
+                'run_id': maintenance_run_chunk.run_id,
+                'contents': maintenance_run_chunk.contents,
+                'status': maintenance_run_chunk.status,
+            }
+    return maintenance_run_chunk_data
+
+def get_maintenance_run_contents(app, run_id):
+    """
+    Return a set with all the citation targets (contents) already assigned to
+    chunks of a maintenance run
+    """
+    contents = set()
+    with app.session_scope() as session:
+        for maintenance_run_chunk in session.query(MaintenanceRunChunk.contents).filter_by(run_id=run_id):
+            contents.update(maintenance_run_chunk.contents)
+    return contents
+
+def get_pending_maintenance_run_chunk_ids(app, run_id):
+    """
+    Return the identifiers of the chunks of a maintenance run that were not processed yet
+    """
+    with app.session_scope() as session:
+        chunk_ids = [chunk_id for chunk_id, in session.query(MaintenanceRunChunk.id).filter_by(run_id=run_id, status='PENDING').order_by(MaintenanceRunChunk.id)]
+    return chunk_ids
+
+def mark_maintenance_run_as_dispatched(app, run_id):
+    """
+    Mark a maintenance run as running once all its chunks have been
+    registered (or as finished if there is nothing pending)
+    """
+    with app.session_scope() as session:
+        maintenance_run = session.query(MaintenanceRun).filter_by(id=run_id).with_for_update().one()
+        maintenance_run.n_targets = int(session.query(func.coalesce(func.sum(func.jsonb_array_length(MaintenanceRunChunk.contents)), 0)).filter(MaintenanceRunChunk.run_id == run_id).scalar())
+        n_pending = session.query(MaintenanceRunChunk).filter_by(run_id=run_id, status='PENDING').count()
+        maintenance_run.status = 'RUNNING' if n_pending > 0 else 'FINISHED'
+        session.add(maintenance_run)
+        session.commit()
+    return True
+
+def finish_maintenance_run_chunk(app, run_id, chunk_id, n_done, n_failed, n_skipped):
+    """
+    Mark a chunk as done and add its counts to the maintenance run, which is
+    marked as finished when no chunks are pending. The maintenance run row is
+    locked so that concurrent subtasks are serialized, and chunks that were
+    already done (e.g., re-delivered subtasks) are not counted twice.
     """
-    marked_as_registered = False
-    previous_status = None
     with app.session_scope() as session:
-        citations = session.query(Citation).with_for_update().filter_by(status='DISCARDED', content=content).all()
-        for citation in citations:
-            citation.status = 'REGISTERED'
-            session.add(citation)
+        maintenance_run = session.query(MaintenanceRun).filter_by(id=run_id).with_for_update().one()
+        n_updated = session.query(MaintenanceRunChunk).filter_by(id=chunk_id, status='PENDING').update({'status': 'DONE', 'updated': get_date()}, synchronize_session=False)
+        if n_updated == 0:
+            session.rollback()
+            logger.warning("Maintenance run '%s' chunk '%s' was already done", run_id, chunk_id)
+            return False
+        maintenance_run.n_done += n_done
+        maintenance_run.n_failed += n_failed
+        maintenance_run.n_skipped += n_skipped
+        if maintenance_run.status == 'RUNNING':
+            n_pending = session.query(MaintenanceRunChunk).filter_by(run_id=run_id, status='PENDING').count()
+            if n_pending == 0:
+                maintenance_run.status = 'FINISHED'
+        session.add(maintenance_run)
         session.commit()
+    return True
@@ -4,7 +4,7 @@ import postgres_copy
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.schema import CreateSchema
 from sqlalchemy.engine.reflection import Inspector
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, case
 from ADSCitationCapture.models import RawCitation, CitationChanges
 from adsputils import setup_logging
 import adsmsg
@@ -15,7 +15,7 @@ class DeltaComputation():
     exists) and identifies citation changes. The class is iterable.
     """
 
-    def __init__(self, sqlachemy_url, group_changes_in_chunks_of=1, sqlalchemy_echo=False, schema_prefix="citation_capture_", force=False):
+    def __init__(self, sqlachemy_url, group_changes_in_chunks_of=1, sqlalchemy_echo=False, schema_prefix="citation_capture_", force=False, group_by_content=False):
         """
         Initializes the class and prepares DB connection.
 
@@ -26,6 +26,9 @@ class DeltaComputation():
         :param schema_prefix: Data is stored in schemas that correspond to a
             prefix + file last access date.
         :param force: If tables already exists in DB, drop them and re-ingest.
+        :param group_by_content: Group all the citation changes of the same
+            citation target (content) when iterating, instead of grouping them
+            in chunks.
         """
         self.engine = create_engine(sqlachemy_url, echo=sqlalchemy_echo)
         self.connection = self.engine.connect()
@@ -55,7 +58,10 @@ class DeltaComputation():
         self.offset = 0
         self.n_changes = 0
         self.force = force
+        self.group_by_content = group_by_content
         self.last_modification_date = None
+        self._grouped_instances = None
+        self._next_grouped_instance = None
 
     def compute(self, input_refids_filename):
         """
@@ -65,6 +71,7 @@ class DeltaComputation():
         :param input_refids_filename: Path to the file to be imported.
         """
         self.offset = 0
+        self._grouped_instances = None
         self.input_refids_filename = input_refids_filename
         self._setup_schemas()
         if self.force or self.joint_table_name not in Inspector.from_engine(self.engine).get_table_names(schema=self.schema_name):
@@ -108,36 +115,64 @@ class DeltaComputation():
         return self
 
     def __next__(self): # Python 3: def __next__(self)
-        """Iterates over the results, grouping changes in chunks"""
+        """Iterates over the results, grouping changes in chunks or by content"""
+        if self.group_by_content:
+            return self._next_content_group()
         if self.offset >= self.n_changes or self.n_changes == 0:
             raise StopIteration
         else:
             citation_changes = adsmsg.CitationChanges()
             # Get citation changes from DB
             for instance in self._citation_changes_query().offset(self.offset).limit(self.group_changes_in_chunks_of).yield_per(100):
-                ## Build protobuf message
-                citation_change = citation_changes.changes.add()
-                # Use new_ or previous_ fields depending if status is NEW/UPDATED or DELETED
-                prefix = "previous_" if instance.status == "DELETED" else "new_"
-                citation_change.citing = getattr(instance, prefix+"citing")
-                resolved = getattr(instance, prefix+"resolved")
-                citation_change.cited = getattr(instance, prefix+"cited")
-                citation_change.content = getattr(instance, prefix+"content")
-                if getattr(instance, prefix+"doi"):
-                    citation_change.content_type = adsmsg.CitationChangeContentType.doi
-                    citation_change.content = citation_change.content.lower() # Normalize DOI to lower case: DOI names are case insensitive (https://www.doi.org/doi_handbook/2_Numbering.html#2.4)
-                elif getattr(instance, prefix+"pid"):
-                    citation_change.content_type = adsmsg.CitationChangeContentType.pid
-                elif getattr(instance, prefix+"url"):
-                    citation_change.content_type = adsmsg.CitationChangeContentType.url
-                citation_change.resolved = getattr(instance, prefix+"resolved")
-                citation_change.timestamp.FromDatetime(self.last_modification_date)
-                citation_change.status = getattr(adsmsg.Status, instance.status.lower())
+                self._add_citation_change(citation_changes, instance)
             self.session.commit()
 
             self.offset += self.group_changes_in_chunks_of
             return citation_changes
 
+    def _next_content_group(self):
+        """
+        Return the next group of citation changes that share the same content,
+        changes are streamed from the DB sorted by content
+        """
+        if self._grouped_instances is None:
+            content = case([(CitationChanges.status == "DELETED", CitationChanges.previous_content)], else_=CitationChanges.new_content)
+            self._grouped_instances = iter(self._citation_changes_query().order_by(content, CitationChanges.id).yield_per(100))
+            self._next_grouped_instance = next(self._grouped_instances, None)
+        if self._next_grouped_instance is None:
+            self.session.commit()
+            raise StopIteration
+        citation_changes = adsmsg.CitationChanges()
+        content = self._instance_content(self._next_grouped_instance)
+        while self._next_grouped_instance is not None and self._instance_content(self._next_grouped_instance) == content:
+            self._add_citation_change(citation_changes, self._next_grouped_instance)
+            self._next_grouped_instance = next(self._grouped_instances, None)
+        return citation_changes
+
+    def _instance_content(self, instance):
+        prefix = "previous_" if instance.status == "DELETED" else "new_"
+        return getattr(instance, prefix+"content")
+
+    def _add_citation_change(self, citation_changes, instance):
+        """Build protobuf message from a citation changes row"""
+        citation_change = citation_changes.changes.add()
+        # Use new_ or previous_ fields depending if status is NEW/UPDATED or DELETED
+        prefix = "previous_" if instance.status == "DELETED" else "new_"
+        citation_change.citing = getattr(instance, prefix+"citing")
+        resolved = getattr(instance, prefix+"resolved")
+        citation_change.cited = getattr(instance, prefix+"cited")
+        citation_change.content = getattr(instance, prefix+"content")
+        if getattr(instance, prefix+"doi"):
+            citation_change.content_type = adsmsg.CitationChangeContentType.doi
+            citation_change.content = citation_change.content.lower() # Normalize DOI to lower case: DOI names are case insensitive (https://www.doi.org/doi_handbook/2_Numbering.html#2.4)
+        elif getattr(instance, prefix+"pid"):
+            citation_change.content_type = adsmsg.CitationChangeContentType.pid
+        elif getattr(instance, prefix+"url"):
+            citation_change.content_type = adsmsg.CitationChangeContentType.url
+        citation_change.resolved = getattr(instance, prefix+"resolved")
+        citation_change.timestamp.FromDatetime(self.last_modification_date)
+        citation_change.status = getattr(adsmsg.Status, instance.status.lower())
+
     def _setup_schemas(self):
         """
         Create new schema, identify previous and drop older ones.
@@ -1,12 +1,17 @@
 
 import os
+import re
+import json
 import itertools
 import datetime
+import hashlib
 from adsputils import get_date, date2solrstamp
 from dateutil.tz import tzutc
 from adsmsg import DenormalizedRecord, NonBibRecord, Status, CitationChangeContentType
+from html.entities import name2codepoint
 from bs4 import BeautifulSoup
 from adsputils import setup_logging
+from ADSCitationCapture.cache import LRUCache
 
 # ============================= INITIALIZATION ==================================== #
 # - Use app logger:
@@ -21,16 +26,160 @@ logger = setup_logging(__name__, proj_home=proj_home,
                         attach_stdout=config.get('LOG_STDOUT', False))
 
 
+# Worker-local cache of record templates (see _get_record_template)
+record_templates_cache = LRUCache(maxsize=config.get('RECORD_TEMPLATE_CACHE_SIZE', 1000))
+
+# Markup that strip_html handles without BeautifulSoup, anything else (e.g.,
+# comments, scripts, tables or ambiguous entities) is delegated to it
+_html_inline_tags = frozenset(['a', 'abbr', 'b', 'big', 'blockquote', 'br', 'cite', 'code', 'dd', 'div', 'dl', 'dt', 'em',
+                               'font', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'li', 'ol', 'p', 'q', 's', 'small',
+                               'span', 'strike', 'strong', 'sub', 'sup', 'tt', 'u', 'ul', 'var'])
+_html_token = re.compile(r"""<(/?)([A-Za-z][A-Za-z0-9]*)(?:\s+[^\s"'>/=]+(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'=<>`]+))?)*\s*/?>"""
+                         r"""|&(?:#([0-9]{1,7})|#[xX]([0-9A-Fa-f]{1,6})|([A-Za-z][A-Za-z0-9]*));|[<&\x00]""")
+_html_void_tags = frozenset(['br', 'hr'])
+_html_implicitly_closed_tags = frozenset(['a', 'dd', 'dt', 'li', 'p'])
+_html_block_container_tags = frozenset(['blockquote', 'dd', 'div', 'dl', 'dt', 'li', 'ol', 'ul'])
+_html_block_tags = _html_block_container_tags | frozenset(['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'p'])
+_html_blanks = ' \t\n\r\x0c'
+
 # =============================== FUNCTIONS ======================================= #
+def _strip_html_with_beautifulsoup(text):
+    return ''.join(BeautifulSoup(text, features="lxml").findAll(text=True))
+
+def _decode_html_entity(match):
+    """
+    Return the character of an entity, or None if the parsers may disagree
+    about it (unknown names, control characters, surrogates, etc.)
+    """
+    decimal, hexadecimal, name = match.group(3, 4, 5)
+    if name is not None:
+        codepoint = name2codepoint.get(name)
+    else:
+        codepoint = int(decimal) if decimal is not None else int(hexadecimal, 16)
+        if codepoint <= 32 or 0x7F <= codepoint <= 0x9F or 0xD800 <= codepoint <= 0xDFFF or codepoint > 0x10FFFF:
+            codepoint = None
+    return chr(codepoint) if codepoint is not None else None
+
+def _append_html_text(texts, data):
+    # Like BeautifulSoup, text that only contains whitespaces is collapsed
+    if data:
+        if not data.strip(_html_blanks):
+            data = '\n' if '\n' in data else ' '
+        texts.append(data)
+
+def strip_html(text):
+    """
+    Remove tags and decode entities, producing the same output as joining the
+    text nodes of BeautifulSoup with lxml but without building a tree. Text
+    without markup is returned almost untouched and uncommon markup is
+    delegated to BeautifulSoup.
+    """
+    original_text = text
+    # Line breaks are normalized and leading whitespaces are dropped as in lxml
+    text = text.replace('\r\n', '\n').replace('\r', '\n').lstrip(_html_blanks)
+    if '<' not in text and '&' not in text and '\x00' not in text:
+        return text
+    texts = []
+    data = []
+    open_tags = []
+    position = 0
+    for match in _html_token.finditer(text):
+        data.append(text[position:match.start()])
+        position = match.end()
+        token = match.group(0)
+        if match.group(2) is not None:
+            # Tag (only properly nested markup is handled since lxml ignores
+            # some end tags, which changes how whitespaces are collapsed)
+            name = match.group(2).lower()
+            if name not in _html_inline_tags:
+                return _strip_html_with_beautifulsoup(original_text)
+            elif token.endswith('/>') and name not in _html_void_tags:
+                # Self-closing syntax is ignored by lxml for non-void elements
+                return _strip_html_with_beautifulsoup(original_text)
+            elif match.group(1):
+                if not open_tags or open_tags[-1] != name:
+                    return _strip_html_with_beautifulsoup(original_text)
+                open_tags.pop()
+            elif name in _html_implicitly_closed_tags and name in open_tags:
+                return _strip_html_with_beautifulsoup(original_text)
+            elif name in _html_block_tags and any(open_tag not in _html_block_container_tags for open_tag in open_tags):
+                # Blocks inside paragraphs, headers or inline elements are restructured by lxml
+                return _strip_html_with_beautifulsoup(original_text)
+            elif name not in _html_void_tags:
+                open_tags.append(name)
+            _append_html_text(texts, ''.join(data))
+            data = []
+        elif token[0] == '&' and len(token) > 1:
+            character = _decode_html_entity(match)
+            if character is None:
+                return _strip_html_with_beautifulsoup(original_text)
+            data.append(character)
+        elif token == '\x00' or text[position:position+1].isalnum() or text[position:position+1] in ('#', '/', '!', '?'):
+            # Null characters, unterminated entities and anything that looks like markup
+            return _strip_html_with_beautifulsoup(original_text)
+        else:
+            # Lone '<' or '&'
+            data.append(token)
+    data.append(text[position:])
+    _append_html_text(texts, ''.join(data))
+    return ''.join(texts)
+
 def build_record(app, citation_change, parsed_metadata, citations, entry_date=None):
     if citation_change.content_type != CitationChangeContentType.doi:
         raise Exception("Only DOI records can be forwarded to master")
-    # Extract required values
-    bibcode = parsed_metadata.get('bibcode')
-    if bibcode is None:
+    if parsed_metadata.get('bibcode') is None:
         raise Exception("Only records with a bibcode can be forwarded to master")
     if entry_date is None:
         entry_date = citation_change.timestamp.ToDatetime()
+    # Start from a copy of the part of the record that only depends on the metadata
+    record = DenormalizedRecord()
+    record._data.CopyFrom(_get_record_template(app, citation_change.content, parsed_metadata)._data)
+    # Fill in the fields that change between forwards
+    n_citations = len(citations)
+    n_authors = record.author_count
+    record.entry_date = date2solrstamp(entry_date) # date2solrstamp(get_date()),
+    record.citation.extend(citations)
+    record.citation_count = n_citations
+    record.citation_count_norm = n_citations/n_authors if n_authors > 0 else 0
+    # Status
+    if citation_change.status == Status.new:
+        status = 2
+    elif citation_change.status == Status.updated:
+        status = 3
+    elif citation_change.status == Status.deleted:
+        status = 1
+        # Only use this field for deletions, otherwise Solr will complain the field does not exist
+        # and if this key does not exist in the dict/protobuf, the message will be
+        # treated as new/update by MasterPipeline
+        record.status = status
+    else:
+        status = 0 # active
+    nonbib_record = _build_nonbib_record(app, citation_change, record, status)
+    return record, nonbib_record
+
+def _get_record_template(app, doi, parsed_metadata):
+    """
+    Return the part of the record that only depends on the citation target
+    metadata (it must not be modified). Templates are cached per citation
+    target and they are rebuilt when the hash of the metadata changes.
+    """
+    if 'pubdate' not in parsed_metadata:
+        # The publication date defaults to the current date, the template cannot be reused
+        return _build_record_template(app, doi, parsed_metadata)
+    key = hashlib.sha256(json.dumps([app.conf['DOI_URL'], parsed_metadata], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    cached = record_templates_cache.get(doi)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    template = _build_record_template(app, doi, parsed_metadata)
+    record_templates_cache.set(doi, (key, template))
+    return template
+
+def _build_record_template(app, doi, parsed_metadata):
+    """
+    Build a record without the fields that change between forwards (entry
+    date, citations and status)
+    """
+    bibcode = parsed_metadata.get('bibcode')
     alternate_bibcode = parsed_metadata.get('alternate_bibcode', [])
     abstract = parsed_metadata.get('abstract', "")
     title = parsed_metadata.get('title', "")
@@ -43,8 +192,8 @@ def build_record(app, citation_change, parsed_metadata, citations, entry_date=No
     version = parsed_metadata.get('version', "")
     doctype = parsed_metadata.get('doctype', "software")
     # Clean abstract and title
-    abstract = ''.join(BeautifulSoup(abstract, features="lxml").findAll(text=True)).replace('\n', ' ').replace('\r', '')
-    title = ''.join(BeautifulSoup(title, features="lxml").findAll(text=True)).replace('\n', ' ').replace('\r', '')
+    abstract = strip_html(abstract).replace('\n', ' ').replace('\r', '')
+    title = strip_html(title).replace('\n', ' ').replace('\r', '')
     # Extract year
     year = pubdate.split("-")[0]
     # Build an author_facet_hier list with the following structure:
@@ -57,8 +206,6 @@ def build_record(app, citation_change, parsed_metadata, citations, entry_date=No
     # Count
     n_keywords = len(keywords)
     n_authors = len(authors)
-    n_citations = len(citations)
-    doi = citation_change.content
     record_dict = {
         'abstract': abstract,
         'ack': '',
@@ -77,7 +224,6 @@ def build_record(app, citation_change, parsed_metadata, citations, entry_date=No
         'copyright': [],
         'comment': [],
         'database': ['general', 'astronomy'],
-        'entry_date': date2solrstamp(entry_date), # date2solrstamp(get_date()),
         'year': year,
         'date': (datetime.datetime.strptime(pubdate, "%Y-%m-%d")+datetime.timedelta(minutes=30)).strftime('%Y-%m-%dT%H:%M:%S.%fZ'), # TODO: Why this date has to be 30 minutes in advance? This is based on ADSImportPipeline SolrAdapter
         'doctype': doctype,
@@ -91,9 +237,6 @@ def build_record(app, citation_change, parsed_metadata, citations, entry_date=No
         'links_data': ['{{"access": "", "instances": "", "title": "", "type": "electr", "url": "{}"}}'.format(app.conf['DOI_URL'] + doi)], # TODO: How is it different from nonbib?
         'identifier': [bibcode, doi] + alternate_bibcode,
         'esources': ["PUB_HTML"],
-        'citation': citations,
-        'citation_count': n_citations,
-        'citation_count_norm': n_citations/n_authors if n_authors > 0 else 0,
         'data_count': 1, # Number of elements in `links_data`
         'keyword': keywords,
         'keyword_facet': keywords,
@@ -111,22 +254,7 @@ def build_record(app, citation_change, parsed_metadata, citations, entry_date=No
     }
     if version is None: # Concept DOIs may not contain version
         del record_dict['version']
-    # Status
-    if citation_change.status == Status.new:
-        status = 2
-    elif citation_change.status == Status.updated:
-        status = 3
-    elif citation_change.status == Status.deleted:
-        status = 1
-        # Only use this field for deletions, otherwise Solr will complain the field does not exist
-        # and if this key does not exist in the dict/protobuf, the message will be
-        # treated as new/update by MasterPipeline
-        record_dict['status'] = status
-    else:
-        status = 0 # active
-    record = DenormalizedRecord(**record_dict)
-    nonbib_record = _build_nonbib_record(app, citation_change, record, status)
-    return record, nonbib_record
+    return DenormalizedRecord(**record_dict)
 
 
 def _build_nonbib_record(app, citation_change, record, status):
@@ -156,3 +284,21 @@ def _build_nonbib_record(app, citation_change, record, status):
     nonbib_record.property.extend(record.property)
     return nonbib_record
 
+def build_fingerprint(records):
+    """
+    Hash of the serialized records (e.g., DenormalizedRecord and NonBibRecord)
+    that can be used to detect if they changed since the last time they were
+    forwarded. Citations are hashed sorted, hence the order in which they were
+    retrieved from the database does not matter.
+    """
+    fingerprint = hashlib.sha256()
+    for record in records:
+        data = record._data
+        if isinstance(record, DenormalizedRecord) and list(data.citation) != sorted(data.citation):
+            data = data.__class__()
+            data.CopyFrom(record._data)
+            del data.citation[:]
+            data.citation.extend(sorted(record._data.citation))
+        fingerprint.update(record.__class__.__name__.encode('utf-8'))
+        fingerprint.update(data.SerializeToString(deterministic=True))
+    return fingerprint.hexdigest()
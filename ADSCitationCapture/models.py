@@ -1,7 +1,7 @@
-from sqlalchemy import Column, Boolean, DateTime, String, Text, Integer, func, UniqueConstraint, ForeignKey
+from sqlalchemy import Column, Boolean, DateTime, String, Text, Integer, LargeBinary, func, UniqueConstraint, ForeignKey, Index
 from sqlalchemy.orm import relationship
-from sqlalchemy import orm
-from sqlalchemy.dialects.postgresql import ENUM, JSON, JSONB
+from sqlalchemy import orm, event, DDL
+from sqlalchemy.dialects.postgresql import ENUM, JSON, JSONB, ARRAY
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy_continuum import make_versioned
 from adsputils import UTCDateTime, get_date
@@ -15,6 +15,9 @@ citation_content_type = ENUM('DOI', 'PID', 'URL', name='citation_content_type')
 citation_change_type = ENUM('NEW', 'DELETED', 'UPDATED', name='citation_change_type')
 citation_status_type = ENUM('REGISTERED', 'DELETED', 'DISCARDED', name='citation_status_type')
 target_status_type = ENUM('REGISTERED', 'DELETED', 'DISCARDED', name='target_status_type')
+maintenance_run_status_type = ENUM('DISPATCHING', 'RUNNING', 'FINISHED', name='maintenance_run_status_type')
+maintenance_run_chunk_status_type = ENUM('PENDING', 'DONE', name='maintenance_run_chunk_status_type')
+event_status_type = ENUM('PENDING', 'SENT', 'FAILED', name='event_status_type')
 
 class RawCitation(Base):
     __tablename__ = 'raw_citation'
@@ -65,7 +68,8 @@ class Citation(Base):
 class CitationTarget(Base):
     __tablename__ = 'citation_target'
     __table_args__ = ({"schema": "public"})
-    __versioned__ = {}  # Must be added to all models that are to be versioned
+    # Must be added to all models that are to be versioned (denormalized columns derived from citations are not versioned)
+    __versioned__ = {'exclude': ['registered_citation_count', 'registered_citing']}
     content = Column(Text(), primary_key=True)      # DOI/URL/PID value: we assume it is unique independently what content type is
     content_type = Column(citation_content_type)
     raw_cited_metadata = Column(Text())
@@ -73,13 +77,104 @@ class CitationTarget(Base):
     status = Column(target_status_type)
     created = Column(UTCDateTime, default=get_date)
     updated = Column(UTCDateTime, onupdate=get_date)
+    registered_citation_count = Column(Integer, default=0)      # Number of REGISTERED citations (maintained by db.py)
+    registered_citing = Column(ARRAY(Text()), default=[])       # Sorted bibcodes of the REGISTERED citations (maintained by db.py)
     citations = relationship("Citation", primaryjoin="CitationTarget.content==Citation.content")
 
+# Indexes for the most frequent lookups (defined after the models because
+# some of them are expressions on the JSONB metadata)
+Index('ix_public_citation_content_status', Citation.content, Citation.status)
+Index('ix_public_citation_target_status', CitationTarget.status)
+Index('ix_public_citation_target_bibcode', CitationTarget.parsed_cited_metadata['bibcode'].astext)
+Index('ix_public_citation_target_alternate_bibcode', CitationTarget.parsed_cited_metadata['alternate_bibcode'], postgresql_using='gin')
+
 class Event(Base):
+    """
+    Outbox of events for the broker: they are stored as pending in the same
+    transaction as the citation changes that produce them and they are sent
+    later on by 'task_send_events'
+    """
     __tablename__ = 'event'
+    # Range partitioned by creation date (monthly partitions, see
+    # 'db.create_event_partitions') to be able to archive old events
+    __table_args__ = ({"schema": "public", "postgresql_partition_by": "RANGE (created)"})
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    data = Column(JSONB)
+    status = Column(event_status_type, default='PENDING')
+    attempts = Column(Integer, default=0)           # Number of failed emissions
+    dump_prefix = Column(Text())                    # Date of the change that produced the event (e.g., 20190101_000000)
+    created = Column(UTCDateTime, default=get_date, primary_key=True) # Partition key (part of the primary key)
+    updated = Column(UTCDateTime, onupdate=get_date)
+
+# Only pending events are scanned by the sender
+Index('ix_public_event_pending', Event.id, postgresql_where=Event.status == 'PENDING')
+# Lookups by source and target identifiers
+Index('ix_public_event_source_id', Event.data[('Source', 'Identifier', 'ID')].astext)
+Index('ix_public_event_target_id', Event.data[('Target', 'Identifier', 'ID')].astext)
+# Rows that do not belong to any monthly partition
+event.listen(Event.__table__, 'after_create', DDL("CREATE TABLE IF NOT EXISTS public.event_default PARTITION OF public.event DEFAULT"))
+
+class EmittedRelation(Base):
+    """
+    Relations already emitted to the broker for the relationships that must
+    not be emitted more than once (e.g., IsIdenticalTo)
+    """
+    __tablename__ = 'emitted_relation'
+    __table_args__ = ({"schema": "public"})
+    relationship = Column(Text(), primary_key=True) # Relationship sub-type (e.g., IsIdenticalTo)
+    source_id = Column(Text(), primary_key=True)
+    target_id = Column(Text(), primary_key=True)
+    created = Column(UTCDateTime, default=get_date)
+
+class CanonicalBibcode(Base):
+    __tablename__ = 'canonical_bibcode'
+    __table_args__ = ({"schema": "public"})
+    bibcode = Column(Text(), primary_key=True)      # Bibcode as received (e.g., citing bibcode)
+    canonical = Column(Text())                      # Canonical bibcode as registered in Solr (NULL if it was not found)
+    created = Column(UTCDateTime, default=get_date)
+    updated = Column(UTCDateTime, default=get_date, onupdate=get_date) # Used to compute the age of the cached mapping
+
+class ForwardedRecord(Base):
+    __tablename__ = 'forwarded_record'
+    __table_args__ = ({"schema": "public"})
+    content = Column(Text(), primary_key=True)      # Citation target content (DOI)
+    fingerprint = Column(Text())                    # Hash of the last records forwarded to master
+    created = Column(UTCDateTime, default=get_date)
+    updated = Column(UTCDateTime, onupdate=get_date)
+
+class OutputRequest(Base):
+    __tablename__ = 'output_request'
+    __table_args__ = ({"schema": "public"})
+    content = Column(Text(), primary_key=True)      # Citation target content (DOI)
+    citation_change = Column(LargeBinary())         # Serialized citation change of the latest request
+    parsed_metadata = Column(JSONB)                 # Citation target metadata of the latest request
+    citations = Column(JSONB)                       # Citing bibcodes of the latest request
+    bibcode_replaced = Column(JSONB)                # Bibcode replacement accumulated over the coalesced requests
+    force = Column(Boolean())                       # Forward even if the records did not change (if any request was forced)
+    created = Column(UTCDateTime, default=get_date)
+    updated = Column(UTCDateTime, onupdate=get_date)
+
+class MaintenanceRun(Base):
+    __tablename__ = 'maintenance_run'
     __table_args__ = ({"schema": "public"})
     id = Column(Integer, primary_key=True)
-    data = Column(JSONB)
+    task = Column(Text())                           # Maintenance task name (e.g., canonical, metadata, resend, reevaluate)
+    arguments = Column(JSONB)                       # Requested DOIs/bibcodes and options (e.g., force)
+    status = Column(maintenance_run_status_type)
+    n_targets = Column(Integer, default=0)
+    n_done = Column(Integer, default=0)
+    n_failed = Column(Integer, default=0)
+    n_skipped = Column(Integer, default=0)
+    created = Column(UTCDateTime, default=get_date)
+    updated = Column(UTCDateTime, onupdate=get_date)
+
+class MaintenanceRunChunk(Base):
+    __tablename__ = 'maintenance_run_chunk'
+    __table_args__ = ({"schema": "public"})
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('public.maintenance_run.id'), index=True)
+    contents = Column(JSONB)                        # List of citation target contents processed by one subtask
+    status = Column(maintenance_run_chunk_status_type)
     created = Column(UTCDateTime, default=get_date)
     updated = Column(UTCDateTime, onupdate=get_date)
 
@@ -0,0 +1,389 @@
+import os
+import gzip
+import json
+import collections
+import socket
+import struct
+import datetime
+import time
+import threading
+import adsmsg
+
+# ============================= INITIALIZATION ==================================== #
+# - Use app logger:
+#import logging
+#logger = logging.getLogger('ads-citation-capture')
+# - Or individual logger for this file:
+from adsputils import setup_logging, load_config
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(__name__, proj_home=proj_home,
+                        level=config.get('LOGGING_LEVEL', 'INFO'),
+                        attach_stdout=config.get('LOG_STDOUT', False))
+
+# List messages used to publish batches of records, DenormalizedRecordList
+# is only available in recent versions of adsmsg (otherwise denormalized
+# records are published one by one)
+_record_list_classes = {
+    adsmsg.NonBibRecord: adsmsg.NonBibRecordList,
+}
+if hasattr(adsmsg, 'DenormalizedRecordList'):
+    _record_list_classes[adsmsg.DenormalizedRecord] = adsmsg.DenormalizedRecordList
+
+# Record files: the message type name and the serialized message are each
+# preceded by their length (unsigned 32-bit big-endian integer)
+_record_length_format = '>I'
+_record_file_extension = '.pb.gz'
+
+_archive_file_extension = '.jsonl.gz'
+_archive_index_extension = '.idx'
+
+
+# =============================== FUNCTIONS ======================================= #
+def _build_record_list(records):
+    """
+    Pack records of the same type in their list message (e.g.,
+    NonBibRecordList), or return None if there is no list message for them
+    """
+    record_list_class = _record_list_classes.get(type(records[0]))
+    if record_list_class is None:
+        return None
+    record_list = record_list_class()
+    # The records are stored in the only repeated message field of the list
+    field_name = [field.name for field in record_list._data.DESCRIPTOR.fields if field.label == field.LABEL_REPEATED][0]
+    for record in records:
+        getattr(record_list._data, field_name).add().CopyFrom(record._data)
+    return record_list
+
+class Buffer(object):
+    """
+    Accumulate items and publish them together when `batch_size` items are
+    buffered or when the oldest item has been waiting for `max_delay`
+    seconds (a timer thread flushes the buffer if no other item is added).
+    Items are published while holding the buffer lock, hence the publishing
+    function is never called from two threads at the same time. It is local
+    to the worker process, hence it should be flushed when the process shuts
+    down.
+    """
+
+    def __init__(self, publish, batch_size=1, max_delay=5):
+        """
+        :param publish: Function that publishes a list of items.
+        :param batch_size: Number of items that triggers a flush (1 to
+            publish every item immediately).
+        :param max_delay: Maximum number of seconds that an item can wait in
+            the buffer.
+        """
+        self.publish = publish
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._items = []
+        self._callbacks = []
+        self._oldest_item_time = None
+        self._timer = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item, callback=None):
+        """
+        Buffer an item, `callback` is called once it has been published
+        (e.g., to register that it was forwarded).
+        """
+        with self._lock:
+            if not self._items:
+                self._oldest_item_time = time.time()
+                self._start_timer()
+            self._items.append(item)
+            if callback is not None:
+                self._callbacks.append(callback)
+            if len(self._items) >= self.batch_size or self._expired():
+                self.flush()
+
+    def flush_expired(self):
+        """
+        Publish the buffered items if the oldest one has been waiting for
+        `max_delay` seconds (e.g., after every task)
+        """
+        with self._lock:
+            if self._expired():
+                self.flush()
+
+    def flush(self):
+        """
+        Publish all the buffered items, they are kept in the buffer if they
+        cannot be published
+        """
+        with self._lock:
+            items, self._items = self._items, []
+            callbacks, self._callbacks = self._callbacks, []
+            if not items:
+                return
+            try:
+                self.publish(items)
+            except:
+                self._items = items + self._items
+                self._callbacks = callbacks + self._callbacks
+                raise
+            self._oldest_item_time = None
+            self._cancel_timer()
+            logger.debug("Published '%i' buffered items", len(items))
+            for callback in callbacks:
+                callback()
+
+    def _start_timer(self):
+        """
+        Flush the buffer from a timer thread once the oldest item expires
+        """
+        if self.max_delay is None or self._timer is not None:
+            return
+        delay = max(0, self._oldest_item_time + self.max_delay - time.time())
+        self._timer = threading.Timer(delay, self._flush_on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _flush_on_timer(self):
+        with self._lock:
+            if self._timer is not threading.current_thread():
+                # The timer was cancelled while it waited for the lock
+                return
+            self._timer = None
+            try:
+                self.flush_expired()
+            except Exception:
+                logger.exception("Buffered items could not be published, it will be tried again in '%s' seconds", self.max_delay)
+                self._oldest_item_time = time.time()
+            if self._items:
+                self._start_timer()
+
+    def _expired(self):
+        return len(self._items) > 0 and self.max_delay is not None \
+                and time.time() - self._oldest_item_time >= self.max_delay
+
+class RecordBuffer(Buffer):
+    """
+    Buffer of records to be forwarded to master, they are published in
+    batches (one list message per record type)
+    """
+
+    def __init__(self, forward, batch_size=1, max_delay=5):
+        """
+        :param forward: Function that publishes a message.
+        """
+        Buffer.__init__(self, self._forward_records, batch_size=batch_size, max_delay=max_delay)
+        self.forward = forward
+
+    def _forward_records(self, records):
+        records_by_type = {}
+        for record in records:
+            records_by_type.setdefault(type(record), []).append(record)
+        for same_type_records in records_by_type.values():
+            # Single records are published as they are
+            record_list = _build_record_list(same_type_records) if len(same_type_records) > 1 else None
+            if record_list is None:
+                for record in same_type_records:
+                    self.forward(record)
+            else:
+                self.forward(record_list)
+
+class RecordFileSink(object):
+    """
+    Write records to gzip compressed files in `directory` instead of
+    publishing them to master, so that they can be replayed later (see
+    `read_record_file`). Every record is stored as its message type name
+    and its serialized protobuf, each of them preceded by its length. Files
+    are rotated once `max_file_size` uncompressed bytes have been written
+    and they keep a '.tmp' suffix until they are complete.
+    """
+
+    def __init__(self, directory, max_file_size=100*1024*1024):
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self._file = None
+        self._filename = None
+        self._file_size = 0
+        self._file_sequence = 0
+        self._lock = threading.RLock()
+
+    def write(self, record):
+        """
+        Append a record (or a list of records) to the current file
+        """
+        with self._lock:
+            if self._file is None:
+                self._open()
+            for data in (type(record).__name__.encode('utf-8'), record.serialize()):
+                self._file.write(struct.pack(_record_length_format, len(data)))
+                self._file.write(data)
+                self._file_size += struct.calcsize(_record_length_format) + len(data)
+            if self._file_size >= self.max_file_size:
+                self.close()
+
+    def close(self):
+        """
+        Close the current file and make it available for replay
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            os.rename(self._filename + '.tmp', self._filename)
+            logger.info("Closed record file '%s' ('%i' bytes)", self._filename, self._file_size)
+            self._file = None
+            self._filename = None
+            self._file_size = 0
+
+    def _open(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        # Process id and sequence keep the names of files written by
+        # concurrent workers unique
+        self._file_sequence += 1
+        now = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = "records_{}_{}_{}_{:06d}{}".format(now, socket.gethostname(), os.getpid(), self._file_sequence, _record_file_extension)
+        self._filename = os.path.join(self.directory, filename)
+        self._file = gzip.open(self._filename + '.tmp', 'wb')
+        self._file_size = 0
+
+def list_record_files(directory):
+    """
+    Complete record files in `directory` sorted by creation date
+    """
+    if not os.path.exists(directory):
+        return []
+    return [os.path.join(directory, filename) for filename in sorted(os.listdir(directory)) if filename.endswith(_record_file_extension)]
+
+def read_record_file(filename):
+    """
+    Iterate over the records stored in a file written by RecordFileSink
+    """
+    length_size = struct.calcsize(_record_length_format)
+    with gzip.open(filename, 'rb') as f:
+        while True:
+            fields = []
+            for i in range(2):
+                length = f.read(length_size)
+                if len(length) == 0 and i == 0:
+                    return
+                elif len(length) < length_size:
+                    raise ValueError("Truncated record file '{}'".format(filename))
+                length = struct.unpack(_record_length_format, length)[0]
+                data = f.read(length)
+                if len(data) < length:
+                    raise ValueError("Truncated record file '{}'".format(filename))
+                fields.append(data)
+            message_type, data = fields
+            yield getattr(adsmsg, message_type.decode('utf-8')).deserializer(data)
+
+class JSONLinesArchive(object):
+    """
+    Append-only archive of JSON documents. Every stream (e.g., relationship
+    and day) is written to gzip compressed JSON lines files in its own
+    sub-directory, which are rotated once `max_file_size` uncompressed bytes
+    have been written. Each file has an index sidecar ('.idx') with one tab
+    separated line per document: its line number and its identifiers (see
+    `search_archive`). Writes are buffered and they reach the disk when a file
+    is rotated or closed, only `max_open_files` streams are kept open.
+    """
+
+    def __init__(self, directory, max_file_size=100*1024*1024, max_open_files=16):
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.max_open_files = max_open_files
+        self._streams = collections.OrderedDict()
+        # Streams closed before being rotated are reopened in append mode
+        self._closed_streams = {}
+        self._lock = threading.RLock()
+
+    def append(self, stream, document, identifiers):
+        """
+        Append a document to a stream (tuple of sub-directory names) and
+        index it by its identifiers
+        """
+        line = (json.dumps(document, sort_keys=True) + "\n").encode('utf-8')
+        with self._lock:
+            state = self._streams.pop(stream, None)
+            if state is None:
+                state = self._open(stream, self._closed_streams.pop(stream, None))
+            # Most recently used streams are kept at the end
+            self._streams[stream] = state
+            state['file'].write(line)
+            state['index'].write("{}\t{}\n".format(state['n_lines'], "\t".join(identifiers)))
+            state['n_lines'] += 1
+            state['size'] += len(line)
+            if state['size'] >= self.max_file_size:
+                self._close(self._streams.pop(stream))
+            while len(self._streams) > self.max_open_files:
+                closed_stream, closed_state = self._streams.popitem(last=False)
+                self._close(closed_state)
+                self._closed_streams[closed_stream] = closed_state
+
+    def close(self):
+        """
+        Close all the open files
+        """
+        with self._lock:
+            while self._streams:
+                self._close(self._streams.popitem(last=False)[1])
+            self._closed_streams.clear()
+
+    def _open(self, stream, closed_state=None):
+        if closed_state is not None:
+            # Gzip files can contain several members, they are read as one
+            closed_state['file'] = gzip.open(closed_state['filename'], 'ab')
+            closed_state['index'] = open(closed_state['filename'] + _archive_index_extension, 'a')
+            return closed_state
+        dirname = os.path.join(self.directory, *stream)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # Host and process id avoid concurrent writes to the same file
+        sequence = 0
+        while True:
+            sequence += 1
+            filename = os.path.join(dirname, "{}_{}_{}_{:06d}{}".format("_".join(stream), socket.gethostname(), os.getpid(), sequence, _archive_file_extension))
+            if not os.path.exists(filename):
+                break
+        return {
+            'filename': filename,
+            'file': gzip.open(filename, 'wb'),
+            'index': open(filename + _archive_index_extension, 'w'),
+            'n_lines': 0,
+            'size': 0,
+        }
+
+    def _close(self, state):
+        state['file'].close()
+        state['index'].close()
+        logger.debug("Closed archive file '%s' ('%i' documents)", state['filename'], state['n_lines'])
+
+def search_archive(directory, identifier):
+    """
+    Iterate over the documents of an archive written by JSONLinesArchive that
+    are indexed with `identifier`
+    """
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith(_archive_file_extension + _archive_index_extension):
+                continue
+            index_filename = os.path.join(dirpath, filename)
+            with open(index_filename) as f:
+                line_numbers = set(int(fields[0]) for fields in (line.rstrip("\n").split("\t") for line in f) if identifier in fields[1:])
+            if not line_numbers:
+                continue
+            archive_filename = index_filename[:-len(_archive_index_extension)]
+            try:
+                with gzip.open(archive_filename, 'rb') as f:
+                    for line_number, line in enumerate(f):
+                        if line_number in line_numbers:
+                            yield json.loads(line.decode('utf-8'))
+            except (EOFError, IOError):
+                # Files still being written (or left by a crash) are only
+                # readable up to their last complete block
+                logger.warning("Archive file '%s' is incomplete", archive_filename)
@@ -1,6 +1,8 @@
 
 import os
+import itertools
 from kombu import Queue
+from celery.signals import task_postrun, worker_process_shutdown
 from google.protobuf.json_format import MessageToDict
 from datetime import datetime
 import ADSCitationCapture.app as app_module
@@ -10,6 +12,7 @@ import ADSCitationCapture.url as url
 import ADSCitationCapture.db as db
 import ADSCitationCapture.forward as forward
 import ADSCitationCapture.api as api
+import ADSCitationCapture.output as output
 import adsmsg
 
 # ============================= INITIALIZATION ==================================== #
@@ -24,13 +27,57 @@ app.conf.CELERY_QUEUES = (
     Queue('process-new-citation', app.exchange, routing_key='process-new-citation'),
     Queue('process-updated-citation', app.exchange, routing_key='process-updated-citation'),
     Queue('process-deleted-citation', app.exchange, routing_key='process-deleted-citation'),
+    Queue('process-citation-target-changes', app.exchange, routing_key='process-citation-target-changes'),
     Queue('maintenance_canonical', app.exchange, routing_key='maintenance_canonical'),
     Queue('maintenance_metadata', app.exchange, routing_key='maintenance_metadata'),
     Queue('maintenance_resend', app.exchange, routing_key='maintenance_resend'),
     Queue('maintenance_reevaluate', app.exchange, routing_key='maintenance_reevaluate'),
+    Queue('maintenance_chunk', app.exchange, routing_key='maintenance_chunk'),
+    Queue('maintenance_resume', app.exchange, routing_key='maintenance_resume'),
     Queue('output-results', app.exchange, routing_key='output-results'),
+    Queue('send-events', app.exchange, routing_key='send-events'),
 )
 
+# Records forwarded to master can be written to local files instead of being
+# published to the broker (see 'run.py REPLAY')
+record_file_sink = output.RecordFileSink(app.conf.get('OUTPUT_SINK_DIRECTORY') or os.path.join(proj_home, 'records'),
+                                         max_file_size=app.conf.get('OUTPUT_SINK_MAX_FILE_SIZE', 100*1024*1024))
+
+def _forward_message(message):
+    """
+    Publish a message to master or write it to the record files depending on
+    the configured output sink
+    """
+    if app.conf.get('OUTPUT_SINK', 'broker') == 'file':
+        record_file_sink.write(message)
+    else:
+        app.forward_message(message)
+
+# Records forwarded to master are published in batches, the lambda resolves
+# '_forward_message' when the batch is published (tests replace 'app')
+output_buffer = output.RecordBuffer(lambda message: _forward_message(message),
+                                    batch_size=app.conf.get('OUTPUT_BATCH_SIZE', 100),
+                                    max_delay=app.conf.get('OUTPUT_BATCH_MAX_DELAY', 5))
+
+@task_postrun.connect
+def flush_expired_buffers(**kwargs):
+    """
+    Publish the buffered records that have waited for too long as soon as
+    the task finishes (the buffer timer also publishes them when the worker
+    is idle)
+    """
+    output_buffer.flush_expired()
+
+@worker_process_shutdown.connect
+def flush_buffers(**kwargs):
+    """
+    Publish the records and archive the events that are still buffered
+    before the worker exits
+    """
+    output_buffer.flush()
+    record_file_sink.close()
+    webhook.close_event_archive()
+
 
 # ============================= TASKS ============================================= #
 
@@ -47,29 +94,22 @@ def task_process_new_citation(citation_change, force=False):
     content_type = None
     is_link_alive = False
     status = "DISCARDED"
-
-    # Check if we already have the citation target in the DB
-    metadata = db.get_citation_target_metadata(app, citation_change.content)
-    citation_target_in_db = bool(metadata) # False if dict is empty
-    raw_metadata = metadata.get('raw', None)
-    parsed_metadata = metadata.get('parsed', {})
-    if citation_target_in_db:
-        status = metadata.get('status', 'DISCARDED') # "REGISTERED" if it is a software record
-
+    raw_metadata = None
+    parsed_metadata = {}
+    fetched_metadata = None
+    deferred_tasks = []
+    original_citations = None
+
+    # External requests are sent before the transaction starts, so that no
+    # database connection or lock is held while waiting for them
+    citation_target_in_db = bool(db.get_citation_target_metadata(app, citation_change.content))
     if citation_change.content_type == adsmsg.CitationChangeContentType.doi \
         and citation_change.content not in ["", None]:
         # Default values
         content_type = "DOI"
         #
         if not citation_target_in_db:
-            # Fetch DOI metadata (if HTTP request fails, an exception is raised
-            # and the task will be re-queued (see app.py and adsputils))
-            raw_metadata = doi.fetch_metadata(app.conf['DOI_URL'], app.conf['DATACITE_URL'], citation_change.content)
-            if raw_metadata:
-                parsed_metadata = doi.parse_metadata(raw_metadata)
-                is_software = parsed_metadata.get('doctype', '').lower() == "software"
-                if parsed_metadata.get('bibcode') not in (None, "") and is_software:
-                    status = "REGISTERED"
+            fetched_metadata = _fetch_citation_target_metadata(citation_change)
     elif citation_change.content_type == adsmsg.CitationChangeContentType.pid \
         and citation_change.content not in ["", None]:
         content_type = "PID"
@@ -87,38 +127,55 @@ def task_process_new_citation(citation_change, force=False):
         status = None
 
     if status is not None:
-        if not citation_target_in_db:
-            # Create citation target in the DB
-            target_stored = db.store_citation_target(app, citation_change, content_type, raw_metadata, parsed_metadata, status)
-        if status == "REGISTERED":
-            if citation_change.content_type == adsmsg.CitationChangeContentType.doi:
-                if canonical_citing_bibcode != citation_change.citing:
-                    # These two bibcodes are identical and we can signal the broker
-                    event_data = webhook.identical_bibcodes_event_data(citation_change.citing, canonical_citing_bibcode)
+        # All the reads and writes are committed together
+        with db.unit_of_work(app) as session:
+            # Check if we already have the citation target in the DB
+            metadata = _get_citation_target_metadata(citation_change, session)
+            citation_target_in_db = bool(metadata) # False if dict is empty
+            if citation_target_in_db:
+                raw_metadata = metadata.get('raw', None)
+                parsed_metadata = metadata.get('parsed', {})
+                status = metadata.get('status', 'DISCARDED') # "REGISTERED" if it is a software record
+            else:
+                if fetched_metadata is None:
+                    # Citation targets are never deleted, this only happens
+                    # if the database was modified by hand
+                    fetched_metadata = _fetch_citation_target_metadata(citation_change)
+                raw_metadata, parsed_metadata, status = fetched_metadata
+                # Create citation target in the DB
+                target_stored = db.store_citation_target(app, citation_change, content_type, raw_metadata, parsed_metadata, status, session=session)
+            if status == "REGISTERED":
+                if citation_change.content_type == adsmsg.CitationChangeContentType.doi:
+                    if canonical_citing_bibcode != citation_change.citing:
+                        # These two bibcodes are identical and we can signal the broker
+                        event_data = webhook.identical_bibcodes_event_data(citation_change.citing, canonical_citing_bibcode)
+                        if event_data:
+                            dump_prefix = citation_change.timestamp.ToDatetime().strftime("%Y%m%d_%H%M%S")
+                            logger.debug("Calling '_store_event' for '%s' IsIdenticalTo '%s'", citation_change.citing, canonical_citing_bibcode)
+                            _store_event(event_data, dump_prefix, session=session, deferred_tasks=deferred_tasks)
+                    citation_target_bibcode = parsed_metadata.get('bibcode')
+                    # The new bibcode and the DOI are identical
+                    event_data = webhook.identical_bibcode_and_doi_event_data(citation_target_bibcode, citation_change.content)
                     if event_data:
                         dump_prefix = citation_change.timestamp.ToDatetime().strftime("%Y%m%d_%H%M%S")
-                        logger.debug("Calling 'task_emit_event' for '%s' IsIdenticalTo '%s'", citation_change.citing, canonical_citing_bibcode)
-                        task_emit_event.delay(event_data, dump_prefix)
-                citation_target_bibcode = parsed_metadata.get('bibcode')
-                # The new bibcode and the DOI are identical
-                event_data = webhook.identical_bibcode_and_doi_event_data(citation_target_bibcode, citation_change.content)
-                if event_data:
-                    dump_prefix = citation_change.timestamp.ToDatetime().strftime("%Y%m%d_%H%M%S")
-                    logger.debug("Calling 'task_emit_event' for '%s' IsIdenticalTo '%s'", citation_target_bibcode, citation_change.content)
-                    task_emit_event.delay(event_data, dump_prefix)
-                # Get citations from the database and transform the stored bibcodes into their canonical ones as registered in Solr.
-                original_citations = db.get_citations_by_bibcode(app, citation_target_bibcode)
-                citations = api.get_canonical_bibcodes(app, original_citations)
-                # Add canonical bibcode of current detected citation
-                if canonical_citing_bibcode and canonical_citing_bibcode not in citations:
-                    citations.append(canonical_citing_bibcode)
-                logger.debug("Calling 'task_output_results' with '%s'", citation_change)
-                task_output_results.delay(citation_change, parsed_metadata, citations)
-            logger.debug("Calling '_emit_citation_change' with '%s'", citation_change)
-            _emit_citation_change(citation_change, parsed_metadata)
-        # Store the citation at the very end, so that if an exception is raised before
-        # this task can be re-run in the future without key collisions in the database
-        stored = db.store_citation(app, citation_change, content_type, raw_metadata, parsed_metadata, status)
+                        logger.debug("Calling '_store_event' for '%s' IsIdenticalTo '%s'", citation_target_bibcode, citation_change.content)
+                        _store_event(event_data, dump_prefix, session=session, deferred_tasks=deferred_tasks)
+                    # Get citations from the database (they are transformed into their canonical form once committed)
+                    original_citations = db.get_citations_by_bibcode(app, citation_target_bibcode, session=session)
+                logger.debug("Calling '_emit_citation_change' with '%s'", citation_change)
+                _emit_citation_change(citation_change, parsed_metadata, session=session, deferred_tasks=deferred_tasks)
+            # Store the citation at the very end, so that if an exception is raised before
+            # this task can be re-run in the future without key collisions in the database
+            stored = db.store_citation(app, citation_change, content_type, raw_metadata, parsed_metadata, status, session=session)
+    if original_citations is not None:
+        # Transform the stored bibcodes into their canonical ones as registered in Solr.
+        citations = api.get_canonical_bibcodes(app, original_citations)
+        # Add canonical bibcode of current detected citation
+        if canonical_citing_bibcode and canonical_citing_bibcode not in citations:
+            citations.append(canonical_citing_bibcode)
+        logger.debug("Calling 'task_output_results' with '%s'", citation_change)
+        deferred_tasks.append((task_output_results, (citation_change, parsed_metadata, citations), {}))
+    _delay_tasks(deferred_tasks)
 
 @app.task(queue='process-updated-citation')
 def task_process_updated_citation(citation_change, force=False):
@@ -126,41 +183,100 @@ def task_process_updated_citation(citation_change, force=False):
     Update citation record
     Emit/forward the update only if it is REGISTERED
     """
-    updated = db.update_citation(app, citation_change)
-    metadata = db.get_citation_target_metadata(app, citation_change.content)
-    parsed_metadata = metadata.get('parsed', {})
-    citation_target_bibcode = parsed_metadata.get('bibcode', None)
-    status = metadata.get('status', 'DISCARDED')
-    # Emit/forward the update only if status is "REGISTERED"
-    if updated and status == 'REGISTERED':
-        if citation_change.content_type == adsmsg.CitationChangeContentType.doi:
-            # Get citations from the database and transform the stored bibcodes into their canonical ones as registered in Solr.
-            original_citations = db.get_citations_by_bibcode(app, citation_target_bibcode)
-            citations = api.get_canonical_bibcodes(app, original_citations)
-            logger.debug("Calling 'task_output_results' with '%s'", citation_change)
-            task_output_results.delay(citation_change, parsed_metadata, citations)
-        logger.debug("Calling '_emit_citation_change' with '%s'", citation_change)
-        _emit_citation_change(citation_change, parsed_metadata)
+    deferred_tasks = []
+    original_citations = None
+    # All the reads and writes are committed together
+    with db.unit_of_work(app) as session:
+        updated = db.update_citation(app, citation_change, session=session)
+        metadata = db.get_citation_target_metadata(app, citation_change.content, session=session)
+        parsed_metadata = metadata.get('parsed', {})
+        citation_target_bibcode = parsed_metadata.get('bibcode', None)
+        status = metadata.get('status', 'DISCARDED')
+        # Emit/forward the update only if status is "REGISTERED"
+        if updated and status == 'REGISTERED':
+            if citation_change.content_type == adsmsg.CitationChangeContentType.doi:
+                # Get citations from the database (they are transformed into their canonical form once committed)
+                original_citations = db.get_citations_by_bibcode(app, citation_target_bibcode, session=session)
+            logger.debug("Calling '_emit_citation_change' with '%s'", citation_change)
+            _emit_citation_change(citation_change, parsed_metadata, session=session, deferred_tasks=deferred_tasks)
+    if original_citations is not None:
+        # Transform the stored bibcodes into their canonical ones as registered in Solr.
+        citations = api.get_canonical_bibcodes(app, original_citations)
+        logger.debug("Calling 'task_output_results' with '%s'", citation_change)
+        deferred_tasks.append((task_output_results, (citation_change, parsed_metadata, citations), {}))
+    _delay_tasks(deferred_tasks)
 
 @app.task(queue='process-deleted-citation')
 def task_process_deleted_citation(citation_change, force=False):
     """
     Mark a citation as deleted
     """
-    marked_as_deleted, previous_status = db.mark_citation_as_deleted(app, citation_change)
-    metadata = db.get_citation_target_metadata(app, citation_change.content)
-    parsed_metadata = metadata.get('parsed', {})
-    citation_target_bibcode = parsed_metadata.get('bibcode', None)
-    # Emit/forward the update only if the previous status was "REGISTERED"
-    if marked_as_deleted and previous_status == 'REGISTERED':
-        if citation_change.content_type == adsmsg.CitationChangeContentType.doi:
-            # Get citations from the database and transform the stored bibcodes into their canonical ones as registered in Solr.
-            original_citations = db.get_citations_by_bibcode(app, citation_target_bibcode)
-            citations = api.get_canonical_bibcodes(app, original_citations)
-            logger.debug("Calling 'task_output_results' with '%s'", citation_change)
-            task_output_results.delay(citation_change, parsed_metadata, citations)
-        logger.debug("Calling '_emit_citation_change' with '%s'", citation_change)
-        _emit_citation_change(citation_change, parsed_metadata)
+    deferred_tasks = []
+    original_citations = None
+    # All the reads and writes are committed together
+    with db.unit_of_work(app) as session:
+        marked_as_deleted, previous_status = db.mark_citation_as_deleted(app, citation_change, session=session)
+        metadata = db.get_citation_target_metadata(app, citation_change.content, session=session)
+        parsed_metadata = metadata.get('parsed', {})
+        citation_target_bibcode = parsed_metadata.get('bibcode', None)
+        # Emit/forward the update only if the previous status was "REGISTERED"
+        if marked_as_deleted and previous_status == 'REGISTERED':
+            if citation_change.content_type == adsmsg.CitationChangeContentType.doi:
+                # Get citations from the database (they are transformed into their canonical form once committed)
+                original_citations = db.get_citations_by_bibcode(app, citation_target_bibcode, session=session)
+            logger.debug("Calling '_emit_citation_change' with '%s'", citation_change)
+            _emit_citation_change(citation_change, parsed_metadata, session=session, deferred_tasks=deferred_tasks)
+    if original_citations is not None:
+        # Transform the stored bibcodes into their canonical ones as registered in Solr.
+        citations = api.get_canonical_bibcodes(app, original_citations)
+        logger.debug("Calling 'task_output_results' with '%s'", citation_change)
+        deferred_tasks.append((task_output_results, (citation_change, parsed_metadata, citations), {}))
+    _delay_tasks(deferred_tasks)
+
+def _get_citation_target_metadata(citation_change, session):
+    """
+    Return the stored metadata of the citation target (empty dict if it is not
+    stored yet). Unseen DOIs are locked before checking again if they were
+    stored, so that only one of the workers that process new citations to the
+    same DOI stores it (the lock is held until the transaction is committed,
+    the metadata is fetched before the transaction starts). If the lock
+    cannot be acquired, the target is checked anyway and storing it may fail
+    if another worker stores it first (the task is then retried).
+    """
+    metadata = db.get_citation_target_metadata(app, citation_change.content, session=session)
+    if not metadata and citation_change.content_type == adsmsg.CitationChangeContentType.doi \
+        and citation_change.content not in ["", None]:
+        locked = db.lock_citation_target(app, citation_change.content, session, timeout=app.conf.get('CITATION_TARGET_LOCK_TIMEOUT', 30))
+        if not locked:
+            logger.warning("Citation target '%s' is still locked by another worker, it will be checked without the lock", citation_change.content)
+        metadata = db.get_citation_target_metadata(app, citation_change.content, session=session)
+    return metadata
+
+def _fetch_citation_target_metadata(citation_change):
+    """
+    Fetch and parse DOI metadata, return the raw and parsed metadata together
+    with the status of the citation target ("REGISTERED" if it is a software
+    record)
+    """
+    status = "DISCARDED"
+    parsed_metadata = {}
+    # Fetch DOI metadata (if HTTP request fails, an exception is raised
+    # and the task will be re-queued (see app.py and adsputils))
+    raw_metadata = doi.fetch_metadata(app.conf['DOI_URL'], app.conf['DATACITE_URL'], citation_change.content)
+    if raw_metadata:
+        parsed_metadata = doi.parse_metadata(raw_metadata)
+        is_software = parsed_metadata.get('doctype', '').lower() == "software"
+        if parsed_metadata.get('bibcode') not in (None, "") and is_software:
+            status = "REGISTERED"
+    return raw_metadata, parsed_metadata, status
+
+def _delay_tasks(deferred_tasks):
+    """
+    Send tasks that depend on database changes once they have been committed
+    (list of tuples with task, args and kwargs)
+    """
+    for task, args, kwargs in deferred_tasks:
+        task.delay(*args, **kwargs)
 
 def _protobuf_to_adsmsg_citation_change(pure_protobuf):
     """
@@ -196,29 +312,158 @@ def task_process_citation_changes(citation_changes, force=False):
         citation_change = _protobuf_to_adsmsg_citation_change(citation_change)
         # Check: Is this citation already stored in the DB?
         citation_in_db = db.citation_already_exists(app, citation_change)
+        if not _is_expected_citation_change(citation_change, citation_in_db):
+            continue
 
         if citation_change.status == adsmsg.Status.new:
-            if citation_in_db:
-                logger.error("Ignoring new citation (citting '%s', content '%s' and timestamp '%s') because it already exists in the database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
-            else:
-                logger.debug("Calling 'task_process_new_citation' with '%s'", citation_change)
-                task_process_new_citation.delay(citation_change, force=force)
+            logger.debug("Calling 'task_process_new_citation' with '%s'", citation_change)
+            task_process_new_citation.delay(citation_change, force=force)
         elif citation_change.status == adsmsg.Status.updated:
-            if not citation_in_db:
-                logger.error("Ignoring updated citation (citting '%s', content '%s' and timestamp '%s') because it does not exist in the database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
-            else:
-                logger.debug("Calling 'task_process_updated_citation' with '%s'", citation_change)
-                task_process_updated_citation.delay(citation_change, force=force)
+            logger.debug("Calling 'task_process_updated_citation' with '%s'", citation_change)
+            task_process_updated_citation.delay(citation_change, force=force)
         elif citation_change.status == adsmsg.Status.deleted:
-            if not citation_in_db:
-                logger.error("Ignoring deleted citation (citting '%s', content '%s' and timestamp '%s') because it does not exist in the database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
-            else:
-                logger.debug("Calling 'task_process_deleted_citation' with '%s'", citation_change)
-                task_process_deleted_citation.delay(citation_change)
+            logger.debug("Calling 'task_process_deleted_citation' with '%s'", citation_change)
+            task_process_deleted_citation.delay(citation_change)
 
-def _emit_citation_change(citation_change, parsed_metadata):
+def _is_expected_citation_change(citation_change, citation_in_db):
+    """
+    New citations should not exist in the database yet, while updated and
+    deleted citations should already exist
+    """
+    if citation_change.status == adsmsg.Status.new and citation_in_db:
+        logger.error("Ignoring new citation (citting '%s', content '%s' and timestamp '%s') because it already exists in the database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
+        return False
+    elif citation_change.status == adsmsg.Status.updated and not citation_in_db:
+        logger.error("Ignoring updated citation (citting '%s', content '%s' and timestamp '%s') because it does not exist in the database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
+        return False
+    elif citation_change.status == adsmsg.Status.deleted and not citation_in_db:
+        logger.error("Ignoring deleted citation (citting '%s', content '%s' and timestamp '%s') because it does not exist in the database", citation_change.citing, citation_change.content, citation_change.timestamp.ToJsonString())
+        return False
+    return True
+
+@app.task(queue='process-citation-target-changes')
+def task_process_citation_target_changes(citation_changes, force=False):
+    """
+    Process all the citation changes of the same citation target (i.e., as
+    grouped by DeltaComputation with `group_by_content`):
+    - Retrieve metadata from doi.org only once
+    - Store new citations in bulk
+    - Forward only one record with the final list of citations
+    """
+    logger.debug('Checking content: %s', citation_changes)
+    if len(citation_changes.changes) == 0:
+        return
+    first_citation_change = _protobuf_to_adsmsg_citation_change(citation_changes.changes[0])
+    if first_citation_change.content_type != adsmsg.CitationChangeContentType.doi \
+        or first_citation_change.content in ["", None]:
+        # Only DOI citation targets are stored in the database, the rest is processed change by change
+        logger.debug("Calling 'task_process_citation_changes' with '%s'", citation_changes)
+        task_process_citation_changes.delay(citation_changes, force=force)
+        return
+
+    deferred_tasks = []
+    forwarded_citation_change = None
+    # External requests are sent before the transaction starts, so that no
+    # database connection or lock is held while waiting for them
+    target_citation_changes = [_protobuf_to_adsmsg_citation_change(citation_change) for citation_change in citation_changes.changes]
+    new_citing_bibcodes = [citation_change.citing for citation_change in target_citation_changes if citation_change.status == adsmsg.Status.new]
+    canonical_bibcodes_mapping = api.get_canonical_bibcodes_mapping(app, new_citing_bibcodes)
+    fetched_metadata = None
+    if new_citing_bibcodes and not db.get_citation_target_metadata(app, first_citation_change.content):
+        fetched_metadata = _fetch_citation_target_metadata(first_citation_change)
+
+    # All the reads and writes are committed together
+    with db.unit_of_work(app) as session:
+        new_citation_changes = []
+        updated_citation_changes = []
+        deleted_citation_changes = []
+        for citation_change in target_citation_changes:
+            citation_in_db = db.citation_already_exists(app, citation_change, session=session)
+            if not _is_expected_citation_change(citation_change, citation_in_db):
+                continue
+            if citation_change.status == adsmsg.Status.new:
+                new_citation_changes.append(citation_change)
+            elif citation_change.status == adsmsg.Status.updated:
+                updated_citation_changes.append(citation_change)
+            elif citation_change.status == adsmsg.Status.deleted:
+                deleted_citation_changes.append(citation_change)
+
+        for citation_change in list(new_citation_changes):
+            if canonical_bibcodes_mapping.get(citation_change.citing) is None:
+                logger.error("The citing bibcode '%s' is not in the system yet, it will be skipped in this ingestion", citation_change.citing)
+                new_citation_changes.remove(citation_change)
+
+        metadata = _get_citation_target_metadata(first_citation_change, session)
+        if metadata:
+            parsed_metadata = metadata.get('parsed', {})
+            status = metadata.get('status', 'DISCARDED') # "REGISTERED" if it is a software record
+        elif new_citation_changes:
+            if fetched_metadata is None:
+                # Citation targets are never deleted, this only happens if
+                # the database was modified by hand
+                fetched_metadata = _fetch_citation_target_metadata(first_citation_change)
+            raw_metadata, parsed_metadata, status = fetched_metadata
+            # Create citation target in the DB
+            db.store_citation_target(app, new_citation_changes[0], "DOI", raw_metadata, parsed_metadata, status, session=session)
+        else:
+            parsed_metadata = {}
+            status = 'DISCARDED'
+
+        # Apply the changes
+        stored_citations = set(db.store_citations(app, new_citation_changes, status, session=session))
+        new_citation_changes = [citation_change for citation_change in new_citation_changes if (citation_change.citing, citation_change.content) in stored_citations]
+        updated_citation_changes = [citation_change for citation_change in updated_citation_changes if db.update_citation(app, citation_change, session=session)]
+        registered_deleted_citation_changes = []
+        for citation_change in deleted_citation_changes:
+            marked_as_deleted, previous_status = db.mark_citation_as_deleted(app, citation_change, session=session)
+            # Emit/forward the deletion only if the previous status was "REGISTERED"
+            if marked_as_deleted and previous_status == 'REGISTERED':
+                registered_deleted_citation_changes.append(citation_change)
+
+        # Emit events for every change but forward only one record
+        emitted_citation_changes = []
+        if status == "REGISTERED":
+            citation_target_bibcode = parsed_metadata.get('bibcode')
+            for citation_change in new_citation_changes:
+                canonical_citing_bibcode = canonical_bibcodes_mapping[citation_change.citing]
+                if canonical_citing_bibcode != citation_change.citing:
+                    # These two bibcodes are identical and we can signal the broker
+                    event_data = webhook.identical_bibcodes_event_data(citation_change.citing, canonical_citing_bibcode)
+                    if event_data:
+                        dump_prefix = citation_change.timestamp.ToDatetime().strftime("%Y%m%d_%H%M%S")
+                        logger.debug("Calling '_store_event' for '%s' IsIdenticalTo '%s'", citation_change.citing, canonical_citing_bibcode)
+                        _store_event(event_data, dump_prefix, session=session, deferred_tasks=deferred_tasks)
+            if new_citation_changes:
+                # The new bibcode and the DOI are identical
+                event_data = webhook.identical_bibcode_and_doi_event_data(citation_target_bibcode, first_citation_change.content)
+                if event_data:
+                    dump_prefix = new_citation_changes[0].timestamp.ToDatetime().strftime("%Y%m%d_%H%M%S")
+                    logger.debug("Calling '_store_event' for '%s' IsIdenticalTo '%s'", citation_target_bibcode, first_citation_change.content)
+                    _store_event(event_data, dump_prefix, session=session, deferred_tasks=deferred_tasks)
+            emitted_citation_changes = new_citation_changes + updated_citation_changes
+        emitted_citation_changes += registered_deleted_citation_changes
+        for citation_change in emitted_citation_changes:
+            logger.debug("Calling '_emit_citation_change' with '%s'", citation_change)
+            _emit_citation_change(citation_change, parsed_metadata, session=session, deferred_tasks=deferred_tasks)
+
+        if emitted_citation_changes:
+            # Forward the record with the final list of citations (the last new or
+            # updated citation change defines its status, deletions are only used
+            # if there was nothing else)
+            # (they are transformed into their canonical form once committed)
+            citation_target_bibcode = parsed_metadata.get('bibcode', None)
+            original_citations = db.get_citations_by_bibcode(app, citation_target_bibcode, session=session)
+            forwarded_citation_change = (new_citation_changes + updated_citation_changes or registered_deleted_citation_changes)[-1]
+    if forwarded_citation_change is not None:
+        citations = api.get_canonical_bibcodes(app, original_citations)
+        logger.debug("Calling 'task_output_results' with '%s'", forwarded_citation_change)
+        deferred_tasks.append((task_output_results, (forwarded_citation_change, parsed_metadata, citations), {}))
+    _delay_tasks(deferred_tasks)
+
+def _emit_citation_change(citation_change, parsed_metadata, session=None, deferred_tasks=None):
     """
     Emit citation change event if the target is a software record
+    (see `_store_event` for `session` and `deferred_tasks`)
     """
     is_link_alive = parsed_metadata and parsed_metadata.get("link_alive", False)
     is_software = parsed_metadata and parsed_metadata.get("doctype", "").lower() == "software"
@@ -226,241 +471,514 @@ def _emit_citation_change(citation_change, parsed_metadata):
         event_data = webhook.citation_change_to_event_data(citation_change)
         if event_data:
             dump_prefix = citation_change.timestamp.ToDatetime().strftime("%Y%m%d_%H%M%S")
-            logger.debug("Calling 'task_emit_event' for '%s'", citation_change)
-            task_emit_event.delay(event_data, dump_prefix)
+            logger.debug("Calling '_store_event' for '%s'", citation_change)
+            _store_event(event_data, dump_prefix, session=session, deferred_tasks=deferred_tasks)
 
+def _store_event(event_data, dump_prefix, session=None, deferred_tasks=None):
+    """
+    Store the event in the outbox (in the transaction of `session` if
+    specified, otherwise in its own transaction) and request the sender to emit it (once the transaction is
+    committed if the sender task is appended to `deferred_tasks`). Relations
+    that are emitted only once (e.g., IsIdenticalTo) are skipped if they were
+    already stored.
+    """
+    if session is None:
+        # The relation cannot be registered as emitted without its event
+        delay_tasks = deferred_tasks is None
+        if delay_tasks:
+            deferred_tasks = []
+        with db.unit_of_work(app) as session:
+            _store_event(event_data, dump_prefix, session=session, deferred_tasks=deferred_tasks)
+        if delay_tasks:
+            _delay_tasks(deferred_tasks)
+        return
+    relationship = event_data.get("RelationshipType", {}).get("SubType", None)
+    if relationship in app.conf.get('EMIT_ONCE_RELATIONSHIPS', ['IsIdenticalTo']):
+        source_id = event_data.get("Source", {}).get("Identifier", {}).get("ID", None)
+        target_id = event_data.get("Target", {}).get("Identifier", {}).get("ID", None)
+        if not db.register_emitted_relation(app, relationship, source_id, target_id, session=session):
+            logger.debug("Skipping event already emitted (relationship '%s', source '%s' and target '%s')", relationship, source_id, target_id)
+            return
+    db.store_event(app, event_data, dump_prefix=dump_prefix, session=session)
+    if deferred_tasks is None:
+        task_send_events.delay()
+    elif (task_send_events, (), {}) not in deferred_tasks:
+        deferred_tasks.append((task_send_events, (), {}))
 
 @app.task(queue='process-emit-event')
 def task_emit_event(event_data, dump_prefix):
     """
-    Emit event
+    Emit event (kept for the messages queued before events were stored in
+    the outbox)
+    """
+    _store_event(event_data, dump_prefix)
+
+@app.task(queue='send-events')
+def task_send_events():
+    """
+    Send the pending events of the outbox to the broker in batches, events
+    that cannot be sent stay pending until they reach the maximum number of
+    attempts and the sender is queued again to retry them (with exponential
+    backoff). Several senders can run concurrently since every one of them
+    skips the events locked by the others.
+    """
+    batch_size = app.conf.get('EMIT_EVENT_BATCH_SIZE', 100)
+    max_attempts = app.conf.get('EMIT_EVENT_MAX_ATTEMPTS', 5)
+    after_id = 0
+    n_sent, n_failed = 0, 0
+    retry_attempts = None
+    while True:
+        # Events are locked until their status is committed
+        with db.unit_of_work(app) as session:
+            events = db.get_pending_events(app, session, after_id=after_id, limit=batch_size)
+            if not events:
+                break
+            after_id = events[-1]['id']
+            if app.conf['TESTING_MODE']:
+                failed_event_keys = set()
+            else:
+                # Events are identified by their primary key
+                failed_event_keys = set(webhook.emit_events(app.conf['ADS_WEBHOOK_URL'], app.conf['ADS_WEBHOOK_AUTH_TOKEN'], [((event['id'], event['created']), event['data']) for event in events]))
+            sent_events = [event for event in events if (event['id'], event['created']) not in failed_event_keys]
+            failed_events = [event for event in events if (event['id'], event['created']) in failed_event_keys]
+            db.mark_events_as_sent(app, [event['id'] for event in sent_events], session)
+            db.mark_events_as_failed(app, [event['id'] for event in failed_events], max_attempts, session)
+        for event in sent_events:
+            _dump_event(event['data'], event['dump_prefix'])
+        for event in failed_events:
+            if event['attempts'] + 1 >= max_attempts:
+                logger.error("Event '%i' could not be sent after '%i' attempts and it was marked as failed", event['id'], event['attempts'] + 1)
+            else:
+                logger.warning("Event '%i' could not be sent (attempt '%i' out of '%i')", event['id'], event['attempts'] + 1, max_attempts)
+                retry_attempts = min(retry_attempts or max_attempts, event['attempts'] + 1)
+        n_sent += len(sent_events)
+        n_failed += len(failed_events)
+    if n_sent or n_failed:
+        logger.info("Sent '%i' events ('%i' could not be sent)", n_sent, n_failed)
+    if retry_attempts is not None:
+        countdown = app.conf.get('EMIT_EVENT_RETRY_DELAY', 60) * 2 ** (retry_attempts - 1)
+        logger.info("Events that could not be sent will be sent again in '%i' seconds", countdown)
+        task_send_events.apply_async(countdown=countdown)
+
+def _dump_event(event_data, dump_prefix=None):
+    """
+    Dump a sent event (or emulated in testing mode) in the event archive,
+    under the day of the change that produced it (`dump_prefix`) if known
     """
-    emitted = False
     relationship = event_data.get("RelationshipType", {}).get("SubType", None)
     source_id = event_data.get("Source", {}).get("Identifier", {}).get("ID", None)
     target_id = event_data.get("Target", {}).get("Identifier", {}).get("ID", None)
 
     if not app.conf['TESTING_MODE']:
-        prefix = os.path.join("emitted", relationship)
-        emitted = webhook.emit_event(app.conf['ADS_WEBHOOK_URL'], app.conf['ADS_WEBHOOK_AUTH_TOKEN'], event_data)
-    else:
-        prefix = os.path.join("emulated", relationship)
-        emitted = True
-    if isinstance(dump_prefix, str):
-        prefix = os.path.join(prefix, dump_prefix)
-    webhook.dump_event(event_data, prefix=prefix)
-    stored = db.store_event(app, event_data)
-
-    if app.conf['TESTING_MODE'] and emitted:
-        logger.debug("Emulated emission of event due to 'testing mode' (relationship '%s', source '%s' and target '%s')", relationship, source_id, target_id)
-    elif emitted:
+        prefix = "emitted"
         logger.debug("Emitted event (relationship '%s', source '%s' and target '%s')", relationship, source_id, target_id)
     else:
-        logger.debug("Non-emitted event (relationship '%s', source '%s' and target '%s')", relationship, source_id, target_id)
+        prefix = "emulated"
+        logger.debug("Emulated emission of event due to 'testing mode' (relationship '%s', source '%s' and target '%s')", relationship, source_id, target_id)
+    day = dump_prefix.split("_")[0] if isinstance(dump_prefix, str) else None
+    webhook.dump_event(event_data, prefix=prefix, day=day)
 
 def _remove_duplicated_dict_in_list(l):
     return [x for x in l if x['content'] in set([r['content'] for r in l])]
 
-@app.task(queue='maintenance_canonical')
-def task_maintenance_canonical(dois, bibcodes):
+def _get_citation_targets(dois, bibcodes, only_status='REGISTERED', not_found=None):
     """
-    Maintenance operation:
-    - Get all the registered citation targets (or only a subset of them if DOIs and/or bibcodes are specified)
-    - For each, get their citations bibcodes and transform them to their canonical form
-    - Send to master an update with the new list of citations canonical bibcodes
+    Return the requested citation targets with a given status or, if no DOIs
+    nor bibcodes are specified, a generator that lazily streams all of them
+    from the database. Bibcodes that do not match any citation target are
+    appended to `not_found` if it is specified.
     """
-
     n_requested = len(dois) + len(bibcodes)
     if n_requested == 0:
-        registered_records = db.get_citation_targets(app, only_status='REGISTERED')
-    else:
-        registered_records = db.get_citation_targets_by_bibcode(app, bibcodes, only_status='REGISTERED')
-        registered_records += db.get_citation_targets_by_doi(app, dois, only_status='REGISTERED')
-        registered_records = _remove_duplicated_dict_in_list(registered_records)
+        return db.iter_citation_targets(app, only_status=only_status)
+    records = db.get_citation_targets_by_bibcode(app, bibcodes, only_status=only_status, not_found=not_found)
+    records += db.get_citation_targets_by_doi(app, dois, only_status=only_status)
+    return _remove_duplicated_dict_in_list(records)
 
-    for registered_record in registered_records:
-        try:
-            # Get citations from the database and transform the stored bibcodes into their canonical ones as registered in Solr.
-            original_citations = db.get_citations_by_bibcode(app, registered_record['bibcode'])
-            existing_citation_bibcodes = api.get_canonical_bibcodes(app, original_citations)
-        except:
-            logger.exception("Failed API request to retreive existing citations for bibcode '{}'".format(registered_record['bibcode']))
-            continue
-        custom_citation_change = adsmsg.CitationChange(content=registered_record['content'],
+def _canonical_citations(citations, canonical_bibcodes_mapping):
+    """
+    Transform citations into their canonical form (the ones that do not exist
+    are removed) using a mapping from bibcodes to canonical bibcodes
+    """
+    canonical_citations = []
+    seen = set()
+    for citation in citations:
+        canonical_citation = canonical_bibcodes_mapping.get(citation)
+        if canonical_citation is not None and canonical_citation not in seen:
+            seen.add(canonical_citation)
+            canonical_citations.append(canonical_citation)
+    return canonical_citations
+
+def _maintenance_canonical(registered_record, citations_by_content, canonical_bibcodes_mapping, force=False):
+    """
+    Send to master an update with the new list of citations canonical bibcodes
+    """
+    original_citations = citations_by_content.get(registered_record['content'], [])
+    existing_citation_bibcodes = _canonical_citations(original_citations, canonical_bibcodes_mapping)
+    custom_citation_change = adsmsg.CitationChange(content=registered_record['content'],
+                                                   content_type=getattr(adsmsg.CitationChangeContentType, registered_record['content_type'].lower()),
+                                                   status=adsmsg.Status.updated,
+                                                   timestamp=datetime.now()
+                                                   )
+    parsed_metadata = db.get_citation_target_metadata(app, custom_citation_change.content).get('parsed', {})
+    if parsed_metadata:
+        logger.debug("Calling 'task_output_results' with '%s'", custom_citation_change)
+        task_output_results.delay(custom_citation_change, parsed_metadata, existing_citation_bibcodes, force=force)
+        return True
+    return False
+
+def _maintenance_metadata(registered_record, force=False):
+    """
+    Retreive metadata and if it is different to what we have in our database:
+    - Get the citations bibcodes and transform them to their canonical form
+    - Send to master an update with the new metadata and the current list of citations canonical bibcodes
+    """
+    updated = False
+    bibcode_replaced = {}
+    # Fetch DOI metadata (if HTTP request fails, an exception is raised
+    # and the target will be counted as failed in the maintenance run)
+    raw_metadata = doi.fetch_metadata(app.conf['DOI_URL'], app.conf['DATACITE_URL'], registered_record['content'])
+    if raw_metadata:
+        parsed_metadata = doi.parse_metadata(raw_metadata)
+        is_software = parsed_metadata.get('doctype', '').lower() == "software"
+        if not is_software:
+            logger.error("The new metadata for '%s' has changed its 'doctype' and it is not 'software' anymore", registered_record['bibcode'])
+        elif parsed_metadata.get('bibcode') in (None, ""):
+            logger.error("The new metadata for '%s' affected the metadata parser and it did not correctly compute a bibcode", registered_record['bibcode'])
+        else:
+            # Detect concept DOIs: they have one or more versions of the software
+            # and they are not a version of something else
+            concept_doi = len(parsed_metadata.get('version_of', [])) == 0 and len(parsed_metadata.get('versions', [])) >= 1
+            different_bibcodes = registered_record['bibcode'] != parsed_metadata['bibcode']
+            if concept_doi and different_bibcodes:
+                # Concept DOI publication date changes with newer software version
+                # and authors can also change (i.e., first author last name initial)
+                # but we want to respect the year in the bibcode, which corresponds
+                # to the year of the latest release when it was first ingested
+                # by ADS
+                parsed_metadata['bibcode'] = registered_record['bibcode']
+                # Temporary bugfix (some bibcodes have non-capital letter at the end):
+                parsed_metadata['bibcode'] = parsed_metadata['bibcode'][:-1] + parsed_metadata['bibcode'][-1].upper()
+                # Re-verify if bibcodes are still different (they could be if
+                # name parsing has changed):
+                different_bibcodes = registered_record['bibcode'] != parsed_metadata['bibcode']
+            if different_bibcodes:
+                # These two bibcodes are identical and we can signal the broker
+                event_data = webhook.identical_bibcodes_event_data(registered_record['bibcode'], parsed_metadata['bibcode'])
+                #
+                logger.warn("Parsing the new metadata for citation target '%s' produced a different bibcode: '%s'. The former will be moved to the 'alternate_bibcode' list, and the new one will be used as the main one.", registered_record['bibcode'], parsed_metadata.get('bibcode', None))
+                alternate_bibcode = parsed_metadata.get('alternate_bibcode', [])
+                alternate_bibcode += registered_record.get('alternate_bibcode', [])
+                if registered_record['bibcode'] not in alternate_bibcode:
+                    alternate_bibcode.append(registered_record['bibcode'])
+                parsed_metadata['alternate_bibcode'] = alternate_bibcode
+                bibcode_replaced = {'previous': registered_record['bibcode'], 'new': parsed_metadata['bibcode'] }
+            # All the reads and writes (including the event) are committed together
+            deferred_tasks = []
+            with db.unit_of_work(app) as session:
+                if different_bibcodes and event_data:
+                    dump_prefix = datetime.now().strftime("%Y%m%d") # "%Y%m%d_%H%M%S"
+                    logger.debug("Calling '_store_event' for '%s' IsIdenticalTo '%s'", registered_record['bibcode'], parsed_metadata['bibcode'])
+                    _store_event(event_data, dump_prefix, session=session, deferred_tasks=deferred_tasks)
+                updated = db.update_citation_target_metadata(app, registered_record['content'], raw_metadata, parsed_metadata, session=session)
+                if updated:
+                    # Get citations from the database
+                    original_citations = db.get_citations_by_bibcode(app, registered_record['bibcode'], session=session)
+            _delay_tasks(deferred_tasks)
+    if updated:
+        citation_change = adsmsg.CitationChange(content=registered_record['content'],
                                                        content_type=getattr(adsmsg.CitationChangeContentType, registered_record['content_type'].lower()),
                                                        status=adsmsg.Status.updated,
                                                        timestamp=datetime.now()
                                                        )
-        parsed_metadata = db.get_citation_target_metadata(app, custom_citation_change.content).get('parsed', {})
-        if parsed_metadata:
-            logger.debug("Calling 'task_output_results' with '%s'", custom_citation_change)
-            task_output_results.delay(custom_citation_change, parsed_metadata, existing_citation_bibcodes)
+        if citation_change.content_type == adsmsg.CitationChangeContentType.doi:
+            # Transform the stored bibcodes into their canonical ones as registered in Solr.
+            citations = api.get_canonical_bibcodes(app, original_citations)
+            logger.debug("Calling 'task_output_results' with '%s'", citation_change)
+            task_output_results.delay(citation_change, parsed_metadata, citations, bibcode_replaced=bibcode_replaced, force=force)
+    return updated
+
+def _maintenance_resend(registered_record, force=False):
+    """
+    Re-send to master an update with the current metadata and the current list of citations canonical bibcodes
+    """
+    citations = db.get_citations_by_bibcode(app, registered_record['bibcode'])
+    custom_citation_change = adsmsg.CitationChange(content=registered_record['content'],
+                                                   content_type=getattr(adsmsg.CitationChangeContentType, registered_record['content_type'].lower()),
+                                                   status=adsmsg.Status.updated,
+                                                   timestamp=datetime.now()
+                                                   )
+    parsed_metadata = db.get_citation_target_metadata(app, custom_citation_change.content).get('parsed', {})
+    if parsed_metadata:
+        logger.debug("Calling 'task_output_results' with '%s'", custom_citation_change)
+        task_output_results.delay(custom_citation_change, parsed_metadata, citations, force=force)
+        return True
+    return False
+
+def _maintenance_reevaluate(previously_discarded_record, force=False):
+    """
+    Retreive metadata of a discarded citation target and if it is now a software record:
+    - Register it together with its citations
+    - Get the citations bibcodes and transform them to their canonical form
+    - Send to master the new record with the current list of citations canonical bibcodes
+    """
+    updated = False
+    bibcode_replaced = {}
+    # Fetch DOI metadata (if HTTP request fails, an exception is raised
+    # and the target will be counted as failed in the maintenance run)
+    raw_metadata = doi.fetch_metadata(app.conf['DOI_URL'], app.conf['DATACITE_URL'], previously_discarded_record['content'])
+    if raw_metadata:
+        parsed_metadata = doi.parse_metadata(raw_metadata)
+        is_software = parsed_metadata.get('doctype', '').lower() == "software"
+        if not is_software:
+            logger.error("Discarded '%s', it is not 'software'", previously_discarded_record['content'])
+        elif parsed_metadata.get('bibcode') in (None, ""):
+            logger.error("The metadata for '%s' could not be parsed correctly and it did not correctly compute a bibcode", previously_discarded_record['content'])
+        else:
+            # Register the citation target and its citations in the DB (committed together)
+            with db.unit_of_work(app) as session:
+                updated = db.update_citation_target_metadata(app, previously_discarded_record['content'], raw_metadata, parsed_metadata, status='REGISTERED', session=session)
+                if updated:
+                    # Citations to discarded targets were stored as discarded too, hence
+                    # these are all the citations (except deleted ones)
+                    original_citations = db.mark_all_discarded_citations_as_registered(app, previously_discarded_record['content'], session=session)
+    if updated:
+        citation_change = adsmsg.CitationChange(content=previously_discarded_record['content'],
+                                                       content_type=getattr(adsmsg.CitationChangeContentType, previously_discarded_record['content_type'].lower()),
+                                                       status=adsmsg.Status.new,
+                                                       timestamp=datetime.now()
+                                                       )
+        if citation_change.content_type == adsmsg.CitationChangeContentType.doi:
+            # Transform the stored bibcodes into their canonical ones as registered in Solr.
+            citations = api.get_canonical_bibcodes(app, original_citations)
+            logger.debug("Calling 'task_output_results' with '%s'", citation_change)
+            task_output_results.delay(citation_change, parsed_metadata, citations, bibcode_replaced=bibcode_replaced, force=force)
+    return updated
+
+# Status of the citation targets processed by each maintenance task
+_maintenance_target_status = {
+    'canonical': 'REGISTERED',
+    'metadata': 'REGISTERED',
+    'resend': 'REGISTERED',
+    'reevaluate': 'DISCARDED',
+}
+
+def _start_maintenance_run(task, dois, bibcodes, force=False):
+    """
+    Register a maintenance run and split its citation targets in chunks that
+    are processed by independent subtasks
+    """
+    run_id = db.create_maintenance_run(app, task, {'dois': list(dois), 'bibcodes': list(bibcodes), 'force': force})
+    logger.info("Started maintenance run '%s' (%s)", run_id, task)
+    _dispatch_maintenance_run(run_id)
+    return run_id
+
+def _dispatch_maintenance_run(run_id):
+    """
+    Register the chunks of citation targets of a maintenance run (only the
+    targets that were not registered yet, if it was interrupted while
+    dispatching) and send the pending chunks to the workers
+    """
+    maintenance_run = db.get_maintenance_run(app, run_id)
+    if not maintenance_run:
+        logger.error("Maintenance run '%s' does not exist", run_id)
+        return
+    if maintenance_run['status'] == 'DISPATCHING':
+        arguments = maintenance_run['arguments']
+        chunk_size = app.conf.get('MAINTENANCE_CHUNK_SIZE', 100)
+        chunked_contents = db.get_maintenance_run_contents(app, run_id)
+        contents_chunk = []
+        not_found = []
+        for record in _get_citation_targets(arguments.get('dois', []), arguments.get('bibcodes', []), only_status=_maintenance_target_status[maintenance_run['task']], not_found=not_found):
+            if record['content'] in chunked_contents:
+                continue
+            chunked_contents.add(record['content'])
+            contents_chunk.append(record['content'])
+            if len(contents_chunk) >= chunk_size:
+                db.store_maintenance_run_chunk(app, run_id, contents_chunk)
+                contents_chunk = []
+        if contents_chunk:
+            db.store_maintenance_run_chunk(app, run_id, contents_chunk)
+        if not_found:
+            logger.warning("Maintenance run '%s' (%s): citation targets with status '%s' not found for '%i' requested bibcodes: %s", run_id, maintenance_run['task'], _maintenance_target_status[maintenance_run['task']], len(not_found), " ".join(not_found))
+        if maintenance_run['task'] == 'canonical':
+            _refresh_canonical_bibcodes(chunked_contents)
+        db.mark_maintenance_run_as_dispatched(app, run_id)
+    chunk_ids = db.get_pending_maintenance_run_chunk_ids(app, run_id)
+    logger.info("Dispatching '%i' pending chunks of maintenance run '%s' (%s)", len(chunk_ids), run_id, maintenance_run['task'])
+    for chunk_id in chunk_ids:
+        task_maintenance_chunk.delay(run_id, chunk_id)
+
+def _refresh_canonical_bibcodes(contents):
+    """
+    Request the canonical form of the citations of all the citation targets
+    of a maintenance run in one bulk pass, the chunks read them from the
+    database cache instead of requesting them to the API one chunk at a time
+    """
+    citations_by_content = db.get_citations_by_content(app, contents=contents)
+    # Each citing bibcode is transformed only once even if it cites multiple targets
+    citing_bibcodes = list(set(itertools.chain.from_iterable(citations_by_content.values())))
+    try:
+        # Ignore cached canonical bibcodes, this refreshes the cache with the current ones
+        api.get_canonical_bibcodes_mapping(app, citing_bibcodes, refresh=True, n_workers=app.conf.get('CANONICAL_BIBCODE_PARALLEL_REQUESTS', 4))
+    except:
+        logger.exception("Failed API request to retreive canonical bibcodes for '{}' citations".format(len(citing_bibcodes)))
+        raise
+    logger.info("Retrieved canonical bibcodes for '%i' citations of '%i' citation targets", len(citing_bibcodes), len(citations_by_content))
+
+@app.task(queue='maintenance_chunk')
+def task_maintenance_chunk(run_id, chunk_id):
+    """
+    Maintenance operation on a chunk of citation targets of a maintenance run,
+    targets are counted as done, failed or skipped (e.g., they no longer have
+    the expected status or there was nothing to update)
+    """
+    maintenance_run = db.get_maintenance_run(app, run_id)
+    maintenance_run_chunk = db.get_maintenance_run_chunk(app, chunk_id)
+    if not maintenance_run or not maintenance_run_chunk:
+        logger.error("Maintenance run '%s' chunk '%s' does not exist", run_id, chunk_id)
+        return
+    if maintenance_run_chunk['status'] == 'DONE':
+        logger.info("Ignoring maintenance run '%s' chunk '%s' because it was already done", run_id, chunk_id)
+        return
+    task = maintenance_run['task']
+    force = maintenance_run['arguments'].get('force', False)
+    contents = maintenance_run_chunk['contents']
+    records = db.get_citation_targets_by_doi(app, contents, only_status=_maintenance_target_status[task])
+    n_done, n_failed = 0, 0
+    n_skipped = len(contents) - len(records)
+
+    if task == 'canonical':
+        # Get the citations bibcodes of all the targets of the chunk at once and transform them to their canonical form
+        citations_by_content = db.get_citations_by_content(app, contents=[r['content'] for r in records])
+        citing_bibcodes = list(set(itertools.chain.from_iterable(citations_by_content.values())))
+        # They were refreshed in the database cache when the run was
+        # dispatched, the in-process cache of this worker may be older
+        for bibcode in citing_bibcodes:
+            api.canonical_bibcodes_cache.pop(bibcode)
+        try:
+            canonical_bibcodes_mapping = api.get_canonical_bibcodes_mapping(app, citing_bibcodes, n_workers=app.conf.get('CANONICAL_BIBCODE_PARALLEL_REQUESTS', 4))
+        except:
+            logger.exception("Failed API request to retreive canonical bibcodes for '{}' citations".format(len(citing_bibcodes)))
+            raise
+
+    for record in records:
+        try:
+            if task == 'canonical':
+                processed = _maintenance_canonical(record, citations_by_content, canonical_bibcodes_mapping, force=force)
+            elif task == 'metadata':
+                processed = _maintenance_metadata(record, force=force)
+            elif task == 'resend':
+                processed = _maintenance_resend(record, force=force)
+            elif task == 'reevaluate':
+                processed = _maintenance_reevaluate(record, force=force)
+            else:
+                raise Exception("Unknown maintenance task: {}".format(task))
+        except:
+            logger.exception("Maintenance run '%s' (%s) failed for citation target '%s'", run_id, task, record['content'])
+            n_failed += 1
+        else:
+            if processed:
+                n_done += 1
+            else:
+                n_skipped += 1
+    db.finish_maintenance_run_chunk(app, run_id, chunk_id, n_done, n_failed, n_skipped)
+    logger.info("Maintenance run '%s' (%s) chunk '%s': '%i' done, '%i' failed and '%i' skipped citation targets", run_id, task, chunk_id, n_done, n_failed, n_skipped)
+
+@app.task(queue='maintenance_resume')
+def task_maintenance_resume(run_id):
+    """
+    Resume an interrupted maintenance run: finish registering its chunks if
+    needed and re-send its pending chunks to the workers
+    """
+    _dispatch_maintenance_run(run_id)
+
+@app.task(queue='maintenance_canonical')
+def task_maintenance_canonical(dois, bibcodes, force=False):
+    """
+    Maintenance operation:
+    - Get all the registered citation targets (or only a subset of them if DOIs and/or bibcodes are specified)
+    - Transform the citations bibcodes of all the targets to their canonical form in one bulk pass
+    - Split them in chunks processed by independent subtasks, which:
+        - Get the citations bibcodes of all the chunk targets at once and their canonical form from the cache
+        - For each target, send to master an update with the new list of citations canonical bibcodes
+    """
+    _start_maintenance_run('canonical', dois, bibcodes, force=force)
 
 @app.task(queue='maintenance_metadata')
-def task_maintenance_metadata(dois, bibcodes):
+def task_maintenance_metadata(dois, bibcodes, force=False):
     """
     Maintenance operation:
     - Get all the registered citation targets (or only a subset of them if DOIs and/or bibcodes are specified)
-    - For each, retreive metadata and if it is different to what we have in our database:
+    - Split them in chunks processed by independent subtasks, which for each target
+      retreive metadata and if it is different to what we have in our database:
         - Get the citations bibcodes and transform them to their canonical form
         - Send to master an update with the new metadata and the current list of citations canonical bibcodes
     """
-    n_requested = len(dois) + len(bibcodes)
-    if n_requested == 0:
-        registered_records = db.get_citation_targets(app, only_status='REGISTERED')
-    else:
-        registered_records = db.get_citation_targets_by_bibcode(app, bibcodes, only_status='REGISTERED')
-        registered_records += db.get_citation_targets_by_doi(app, dois, only_status='REGISTERED')
-        registered_records = _remove_duplicated_dict_in_list(registered_records)
-
-    for registered_record in registered_records:
-        updated = False
-        bibcode_replaced = {}
-        # Fetch DOI metadata (if HTTP request fails, an exception is raised
-        # and the task will be re-queued (see app.py and adsputils))
-        raw_metadata = doi.fetch_metadata(app.conf['DOI_URL'], app.conf['DATACITE_URL'], registered_record['content'])
-        if raw_metadata:
-            parsed_metadata = doi.parse_metadata(raw_metadata)
-            is_software = parsed_metadata.get('doctype', '').lower() == "software"
-            if not is_software:
-                logger.error("The new metadata for '%s' has changed its 'doctype' and it is not 'software' anymore", registered_record['bibcode'])
-            elif parsed_metadata.get('bibcode') in (None, ""):
-                logger.error("The new metadata for '%s' affected the metadata parser and it did not correctly compute a bibcode", registered_record['bibcode'])
-            else:
-                # Detect concept DOIs: they have one or more versions of the software
-                # and they are not a version of something else
-                concept_doi = len(parsed_metadata.get('version_of', [])) == 0 and len(parsed_metadata.get('versions', [])) >= 1
-                different_bibcodes = registered_record['bibcode'] != parsed_metadata['bibcode']
-                if concept_doi and different_bibcodes:
-                    # Concept DOI publication date changes with newer software version
-                    # and authors can also change (i.e., first author last name initial)
-                    # but we want to respect the year in the bibcode, which corresponds
-                    # to the year of the latest release when it was first ingested
-                    # by ADS
-                    parsed_metadata['bibcode'] = registered_record['bibcode']
-                    # Temporary bugfix (some bibcodes have non-capital letter at the end):
-                    parsed_metadata['bibcode'] = parsed_metadata['bibcode'][:-1] + parsed_metadata['bibcode'][-1].upper()
-                    # Re-verify if bibcodes are still different (they could be if
-                    # name parsing has changed):
-                    different_bibcodes = registered_record['bibcode'] != parsed_metadata['bibcode']
-                if different_bibcodes:
-                    # These two bibcodes are identical and we can signal the broker
-                    event_data = webhook.identical_bibcodes_event_data(registered_record['bibcode'], parsed_metadata['bibcode'])
-                    if event_data:
-                        dump_prefix = datetime.now().strftime("%Y%m%d") # "%Y%m%d_%H%M%S"
-                        logger.debug("Calling 'task_emit_event' for '%s' IsIdenticalTo '%s'", registered_record['bibcode'], parsed_metadata['bibcode'])
-                        task_emit_event.delay(event_data, dump_prefix)
-                    #
-                    logger.warn("Parsing the new metadata for citation target '%s' produced a different bibcode: '%s'. The former will be moved to the 'alternate_bibcode' list, and the new one will be used as the main one.", registered_record['bibcode'], parsed_metadata.get('bibcode', None))
-                    alternate_bibcode = parsed_metadata.get('alternate_bibcode', [])
-                    alternate_bibcode += registered_record.get('alternate_bibcode', [])
-                    if registered_record['bibcode'] not in alternate_bibcode:
-                        alternate_bibcode.append(registered_record['bibcode'])
-                    parsed_metadata['alternate_bibcode'] = alternate_bibcode
-                    bibcode_replaced = {'previous': registered_record['bibcode'], 'new': parsed_metadata['bibcode'] }
-                updated = db.update_citation_target_metadata(app, registered_record['content'], raw_metadata, parsed_metadata)
-        if updated:
-            citation_change = adsmsg.CitationChange(content=registered_record['content'],
-                                                           content_type=getattr(adsmsg.CitationChangeContentType, registered_record['content_type'].lower()),
-                                                           status=adsmsg.Status.updated,
-                                                           timestamp=datetime.now()
-                                                           )
-            if citation_change.content_type == adsmsg.CitationChangeContentType.doi:
-                # Get citations from the database and transform the stored bibcodes into their canonical ones as registered in Solr.
-                original_citations = db.get_citations_by_bibcode(app, registered_record['bibcode'])
-                citations = api.get_canonical_bibcodes(app, original_citations)
-                logger.debug("Calling 'task_output_results' with '%s'", citation_change)
-                task_output_results.delay(citation_change, parsed_metadata, citations, bibcode_replaced=bibcode_replaced)
+    _start_maintenance_run('metadata', dois, bibcodes, force=force)
 
 @app.task(queue='maintenance_resend')
-def task_maintenance_resend(dois, bibcodes):
+def task_maintenance_resend(dois, bibcodes, force=False):
     """
     Maintenance operation:
     - Get all the registered citation targets (or only a subset of them if DOIs and/or bibcodes are specified)
-    - For each:
+    - Split them in chunks processed by independent subtasks, which for each target:
         - Re-send to master an update with the current metadata and the current list of citations canonical bibcodes
     """
-    n_requested = len(dois) + len(bibcodes)
-    if n_requested == 0:
-        registered_records = db.get_citation_targets(app, only_status='REGISTERED')
-    else:
-        registered_records = db.get_citation_targets_by_bibcode(app, bibcodes, only_status='REGISTERED')
-        registered_records += db.get_citation_targets_by_doi(app, dois, only_status='REGISTERED')
-        registered_records = _remove_duplicated_dict_in_list(registered_records)
-
-    for registered_record in registered_records:
-        citations = db.get_citations_by_bibcode(app, registered_record['bibcode'])
-        custom_citation_change = adsmsg.CitationChange(content=registered_record['content'],
-                                                       content_type=getattr(adsmsg.CitationChangeContentType, registered_record['content_type'].lower()),
-                                                       status=adsmsg.Status.updated,
-                                                       timestamp=datetime.now()
-                                                       )
-        parsed_metadata = db.get_citation_target_metadata(app, custom_citation_change.content).get('parsed', {})
-        if parsed_metadata:
-            logger.debug("Calling 'task_output_results' with '%s'", custom_citation_change)
-            task_output_results.delay(custom_citation_change, parsed_metadata, citations)
+    _start_maintenance_run('resend', dois, bibcodes, force=force)
 
 @app.task(queue='maintenance_reevaluate')
-def task_maintenance_reevaluate(dois, bibcodes):
+def task_maintenance_reevaluate(dois, bibcodes, force=False):
     """
     Maintenance operation:
-    - Get all the registered citation targets (or only a subset of them if DOIs and/or bibcodes are specified)
-    - For each, retreive metadata and if it is different to what we have in our database:
+    - Get all the discarded citation targets (or only a subset of them if DOIs and/or bibcodes are specified)
+    - Split them in chunks processed by independent subtasks, which for each target
+      retreive metadata and if it is now a software record:
         - Get the citations bibcodes and transform them to their canonical form
-        - Send to master an update with the new metadata and the current list of citations canonical bibcodes
+        - Send to master the new record with the current list of citations canonical bibcodes
     """
-    n_requested = len(dois) + len(bibcodes)
-    if n_requested == 0:
-        discarded_records = db.get_citation_targets(app, only_status='DISCARDED')
-    else:
-        discarded_records = db.get_citation_targets_by_bibcode(app, bibcodes, only_status='DISCARDED')
-        discarded_records += db.get_citation_targets_by_doi(app, dois, only_status='DISCARDED')
-        discarded_records = _remove_duplicated_dict_in_list(discarded_records)
-
-    for previously_discarded_record in discarded_records:
-        updated = False
-        bibcode_replaced = {}
-        # Fetch DOI metadata (if HTTP request fails, an exception is raised
-        # and the task will be re-queued (see app.py and adsputils))
-        raw_metadata = doi.fetch_metadata(app.conf['DOI_URL'], app.conf['DATACITE_URL'], previously_discarded_record['content'])
-        if raw_metadata:
-            parsed_metadata = doi.parse_metadata(raw_metadata)
-            is_software = parsed_metadata.get('doctype', '').lower() == "software"
-            if not is_software:
-                logger.error("Discarded '%s', it is not 'software'", previously_discarded_record['content'])
-            elif parsed_metadata.get('bibcode') in (None, ""):
-                logger.error("The metadata for '%s' could not be parsed correctly and it did not correctly compute a bibcode", previously_discarded_record['content'])
-            else:
-                # Create citation target in the DB
-                updated = db.update_citation_target_metadata(app, previously_discarded_record['content'], raw_metadata, parsed_metadata, status='REGISTERED')
-                if updated:
-                    db.mark_all_discarded_citations_as_registered(app, previously_discarded_record['content'])
-        if updated:
-            citation_change = adsmsg.CitationChange(content=previously_discarded_record['content'],
-                                                           content_type=getattr(adsmsg.CitationChangeContentType, previously_discarded_record['content_type'].lower()),
-                                                           status=adsmsg.Status.new,
-                                                           timestamp=datetime.now()
-                                                           )
-            if citation_change.content_type == adsmsg.CitationChangeContentType.doi:
-                # Get citations from the database and transform the stored bibcodes into their canonical ones as registered in Solr.
-                original_citations = db.get_citations_by_bibcode(app, parsed_metadata['bibcode'])
-                citations = api.get_canonical_bibcodes(app, original_citations)
-                logger.debug("Calling 'task_output_results' with '%s'", citation_change)
-                task_output_results.delay(citation_change, parsed_metadata, citations, bibcode_replaced=bibcode_replaced)
-
-
-
+    _start_maintenance_run('reevaluate', dois, bibcodes, force=force)
 
 @app.task(queue='output-results')
-def task_output_results(citation_change, parsed_metadata, citations, bibcode_replaced={}):
+def task_output_results(citation_change, parsed_metadata, citations, bibcode_replaced={}, force=False):
     """
     This worker will forward results to the outside
     exchange (typically an ADSMasterPipeline) to be
     incorporated into the storage
 
     :param citation_change: contains citation changes
+    :param force: forward even if the records did not change since the last time they were forwarded
     :return: no return
     """
+    coalescing_window = app.conf.get('OUTPUT_COALESCING_WINDOW', 0)
+    if coalescing_window > 0:
+        # Only the latest state of the citation target is forwarded when the window expires
+        if db.store_output_request(app, citation_change, parsed_metadata, citations, bibcode_replaced=bibcode_replaced, force=force):
+            logger.debug("Calling 'task_output_coalesced_results' for '%s' in '%s' seconds", citation_change.content, coalescing_window)
+            task_output_coalesced_results.apply_async((citation_change.content,), countdown=coalescing_window)
+        else:
+            logger.debug("Coalesced output request for '%s' with the pending one", citation_change.content)
+        return
+    _output_results(citation_change, parsed_metadata, citations, bibcode_replaced=bibcode_replaced, force=force)
+
+@app.task(queue='output-results')
+def task_output_coalesced_results(content):
+    """
+    Forward the latest state of a citation target from the output requests
+    that were coalesced during the window
+    """
+    output_request = db.pop_output_request(app, content)
+    if output_request is None:
+        logger.debug("No pending output request for '%s'", content)
+        return
+    _output_results(output_request['citation_change'], output_request['parsed_metadata'], output_request['citations'],
+                    bibcode_replaced=output_request['bibcode_replaced'], force=output_request['force'])
+
+def _output_results(citation_change, parsed_metadata, citations, bibcode_replaced={}, force=False):
+    """
+    Build the records and forward them to master if they changed since the
+    last time they were forwarded (or if forced)
+    """
     entry_date = db.get_citation_target_entry_date(app, citation_change.content)
     messages = []
     if bibcode_replaced:
@@ -480,15 +998,23 @@ def task_output_results(citation_change, parsed_metadata, citations, bibcode_rep
     record, nonbib_record = forward.build_record(app, citation_change, parsed_metadata, citations, entry_date=entry_date)
     messages.append((record, nonbib_record))
 
-    for record, nonbib_record in messages:
+    if app.conf['CELERY_ALWAYS_EAGER']:
+        return
+    records = list(itertools.chain.from_iterable(messages))
+    fingerprint = forward.build_fingerprint(records)
+    if not force and fingerprint == db.get_forwarded_record_fingerprint(app, citation_change.content):
+        logger.info("Ignoring forward of citation target '%s' because its records did not change since the last time they were forwarded", citation_change.content)
+        return
+
+    for i, record in enumerate(records):
         logger.debug('Will forward this record: %s', record)
-        logger.debug("Calling 'app.forward_message' with '%s'", str(record.toJSON()))
-        if not app.conf['CELERY_ALWAYS_EAGER']:
-            app.forward_message(record)
-        logger.debug('Will forward this record: %s', nonbib_record)
-        logger.debug("Calling 'app.forward_message' with '%s'", str(nonbib_record.toJSON()))
-        if not app.conf['CELERY_ALWAYS_EAGER']:
-            app.forward_message(nonbib_record)
+        logger.debug("Buffering '%s' to be forwarded", str(record.toJSON()))
+        # The fingerprint is stored once all the records have been published
+        callback = None
+        if i == len(records) - 1:
+            content = citation_change.content
+            callback = lambda: db.store_forwarded_record_fingerprint(app, content, fingerprint)
+        output_buffer.add(record, callback=callback)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,61 @@
+import json
+import unittest
+import httpretty
+from ADSCitationCapture import api
+from ADSCitationCapture import db
+from .test_base import TestBase
+
+
+class TestWorkers(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        api.canonical_bibcodes_cache.clear()
+        httpretty.enable()  # enable HTTPretty so that it will monkey patch the socket module
+        self.bigquery_url = self.app.conf['ADS_API_URL']+"search/bigquery"
+        body = {
+            'response': {
+                'docs': [
+                    {'bibcode': '2015ApJ...815L..10L', 'identifier': ['2015ApJ...815L..10L', '2015arXiv151003579A']},
+                ]
+            }
+        }
+        httpretty.register_uri(httpretty.POST, self.bigquery_url, status=200, body=json.dumps(body), content_type="application/json")
+
+    def tearDown(self):
+        api.canonical_bibcodes_cache.clear()
+        httpretty.disable()
+        httpretty.reset()   # clean up registered urls and request history
+        TestBase.tearDown(self)
+
+    def test_get_canonical_bibcodes(self):
+        bibcodes = ['2015arXiv151003579A', '2015ApJ...815L..10L', '2019arXiv190105505T']
+        canonical_bibcodes = api.get_canonical_bibcodes(self.app, bibcodes)
+        self.assertEqual(canonical_bibcodes, ['2015ApJ...815L..10L'])
+        canonical_bibcodes_mapping = api.get_canonical_bibcodes_mapping(self.app, bibcodes)
+        self.assertEqual(canonical_bibcodes_mapping, {'2015arXiv151003579A': '2015ApJ...815L..10L', '2015ApJ...815L..10L': '2015ApJ...815L..10L', '2019arXiv190105505T': None})
+        # Second request was served from the in-process cache
+        self.assertEqual(len(httpretty.latest_requests()), 1)
+
+    def test_get_canonical_bibcodes_from_database_cache(self):
+        bibcodes = ['2015arXiv151003579A', '2019arXiv190105505T']
+        api.get_canonical_bibcodes(self.app, bibcodes)
+        api.canonical_bibcodes_cache.clear()
+        cached_canonical_bibcodes = db.get_cached_canonical_bibcodes(self.app, bibcodes, ttl=60, not_found_ttl=60)
+        self.assertEqual(cached_canonical_bibcodes, {'2015arXiv151003579A': '2015ApJ...815L..10L', '2019arXiv190105505T': None})
+        self.assertEqual(api.get_canonical_bibcode(self.app, '2015arXiv151003579A'), '2015ApJ...815L..10L')
+        self.assertEqual(len(httpretty.latest_requests()), 1)
+        # Expired entries are requested again
+        self.assertEqual(db.get_cached_canonical_bibcodes(self.app, bibcodes, ttl=0, not_found_ttl=0), {})
+
+    def test_get_canonical_bibcodes_refresh(self):
+        bibcodes = ['2015arXiv151003579A']
+        api.get_canonical_bibcodes(self.app, bibcodes)
+        api.get_canonical_bibcodes(self.app, bibcodes, refresh=True)
+        self.assertEqual(len(httpretty.latest_requests()), 2)
+        api.invalidate_canonical_bibcodes(self.app, bibcodes)
+        self.assertEqual(db.get_cached_canonical_bibcodes(self.app, bibcodes, ttl=60, not_found_ttl=60), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
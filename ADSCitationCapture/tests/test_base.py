@@ -3,7 +3,7 @@ import contextlib
 import mock
 from sqlalchemy import create_engine
 from adsputils import load_config
-from ADSCitationCapture import app, tasks
+from ADSCitationCapture import app, tasks, output
 from ADSCitationCapture.models import Base
 
 
@@ -46,9 +46,14 @@ class TestBase(unittest.TestCase):
             "CELERY_ALWAYS_EAGER": False,
             "CELERY_EAGER_PROPAGATES_EXCEPTIONS": False,
             "SQLALCHEMY_URL": self.sqlalchemy_url,
+            # Events are emitted one by one so that tests can mock webhook.emit_event
+            "EMIT_EVENT_BATCH_SIZE": 1,
         }
         self.app = app.ADSCitationCaptureCelery('test', proj_home=self.proj_home, local_config=config)
         tasks.app = self.app # monkey-patch the app object
+        # Records are forwarded immediately (the output buffer of the module is built with the worker configuration)
+        self._output_buffer = tasks.output_buffer
+        tasks.output_buffer = output.RecordBuffer(lambda message: tasks._forward_message(message), batch_size=1, max_delay=None)
         self._init_mock_data()
         try:
             Base.metadata.create_all(bind=self.app._engine, checkfirst=True)
@@ -78,6 +83,7 @@ class TestBase(unittest.TestCase):
         self.app._engine.dispose()
         self.app.close_app()
         tasks.app = self._app
+        tasks.output_buffer = self._output_buffer
 
     def _init_mock_data(self):
         self.mock_data = {}
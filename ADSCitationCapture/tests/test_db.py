@@ -0,0 +1,237 @@
+import shutil
+import tempfile
+import unittest
+import adsmsg
+from sqlalchemy import text, any_
+from sqlalchemy.dialects.postgresql import array
+from sqlalchemy_continuum import version_class
+from sqlalchemy_continuum.operation import Operation
+from ADSCitationCapture import db, output
+from ADSCitationCapture.models import Citation, CitationTarget, Event
+from .test_base import TestBase
+
+
+class TestWorkers(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+
+    def tearDown(self):
+        TestBase.tearDown(self)
+
+    def _citation_targets(self, status):
+        return [
+            {'content': '10.5281/zenodo.11020', 'content_type': 'DOI', 'raw_metadata': '', 'parsed_metadata': {'bibcode': '2014zndo.....11020F'}, 'status': status},
+            {'content': '10.5281/zenodo.27878', 'content_type': 'DOI', 'raw_metadata': '', 'parsed_metadata': {'bibcode': '2015zndo.....27878D'}, 'status': status},
+        ]
+
+    def _citation_change(self, citing, content):
+        citation_change = adsmsg.CitationChange(citing=citing, cited='...................', content=content, content_type=adsmsg.CitationChangeContentType.doi, resolved=False, status=adsmsg.Status.new)
+        citation_change.timestamp.GetCurrentTime()
+        return citation_change
+
+    def test_store_citation_targets(self):
+        stored_contents = db.store_citation_targets(self.app, self._citation_targets('DISCARDED'))
+        self.assertEqual(sorted(stored_contents), ['10.5281/zenodo.11020', '10.5281/zenodo.27878'])
+        # Existing citation targets are ignored
+        self.assertEqual(db.store_citation_targets(self.app, self._citation_targets('REGISTERED')), [])
+        self.assertEqual(db.get_citation_target_metadata(self.app, '10.5281/zenodo.11020')['status'], 'DISCARDED')
+        # ...unless they are updated
+        stored_contents = db.store_citation_targets(self.app, self._citation_targets('REGISTERED'), update=True)
+        self.assertEqual(len(stored_contents), 2)
+        self.assertEqual(db.get_citation_target_metadata(self.app, '10.5281/zenodo.11020')['status'], 'REGISTERED')
+        with self.app.session_scope() as session:
+            CitationTargetVersion = version_class(CitationTarget)
+            versions = session.query(CitationTargetVersion).filter_by(content='10.5281/zenodo.11020').order_by(CitationTargetVersion.transaction_id).all()
+            self.assertEqual([(v.operation_type, v.status) for v in versions], [(Operation.INSERT, 'DISCARDED'), (Operation.UPDATE, 'REGISTERED')])
+            self.assertEqual(versions[0].end_transaction_id, versions[1].transaction_id)
+            self.assertIsNone(versions[1].end_transaction_id)
+
+    def test_store_citations(self):
+        db.store_citation_targets(self.app, self._citation_targets('REGISTERED'))
+        citation_changes = [
+            self._citation_change('2015ApJ...815L..10L', '10.5281/zenodo.11020'),
+            self._citation_change('2015ApJ...815L..10L', '10.5281/zenodo.27878'),
+        ]
+        stored_citations = db.store_citations(self.app, citation_changes, 'REGISTERED')
+        self.assertEqual(sorted(stored_citations), [('2015ApJ...815L..10L', '10.5281/zenodo.11020'), ('2015ApJ...815L..10L', '10.5281/zenodo.27878')])
+        # Existing citations are ignored
+        citation_changes.append(self._citation_change('2019arXiv190105505T', '10.5281/zenodo.11020'))
+        stored_citations = db.store_citations(self.app, citation_changes, 'REGISTERED')
+        self.assertEqual(stored_citations, [('2019arXiv190105505T', '10.5281/zenodo.11020')])
+        self.assertEqual(sorted(db.get_citations_by_bibcode(self.app, '2014zndo.....11020F')), ['2015ApJ...815L..10L', '2019arXiv190105505T'])
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(version_class(Citation)).filter_by(operation_type=Operation.INSERT).count(), 3)
+
+    def test_mark_all_discarded_citations_as_registered(self):
+        db.store_citation_targets(self.app, self._citation_targets('DISCARDED'))
+        citation_changes = [
+            self._citation_change('2015ApJ...815L..10L', '10.5281/zenodo.11020'),
+            self._citation_change('2019arXiv190105505T', '10.5281/zenodo.11020'),
+            self._citation_change('2015ApJ...815L..10L', '10.5281/zenodo.27878'),
+        ]
+        db.store_citations(self.app, citation_changes, 'DISCARDED')
+        citations = db.mark_all_discarded_citations_as_registered(self.app, '10.5281/zenodo.11020')
+        self.assertEqual(sorted(citations), ['2015ApJ...815L..10L', '2019arXiv190105505T'])
+        self.assertEqual(db.mark_all_discarded_citations_as_registered(self.app, '10.5281/zenodo.11020'), [])
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(Citation).filter_by(status='DISCARDED').count(), 1)
+            self.assertEqual(session.query(version_class(Citation)).filter_by(operation_type=Operation.UPDATE, status='REGISTERED').count(), 2)
+
+    def test_update_and_delete_citation(self):
+        db.store_citation_targets(self.app, self._citation_targets('REGISTERED'))
+        citation_change = self._citation_change('2015ApJ...815L..10L', '10.5281/zenodo.11020')
+        db.store_citations(self.app, [citation_change], 'REGISTERED')
+        # Older or equal timestamps are ignored
+        self.assertFalse(db.update_citation(self.app, citation_change))
+        self.assertEqual(db.mark_citation_as_deleted(self.app, citation_change), (False, 'REGISTERED'))
+        # Newer timestamps win
+        citation_change.timestamp.seconds += 1
+        citation_change.cited = '2014zndo.....11020F'
+        self.assertTrue(db.update_citation(self.app, citation_change))
+        citation_change.timestamp.seconds += 1
+        self.assertEqual(db.mark_citation_as_deleted(self.app, citation_change), (True, 'REGISTERED'))
+        self.assertEqual(db.get_citations_by_bibcode(self.app, '2014zndo.....11020F'), [])
+        with self.app.session_scope() as session:
+            citation = session.query(Citation).one()
+            self.assertEqual((citation.cited, citation.status), ('2014zndo.....11020F', 'DELETED'))
+            self.assertEqual(session.query(version_class(Citation)).filter_by(end_transaction_id=None).one().status, 'DELETED')
+
+    def test_registered_citations(self):
+        db.store_citation_targets(self.app, self._citation_targets('REGISTERED'))
+        citation_changes = [
+            self._citation_change('2019arXiv190105505T', '10.5281/zenodo.11020'),
+            self._citation_change('2015ApJ...815L..10L', '10.5281/zenodo.11020'),
+        ]
+        db.store_citations(self.app, citation_changes, 'REGISTERED')
+        with self.app.session_scope() as session:
+            citation_target = session.query(CitationTarget).filter_by(content='10.5281/zenodo.11020').one()
+            self.assertEqual((citation_target.registered_citation_count, citation_target.registered_citing), (2, ['2015ApJ...815L..10L', '2019arXiv190105505T']))
+            self.assertIsNone(citation_target.updated)
+        citation_changes[0].timestamp.seconds += 1
+        db.mark_citation_as_deleted(self.app, citation_changes[0])
+        self.assertEqual(db.get_citations_by_bibcode(self.app, '2014zndo.....11020F'), ['2015ApJ...815L..10L'])
+        # Nothing to be fixed unless the denormalized columns are out of sync
+        self.assertEqual(db.rebuild_registered_citations(self.app), [])
+        with self.app.session_scope() as session:
+            session.query(CitationTarget).update({'registered_citation_count': None, 'registered_citing': None}, synchronize_session=False)
+        self.assertEqual(sorted(db.rebuild_registered_citations(self.app)), ['10.5281/zenodo.11020', '10.5281/zenodo.27878'])
+        self.assertEqual(db.get_citations_by_bibcode(self.app, '2014zndo.....11020F'), ['2015ApJ...815L..10L'])
+
+    def test_registered_citations_unit_of_work(self):
+        db.store_citation_targets(self.app, self._citation_targets('REGISTERED'))
+        citation_changes = [
+            self._citation_change('2015ApJ...815L..10L', '10.5281/zenodo.11020'),
+            self._citation_change('2019arXiv190105505T', '10.5281/zenodo.11020'),
+        ]
+        with db.unit_of_work(self.app) as session:
+            for citation_change in citation_changes:
+                self.assertTrue(db.store_citation(self.app, citation_change, 'DOI', '', {}, 'REGISTERED', session=session))
+            # Registered citations are refreshed once but reads in the unit of work see the changes
+            self.assertEqual(db.get_citations_by_bibcode(self.app, '2014zndo.....11020F', session=session), ['2015ApJ...815L..10L', '2019arXiv190105505T'])
+            citation_changes[0].timestamp.seconds += 1
+            citation_changes[0].cited = '2014zndo.....11020F'
+            self.assertTrue(db.update_citation(self.app, citation_changes[0], session=session))
+            citation_changes[1].timestamp.seconds += 1
+            self.assertEqual(db.mark_citation_as_deleted(self.app, citation_changes[1], session=session), (True, 'REGISTERED'))
+            self.assertEqual(db.get_citations_by_bibcode(self.app, '2014zndo.....11020F', session=session), ['2015ApJ...815L..10L'])
+        self.assertEqual(db.get_citations_by_bibcode(self.app, '2014zndo.....11020F'), ['2015ApJ...815L..10L'])
+        self.assertEqual(db.rebuild_registered_citations(self.app), [])
+
+    def test_get_citation_targets_by_bibcode(self):
+        citation_targets = self._citation_targets('REGISTERED')
+        citation_targets[0]['parsed_metadata']['alternate_bibcode'] = ['2014zndo.....11020A']
+        citation_targets[1]['status'] = 'DISCARDED'
+        db.store_citation_targets(self.app, citation_targets)
+        # Canonical and alternate bibcodes resolve to the same citation target (in the order of the input)
+        not_found = []
+        records = db.get_citation_targets_by_bibcode(self.app, ['2014zndo.....11020A', '2014zndo.....11020F'], not_found=not_found)
+        self.assertEqual([record['content'] for record in records], ['10.5281/zenodo.11020'])
+        self.assertEqual(records[0]['alternate_bibcode'], ['2014zndo.....11020A'])
+        self.assertEqual(not_found, [])
+        # Citation targets with other statuses and unknown bibcodes are not found
+        not_found = []
+        records = db.get_citation_targets_by_bibcode(self.app, ['2015zndo.....27878D', '2014zndo.....11020F', '2019zndo.....00000X'], not_found=not_found)
+        self.assertEqual([record['content'] for record in records], ['10.5281/zenodo.11020'])
+        self.assertEqual(not_found, ['2015zndo.....27878D', '2019zndo.....00000X'])
+        # ...unless the status is not restricted
+        not_found = []
+        records = db.get_citation_targets_by_bibcode(self.app, ['2015zndo.....27878D', '2014zndo.....11020A', '2019zndo.....00000X'], only_status=None, not_found=not_found)
+        self.assertEqual([record['content'] for record in records], ['10.5281/zenodo.27878', '10.5281/zenodo.11020'])
+        self.assertEqual(not_found, ['2019zndo.....00000X'])
+        records = db.get_citation_targets_by_bibcode(self.app, ['2015zndo.....27878D'], only_status='DISCARDED')
+        self.assertEqual([record['content'] for record in records], ['10.5281/zenodo.27878'])
+
+    def test_lookup_indexes(self):
+        db.store_citation_targets(self.app, self._citation_targets('REGISTERED'))
+        db.store_citations(self.app, [self._citation_change('2015ApJ...815L..10L', '10.5281/zenodo.11020')], 'REGISTERED')
+        with self.app.session_scope() as session:
+            # Tables are too small for the planner to prefer the indexes
+            session.execute(text("SET LOCAL enable_seqscan = off"))
+            queries = {
+                'ix_public_citation_target_bibcode': session.query(CitationTarget.content).filter(CitationTarget.parsed_cited_metadata['bibcode'].astext == any_(array(['2014zndo.....11020F']))),
+                'ix_public_citation_target_alternate_bibcode': session.query(CitationTarget.content).filter(CitationTarget.parsed_cited_metadata['alternate_bibcode'].has_any(array(['2014zndo.....11020F']))),
+                'ix_public_citation_target_status': session.query(CitationTarget.content).filter_by(status='DISCARDED'),
+                'ix_public_citation_content_status': session.query(Citation.citing).filter_by(content='10.5281/zenodo.11020', status='REGISTERED'),
+            }
+            for index_name, query in queries.items():
+                statement = str(query.statement.compile(dialect=session.bind.dialect, compile_kwargs={"literal_binds": True}))
+                plan = "\n".join(row[0] for row in session.execute(text("EXPLAIN " + statement)))
+                self.assertIn(index_name, plan)
+            session.rollback()
+
+    def test_get_citation_target_metadata_cache(self):
+        db.citation_target_metadata_cache.clear()
+        db.store_citation_targets(self.app, self._citation_targets('REGISTERED'))
+        metadata = db.get_citation_target_metadata(self.app, '10.5281/zenodo.11020')
+        self.assertIn('10.5281/zenodo.11020', db.citation_target_metadata_cache)
+        # Returned metadata can be modified without altering the cache
+        metadata['parsed']['bibcode'] = 'modified'
+        self.assertEqual(db.get_citation_target_metadata(self.app, '10.5281/zenodo.11020')['parsed'], {'bibcode': '2014zndo.....11020F'})
+        # Updated rows are reloaded
+        db.update_citation_target_metadata(self.app, '10.5281/zenodo.11020', '', {'bibcode': '2014zndo.....11020X'}, status='DISCARDED')
+        metadata = db.get_citation_target_metadata(self.app, '10.5281/zenodo.11020')
+        self.assertEqual((metadata['parsed'], metadata['status']), ({'bibcode': '2014zndo.....11020X'}, 'DISCARDED'))
+        self.assertIsNotNone(db.get_citation_target_entry_date(self.app, '10.5281/zenodo.11020'))
+        self.assertEqual(db.get_citation_target_metadata(self.app, '10.5281/zenodo.00000'), {})
+
+    def test_lock_citation_target(self):
+        with db.unit_of_work(self.app) as session:
+            self.assertTrue(db.lock_citation_target(self.app, '10.5281/zenodo.11020', session, timeout=0))
+            with db.unit_of_work(self.app) as other_session:
+                self.assertFalse(db.lock_citation_target(self.app, '10.5281/zenodo.11020', other_session, timeout=0))
+                self.assertTrue(db.lock_citation_target(self.app, '10.5281/zenodo.27878', other_session, timeout=0))
+        # The lock is released when the transaction ends
+        with db.unit_of_work(self.app) as session:
+            self.assertTrue(db.lock_citation_target(self.app, '10.5281/zenodo.11020', session, timeout=0))
+
+    def test_event_partitions(self):
+        self.assertEqual(len(db.create_event_partitions(self.app, months_ahead=2)), 3)
+        self.assertEqual(db.create_event_partitions(self.app, months_ahead=2), [])
+        event_data = {'Source': {'Identifier': {'ID': '2015ApJ...815L..10L'}}, 'Target': {'Identifier': {'ID': '10.5281/zenodo.11020'}}}
+        db.store_event(self.app, event_data)
+        self.assertEqual(db.get_events_by_identifier(self.app, '10.5281/zenodo.11020'), [event_data])
+        # Partitions with pending events are kept
+        expired_partitions = db.get_expired_event_partitions(self.app, -3)
+        self.assertEqual(len(expired_partitions), 3)
+        directory = tempfile.mkdtemp()
+        archive = output.JSONLinesArchive(directory)
+        self.assertEqual([db.archive_event_partition(self.app, name, archive) for name in expired_partitions], [None, 0, 0])
+        with self.app.session_scope() as session:
+            db.mark_events_as_sent(self.app, [event.id for event in session.query(Event)], session)
+            session.commit()
+        self.assertEqual(db.archive_event_partition(self.app, expired_partitions[0], archive), 1)
+        self.assertEqual(db.get_event_partitions(self.app), {})
+        self.assertEqual(db.get_events_by_identifier(self.app, '10.5281/zenodo.11020'), [])
+        self.assertEqual([event['data'] for event in output.search_archive(directory, '2015ApJ...815L..10L')], [event_data])
+        shutil.rmtree(directory)
+
+    def test_event_partitions_with_default_rows(self):
+        db.store_event(self.app, {'Source': {'Identifier': {'ID': '2015ApJ...815L..10L'}}, 'Target': {'Identifier': {'ID': '10.5281/zenodo.11020'}}})
+        # The event of the current month is in the default partition, hence
+        # only the partition of the next month can be created
+        self.assertEqual(db.create_event_partitions(self.app, months_ahead=1), [db._month_start(db.get_date().date(), 1).strftime("event_%Y%m")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,7 @@ from ADSCitationCapture import webhook
 from ADSCitationCapture import doi
 from ADSCitationCapture import url
 from ADSCitationCapture import db
+from ADSCitationCapture import forward
 from .test_base import TestBase
 
 import unittest
@@ -21,6 +22,52 @@ class TestWorkers(TestBase):
     def tearDown(self):
         TestBase.tearDown(self)
 
+    def test_strip_html(self):
+        texts = [
+            "",
+            "  Plain text without markup",
+            "<p>We observe abundance anomalies&nbsp;at the surface</p>\n<p>of <i>A</i> stars &amp; <sub>2</sub> &lt;p&gt;</p>",
+            "<div>\n  <ul>\n <li>a</li>\n <li> </li>\n </ul>\n</div>\r\n",
+            "<a href='https://zenodo.org/?a=1&amp;b=2'>link</a> a < b &#169; &#x2014;",
+            # Markup delegated to BeautifulSoup
+            "<!-- comment -->text",
+            "<b><p>restructured</b> paragraph</p>",
+            "</p>stray  <em> </em> end tag",
+            "&copy2019 &notit; &#128;",
+            "<p/>\n&#x41;&amp;</p>  <em>atext",
+            "<a\r\n &lt;&#169;<p/>\t</a>\n",
+        ]
+        for filename in ('datacite_parsed_metadata.json', 'datacite_parsed_metadata_and_authors.json'):
+            with open(os.path.join(self.app.conf['PROJ_HOME'], 'ADSCitationCapture/tests/data', filename)) as f:
+                parsed_metadata = json.load(f)
+            texts += [parsed_metadata['abstract'], parsed_metadata['title']]
+        texts += [self.mock_data[doi_id]['parsed'].get(key, "") for doi_id in self.mock_data for key in ('abstract', 'title')]
+        for text in texts:
+            self.assertEqual(forward.strip_html(text), forward._strip_html_with_beautifulsoup(text))
+        # Self-closed non-void elements
+        self.assertEqual(forward.strip_html("<p/>\n&#x41;&amp;</p>  <em>atext"), "\nA&  atext")
+        self.assertEqual(forward.strip_html("<a\r\n &lt;&#169;<p/>\t</a>\n"), "\n")
+
+    def test_build_record_template(self):
+        forward.record_templates_cache.clear()
+        doi_id = "10.5281/zenodo.11020" # software
+        parsed_metadata = self.mock_data[doi_id]['parsed']
+        citation_change = adsmsg.CitationChange(content=doi_id, content_type=adsmsg.CitationChangeContentType.doi, status=adsmsg.Status.new)
+        record, nonbib_record = forward.build_record(self.app, citation_change, parsed_metadata, ['2015ApJ...815L..10L'])
+        key, template = forward.record_templates_cache.get(doi_id)
+        # The template is reused and it is not modified
+        citation_change.status = adsmsg.Status.deleted
+        record, nonbib_record = forward.build_record(self.app, citation_change, parsed_metadata, ['2015ApJ...815L..10L', '2019arXiv190105505T'])
+        self.assertIs(forward.record_templates_cache.get(doi_id)[1], template)
+        self.assertEqual(list(template.citation), [])
+        self.assertEqual(list(record.citation), ['2015ApJ...815L..10L', '2019arXiv190105505T'])
+        self.assertEqual((record.citation_count, record.status, nonbib_record.status), (2, 1, 1))
+        # Metadata changes invalidate the template
+        modified_parsed_metadata = dict(parsed_metadata, title='Modified title')
+        record, nonbib_record = forward.build_record(self.app, citation_change, modified_parsed_metadata, [])
+        self.assertNotEqual(forward.record_templates_cache.get(doi_id)[0], key)
+        self.assertEqual(list(record.title), ['Modified title'])
+
 
 if __name__ == '__main__':
     unittest.main()
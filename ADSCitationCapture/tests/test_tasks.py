@@ -1,12 +1,16 @@
 import sys
 import os
 import json
+import shutil
+import tempfile
+import time
 import adsmsg
 from ADSCitationCapture import webhook
 from ADSCitationCapture import doi
 from ADSCitationCapture import url
 from ADSCitationCapture import db
 from ADSCitationCapture import api
+from ADSCitationCapture.models import Event
 from .test_base import TestBase
 
 import unittest
@@ -43,7 +47,7 @@ class TestWorkers(TestBase):
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
                 'store_citation': patch.object(db, 'store_citation', return_value=True), \
-                'store_event': patch.object(db, 'store_event', return_value=True), \
+                'store_event': patch.object(db, 'store_event', wraps=db.store_event), \
                 'update_citation': patch.object(db, 'update_citation', return_value=True), \
                 'mark_citation_as_deleted': patch.object(db, 'mark_citation_as_deleted', return_value=(True, 'REGISTERED')), \
                 'get_citations': patch.object(db, 'get_citations', return_value=[]), \
@@ -96,7 +100,8 @@ class TestWorkers(TestBase):
             self.assertTrue(mocked['identical_bibcode_and_doi_event_data'].called)
             self.assertTrue(mocked['store_event'].called)
             self.assertTrue(mocked['webhook_dump_event'].called)
-            self.assertTrue(mocked['webhook_emit_event'].called)
+            self.assertEqual(db.get_pending_event_count(self.app), 0)
+            self.assertTrue(mocked['webhook_emit_event'].called) # events are sent from the outbox
 
 
     def test_process_updated_citation_changes_doi(self):
@@ -236,7 +241,7 @@ class TestWorkers(TestBase):
                 'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
                 'store_citation_target': patch.object(db, 'store_citation_target', return_value=True), \
                 'store_citation': patch.object(db, 'store_citation', return_value=True), \
-                'store_event': patch.object(db, 'store_event', return_value=True), \
+                'store_event': patch.object(db, 'store_event', wraps=db.store_event), \
                 'update_citation': patch.object(db, 'update_citation', return_value=True), \
                 'mark_citation_as_deleted': patch.object(db, 'mark_citation_as_deleted', return_value=(True, 'REGISTERED')), \
                 'get_citations': patch.object(db, 'get_citations', return_value=[]), \
@@ -289,7 +294,8 @@ class TestWorkers(TestBase):
             self.assertTrue(mocked['identical_bibcode_and_doi_event_data'].called)
             self.assertTrue(mocked['store_event'].called)
             self.assertTrue(mocked['webhook_dump_event'].called)
-            self.assertTrue(mocked['webhook_emit_event'].called)
+            self.assertEqual(db.get_pending_event_count(self.app), 0)
+            self.assertTrue(mocked['webhook_emit_event'].called) # events are sent from the outbox
 
     def test_process_updated_citation_changes_doi_when_target_exists_citation_doesnt(self):
         citation_changes = self._common_citation_changes_doi(adsmsg.Status.updated)
@@ -1020,6 +1026,166 @@ class TestWorkers(TestBase):
             self.assertFalse(mocked['webhook_emit_event'].called) # because we don't know if an URL is software
 
 
+    def test_process_new_citation_rollback(self):
+        citation_change = tasks._protobuf_to_adsmsg_citation_change(self._common_citation_changes_doi(adsmsg.Status.new).changes[0])
+        doi_id = "10.5281/zenodo.11020" # software
+        store_citation = db.store_citation
+        def _store_citation_and_fail(*args, **kwargs):
+            store_citation(*args, **kwargs)
+            raise Exception("Failure after storing the citation")
+        mock_patches = lambda: {
+                'get_canonical_bibcode': patch.object(api, 'get_canonical_bibcode', return_value=citation_change.citing), \
+                'get_canonical_bibcodes': patch.object(api, 'get_canonical_bibcodes', side_effect=lambda app, bibcodes: bibcodes), \
+                'fetch_metadata': patch.object(doi, 'fetch_metadata', return_value=self.mock_data[doi_id]['raw']), \
+                'parse_metadata': patch.object(doi, 'parse_metadata', return_value=self.mock_data[doi_id]['parsed']), \
+                'task_output_results': patch.object(tasks.task_output_results, 'delay', return_value=None), \
+                'task_send_events': patch.object(tasks.task_send_events, 'delay', return_value=None)}
+        with TestBase.mock_multiple_targets(dict(mock_patches(), store_citation=patch.object(db, 'store_citation', side_effect=_store_citation_and_fail))) as mocked:
+            with self.assertRaises(Exception):
+                tasks.task_process_new_citation(citation_change)
+            # The citation target, the events and the citation are rolled back together...
+            self.assertEqual(db.get_citation_target_metadata(self.app, doi_id), {})
+            self.assertEqual(db.get_pending_event_count(self.app), 0)
+            self.assertFalse(db.citation_already_exists(self.app, citation_change))
+            # ...and the tasks that depend on them are not started
+            self.assertFalse(mocked['task_output_results'].called)
+            self.assertFalse(mocked['task_send_events'].called)
+        # The task can be run again
+        with TestBase.mock_multiple_targets(mock_patches()) as mocked:
+            tasks.task_process_new_citation(citation_change)
+            self.assertEqual(db.get_citation_target_metadata(self.app, doi_id)['status'], 'REGISTERED')
+            self.assertTrue(db.citation_already_exists(self.app, citation_change))
+            self.assertEqual(mocked['task_output_results'].call_count, 1)
+            self.assertEqual(mocked['task_output_results'].call_args[0][2], [citation_change.citing])
+            self.assertTrue(mocked['task_send_events'].called)
+
+    def test_process_new_citation_locked_target(self):
+        self.app.conf['CITATION_TARGET_LOCK_TIMEOUT'] = 0
+        citation_change = tasks._protobuf_to_adsmsg_citation_change(self._common_citation_changes_doi(adsmsg.Status.new).changes[0])
+        doi_id = "10.5281/zenodo.11020" # software
+        store_citation_target = db.store_citation_target
+        def _fetch_metadata_while_stored(*args, **kwargs):
+            # Another worker stores the same citation target meanwhile
+            store_citation_target(self.app, citation_change, "DOI", self.mock_data[doi_id]['raw'], self.mock_data[doi_id]['parsed'], 'REGISTERED')
+            return self.mock_data[doi_id]['raw']
+        with db.unit_of_work(self.app) as other_session:
+            # ...and it still holds the lock when this worker times out waiting for it
+            self.assertTrue(db.lock_citation_target(self.app, doi_id, other_session, timeout=0))
+            with TestBase.mock_multiple_targets({
+                    'get_canonical_bibcode': patch.object(api, 'get_canonical_bibcode', return_value=citation_change.citing), \
+                    'get_canonical_bibcodes': patch.object(api, 'get_canonical_bibcodes', side_effect=lambda app, bibcodes: bibcodes), \
+                    'fetch_metadata': patch.object(doi, 'fetch_metadata', side_effect=_fetch_metadata_while_stored), \
+                    'parse_metadata': patch.object(doi, 'parse_metadata', return_value=self.mock_data[doi_id]['parsed']), \
+                    'store_citation_target': patch.object(db, 'store_citation_target', wraps=db.store_citation_target), \
+                    'task_output_results': patch.object(tasks.task_output_results, 'delay', return_value=None), \
+                    'task_send_events': patch.object(tasks.task_send_events, 'delay', return_value=None)}) as mocked:
+                tasks.task_process_new_citation(citation_change)
+                # The citation target is checked again without the lock and the stored one is reused
+                self.assertEqual(mocked['fetch_metadata'].call_count, 1)
+                self.assertFalse(mocked['store_citation_target'].called)
+                self.assertTrue(db.citation_already_exists(self.app, citation_change))
+                self.assertEqual(mocked['task_output_results'].call_count, 1)
+
+    def test_process_citation_target_changes_doi(self):
+        citation_changes = self._common_citation_changes_doi(adsmsg.Status.new)
+        citation_change = citation_changes.changes.add()
+        citation_change.CopyFrom(citation_changes.changes[0])
+        citation_change.citing = '2015ApJ...815L..10L'
+        doi_id = "10.5281/zenodo.11020" # software
+        citings = [citation_change.citing for citation_change in citation_changes.changes]
+        with TestBase.mock_multiple_targets({
+                'get_canonical_bibcodes_mapping': patch.object(api, 'get_canonical_bibcodes_mapping', return_value={citing: citing for citing in citings}), \
+                'get_canonical_bibcodes': patch.object(api, 'get_canonical_bibcodes', side_effect=lambda app, bibcodes: bibcodes), \
+                'fetch_metadata': patch.object(doi, 'fetch_metadata', return_value=self.mock_data[doi_id]['raw']), \
+                'parse_metadata': patch.object(doi, 'parse_metadata', return_value=self.mock_data[doi_id]['parsed']), \
+                'webhook_dump_event': patch.object(webhook, 'dump_event', return_value=True), \
+                'webhook_emit_event': patch.object(webhook, 'emit_event', return_value=True), \
+                'task_output_results': patch.object(tasks.task_output_results, 'delay', return_value=None)}) as mocked:
+            tasks.task_process_citation_target_changes(citation_changes)
+            # Metadata is fetched once and only one record is forwarded with all the citations
+            self.assertEqual(mocked['fetch_metadata'].call_count, 1)
+            self.assertEqual(mocked['task_output_results'].call_count, 1)
+            self.assertEqual(sorted(mocked['task_output_results'].call_args[0][2]), sorted(citings))
+            # Every citation is emitted but the bibcode/DOI identity only once
+            relationships = [args[0][2]['RelationshipType']['SubType'] for args in mocked['webhook_emit_event'].call_args_list]
+            self.assertEqual(sorted(relationships), ['Cites', 'Cites', 'IsIdenticalTo'])
+        self.assertEqual(sorted(db.get_citations_by_bibcode(self.app, self.mock_data[doi_id]['parsed']['bibcode'])), sorted(citings))
+
+    def test_task_send_events(self):
+        self.app.conf['EMIT_EVENT_BATCH_SIZE'] = 2
+        self.app.conf['EMIT_EVENT_MAX_ATTEMPTS'] = 2
+        events_data = [webhook.identical_bibcodes_event_data(source_bibcode, '2015ApJ...815L..10L') for source_bibcode in ('2015arXiv151003579A', 'malformed', '2019arXiv190105505T')]
+        # Events are stored in the transaction of the citation change
+        with db.unit_of_work(self.app) as session:
+            for event_data in events_data:
+                db.store_event(self.app, event_data, dump_prefix='20190101_000000', session=session)
+        with TestBase.mock_multiple_targets({
+                'webhook_dump_event': patch.object(webhook, 'dump_event', return_value=True), \
+                'webhook_emit_events': patch.object(webhook, 'emit_events', side_effect=lambda url, token, events: [key for key, event_data in events if event_data['Source']['Identifier']['ID'] == 'malformed']), \
+                'task_send_events': patch.object(tasks.task_send_events, 'apply_async', return_value=None)}) as mocked:
+            tasks.task_send_events()
+            self.assertEqual([len(args[0][2]) for args in mocked['webhook_emit_events'].call_args_list], [2, 1])
+            self.assertEqual(mocked['webhook_dump_event'].call_count, 2)
+            with self.app.session_scope() as session:
+                self.assertEqual(sorted((event.data['Source']['Identifier']['ID'], event.status, event.attempts) for event in session.query(Event)),
+                                 [('2015arXiv151003579A', 'SENT', 0), ('2019arXiv190105505T', 'SENT', 0), ('malformed', 'PENDING', 1)])
+            # The sender is queued again to retry the pending event
+            mocked['task_send_events'].assert_called_once_with(countdown=self.app.conf['EMIT_EVENT_RETRY_DELAY'])
+            # The event is marked as failed once it reaches the maximum number of attempts
+            tasks.task_send_events()
+            self.assertEqual(db.get_pending_event_count(self.app), 0)
+            self.assertEqual(mocked['task_send_events'].call_count, 1)
+            self.assertEqual(db.retry_failed_events(self.app), 1)
+            self.assertEqual(db.get_pending_event_count(self.app), 1)
+
+    def test_maintenance_metadata_event(self):
+        doi_id = "10.5281/zenodo.11020" # software
+        citation_change = adsmsg.CitationChange(content=doi_id, content_type=adsmsg.CitationChangeContentType.doi, status=adsmsg.Status.new)
+        db.store_citation_target(self.app, citation_change, 'DOI', self.mock_data[doi_id]['raw'], self.mock_data[doi_id]['parsed'], 'REGISTERED')
+        registered_record = {'bibcode': '2014zndo.....11020F', 'alternate_bibcode': [], 'content': doi_id, 'content_type': 'DOI'}
+        parsed_metadata = self.mock_data[doi_id]['parsed'].copy()
+        parsed_metadata['bibcode'] = '2014zndo.....11020X'
+        update_citation_target_metadata = db.update_citation_target_metadata
+        with TestBase.mock_multiple_targets({
+                'fetch_metadata': patch.object(doi, 'fetch_metadata', return_value=self.mock_data[doi_id]['raw']), \
+                'parse_metadata': patch.object(doi, 'parse_metadata', side_effect=lambda raw_metadata: parsed_metadata.copy()), \
+                'update_citation_target_metadata': patch.object(db, 'update_citation_target_metadata', side_effect=ValueError("Metadata update failed")), \
+                'get_canonical_bibcodes': patch.object(api, 'get_canonical_bibcodes', return_value=[]), \
+                'task_output_results': patch.object(tasks.task_output_results, 'delay', return_value=None), \
+                'task_send_events': patch.object(tasks.task_send_events, 'delay', return_value=None)}) as mocked:
+            # The IsIdenticalTo event is rolled back with the metadata update
+            with self.assertRaises(ValueError):
+                tasks._maintenance_metadata(registered_record)
+            self.assertEqual(db.get_pending_event_count(self.app), 0)
+            self.assertFalse(mocked['task_send_events'].called)
+            mocked['update_citation_target_metadata'].side_effect = update_citation_target_metadata
+            self.assertTrue(tasks._maintenance_metadata(registered_record))
+            self.assertEqual(db.get_pending_event_count(self.app), 1)
+            self.assertEqual(mocked['task_send_events'].call_count, 1)
+            self.assertEqual(mocked['task_output_results'].call_count, 1)
+
+    def test_store_event_once(self):
+        citation_change = adsmsg.CitationChange(citing='2015ApJ...815L..10L', content='10.5281/zenodo.11020', content_type=adsmsg.CitationChangeContentType.doi, status=adsmsg.Status.new)
+        with patch.object(tasks.task_send_events, 'delay', return_value=None) as task_send_events:
+            for i in range(2):
+                with db.unit_of_work(self.app) as session:
+                    tasks._store_event(webhook.identical_bibcode_and_doi_event_data('2014zndo.....11020F', '10.5281/zenodo.11020'), '20190101_000000', session=session)
+                    tasks._store_event(webhook.citation_change_to_event_data(citation_change), '20190101_000000', session=session)
+            # Events of the relations that are emitted once are not stored again
+            self.assertEqual(db.get_pending_event_count(self.app), 3)
+            self.assertEqual(task_send_events.call_count, 3)
+        # ...unless the transaction that stored them was rolled back
+        with self.assertRaises(ValueError):
+            with db.unit_of_work(self.app) as session:
+                tasks._store_event(webhook.identical_bibcodes_event_data('2015arXiv151003579A', '2015ApJ...815L..10L'), '20190101_000000', session=session, deferred_tasks=[])
+                raise ValueError()
+        self.assertTrue(db.register_emitted_relation(self.app, 'IsIdenticalTo', '2015arXiv151003579A', '2015ApJ...815L..10L'))
+        # ...or the event could not be stored
+        with patch.object(db, 'store_event', side_effect=ValueError()):
+            with self.assertRaises(ValueError):
+                tasks._store_event(webhook.identical_bibcodes_event_data('2019arXiv190105505T', '2015ApJ...815L..10L'), '20190101_000000')
+        self.assertTrue(db.register_emitted_relation(self.app, 'IsIdenticalTo', '2019arXiv190105505T', '2015ApJ...815L..10L'))
+
     def test_task_output_results(self):
         with patch('ADSCitationCapture.app.ADSCitationCaptureCelery.forward_message', return_value=None) as forward_message:
             citation_change = adsmsg.CitationChange(content_type=adsmsg.CitationChangeContentType.doi, status=adsmsg.Status.active)
@@ -1033,5 +1199,185 @@ class TestWorkers(TestBase):
             self.assertTrue(forward_message.called)
             self.assertEqual(forward_message.call_count, 2)
 
+    def test_task_output_results_unchanged(self):
+        citation_change = adsmsg.CitationChange(content='10.5281/zenodo.11020', content_type=adsmsg.CitationChangeContentType.doi, status=adsmsg.Status.updated)
+        parsed_metadata = {
+                'bibcode': 'test123456789012345',
+                'authors': ['Test, Unit'],
+                'normalized_authors': ['Test, U']
+                }
+        citations = ['2015ApJ...815L..10L']
+        with patch('ADSCitationCapture.app.ADSCitationCaptureCelery.forward_message', return_value=None) as forward_message:
+            tasks.task_output_results(citation_change, parsed_metadata, citations)
+            self.assertEqual(forward_message.call_count, 2)
+            # Same records are not forwarded again
+            tasks.task_output_results(citation_change, parsed_metadata, citations)
+            self.assertEqual(forward_message.call_count, 2)
+            # Unless forced
+            tasks.task_output_results(citation_change, parsed_metadata, citations, force=True)
+            self.assertEqual(forward_message.call_count, 4)
+            # Or they changed (citations are forwarded in the given order)
+            tasks.task_output_results(citation_change, parsed_metadata, ['2019arXiv190105505T'] + citations)
+            self.assertEqual(forward_message.call_count, 6)
+            records = [args[0] for args, kwargs in forward_message.call_args_list[-2:] if isinstance(args[0], adsmsg.DenormalizedRecord)]
+            self.assertEqual(list(records[0].citation), ['2019arXiv190105505T', '2015ApJ...815L..10L'])
+            # The order of the citations does not make them different
+            tasks.task_output_results(citation_change, parsed_metadata, citations + ['2019arXiv190105505T'])
+            self.assertEqual(forward_message.call_count, 6)
+
+    def test_task_output_results_coalesced(self):
+        self.app.conf['OUTPUT_COALESCING_WINDOW'] = 60
+        citation_change = adsmsg.CitationChange(content='10.5281/zenodo.11020', content_type=adsmsg.CitationChangeContentType.doi, status=adsmsg.Status.updated)
+        parsed_metadata = {
+                'bibcode': 'test123456789012345',
+                'authors': ['Test, Unit'],
+                'normalized_authors': ['Test, U']
+                }
+        citations = ['2015ApJ...815L..10L']
+        with patch('ADSCitationCapture.app.ADSCitationCaptureCelery.forward_message', return_value=None) as forward_message, \
+                patch.object(tasks.task_output_coalesced_results, 'apply_async', return_value=None) as apply_async, \
+                patch('ADSCitationCapture.forward.build_record', wraps=tasks.forward.build_record) as build_record:
+            tasks.task_output_results(citation_change, parsed_metadata, citations)
+            tasks.task_output_results(citation_change, parsed_metadata, citations + ['2019arXiv190105505T'], bibcode_replaced={'previous': 'test000000000000000', 'new': 'test123456789012345'})
+            tasks.task_output_results(citation_change, parsed_metadata, citations)
+            # Only the first request starts a window
+            self.assertEqual(apply_async.call_count, 1)
+            self.assertFalse(forward_message.called)
+            tasks.task_output_coalesced_results(citation_change.content)
+            # The deletion of the replaced bibcode is kept together with the latest state
+            self.assertEqual(forward_message.call_count, 4)
+            self.assertEqual(build_record.call_args[0][3], citations)
+            # Nothing is pending anymore
+            tasks.task_output_coalesced_results(citation_change.content)
+            self.assertEqual(forward_message.call_count, 4)
+
+    def test_task_output_results_batched(self):
+        citation_change = adsmsg.CitationChange(content='10.5281/zenodo.11020', content_type=adsmsg.CitationChangeContentType.doi, status=adsmsg.Status.updated)
+        parsed_metadata = {
+                'bibcode': 'test123456789012345',
+                'authors': ['Test, Unit'],
+                'normalized_authors': ['Test, U']
+                }
+        citations = ['2015ApJ...815L..10L']
+        with patch('ADSCitationCapture.app.ADSCitationCaptureCelery.forward_message', return_value=None) as forward_message, \
+                patch.object(tasks, 'output_buffer', tasks.output.RecordBuffer(lambda message: tasks.app.forward_message(message), batch_size=4, max_delay=None)), \
+                patch('ADSCitationCapture.db.store_forwarded_record_fingerprint', wraps=db.store_forwarded_record_fingerprint) as store_forwarded_record_fingerprint:
+            tasks.task_output_results(citation_change, parsed_metadata, citations)
+            # Records wait in the buffer and the fingerprint is only stored once they are published
+            self.assertEqual(len(tasks.output_buffer), 2)
+            self.assertFalse(forward_message.called)
+            self.assertFalse(store_forwarded_record_fingerprint.called)
+            citation_change.content = '10.5281/zenodo.27878'
+            tasks.task_output_results(citation_change, parsed_metadata, citations)
+            self.assertEqual(len(tasks.output_buffer), 0)
+            self.assertEqual(store_forwarded_record_fingerprint.call_count, 2)
+            # Non-bibliographic records are published together
+            nonbib_record_lists = [args[0] for args, kwargs in forward_message.call_args_list if isinstance(args[0], adsmsg.NonBibRecordList)]
+            self.assertEqual(len(nonbib_record_lists), 1)
+            self.assertEqual(len(nonbib_record_lists[0].nonbib_records), 2)
+            # Pending records are published on worker shutdown
+            citation_change.content = '10.5281/zenodo.11020'
+            tasks.task_output_results(citation_change, parsed_metadata, citations + ['2019arXiv190105505T'])
+            call_count = forward_message.call_count
+            tasks.flush_buffers()
+            self.assertGreater(forward_message.call_count, call_count)
+            self.assertEqual(store_forwarded_record_fingerprint.call_count, 3)
+            # Records that cannot be published are kept in the buffer
+            citation_change.content = '10.5281/zenodo.27878'
+            tasks.task_output_results(citation_change, parsed_metadata, citations + ['2019arXiv190105505T'])
+            forward_message.side_effect = Exception("Broker unavailable")
+            with self.assertRaises(Exception):
+                tasks.output_buffer.flush()
+            self.assertEqual(len(tasks.output_buffer), 2)
+            self.assertEqual(store_forwarded_record_fingerprint.call_count, 3)
+
+    def test_task_output_results_batch_max_delay(self):
+        citation_change = adsmsg.CitationChange(content='10.5281/zenodo.11020', content_type=adsmsg.CitationChangeContentType.doi, status=adsmsg.Status.updated)
+        parsed_metadata = {
+                'bibcode': 'test123456789012345',
+                'authors': ['Test, Unit'],
+                'normalized_authors': ['Test, U']
+                }
+        citations = ['2015ApJ...815L..10L']
+        with patch('ADSCitationCapture.app.ADSCitationCaptureCelery.forward_message', return_value=None) as forward_message, \
+                patch.object(tasks, 'output_buffer', tasks.output.RecordBuffer(lambda message: tasks.app.forward_message(message), batch_size=4, max_delay=0.1)):
+            tasks.task_output_results(citation_change, parsed_metadata, citations)
+            self.assertEqual(len(tasks.output_buffer), 2)
+            # Records are published once they expire even if no other task runs
+            for i in range(50):
+                if db.get_forwarded_record_fingerprint(self.app, citation_change.content) is not None:
+                    break
+                time.sleep(0.1)
+            self.assertIsNotNone(db.get_forwarded_record_fingerprint(self.app, citation_change.content))
+            self.assertEqual(len(tasks.output_buffer), 0)
+            self.assertTrue(forward_message.called)
+
+    def test_task_output_results_file_sink(self):
+        self.app.conf['OUTPUT_SINK'] = 'file'
+        citation_change = adsmsg.CitationChange(content='10.5281/zenodo.11020', content_type=adsmsg.CitationChangeContentType.doi, status=adsmsg.Status.updated)
+        parsed_metadata = {
+                'bibcode': 'test123456789012345',
+                'authors': ['Test, Unit'],
+                'normalized_authors': ['Test, U']
+                }
+        citations = ['2015ApJ...815L..10L']
+        directory = tempfile.mkdtemp()
+        with patch('ADSCitationCapture.app.ADSCitationCaptureCelery.forward_message', return_value=None) as forward_message, \
+                patch.object(tasks, 'record_file_sink', tasks.output.RecordFileSink(directory)):
+            tasks.task_output_results(citation_change, parsed_metadata, citations)
+            self.assertFalse(forward_message.called)
+            # Files are only listed once they are complete
+            self.assertEqual(tasks.output.list_record_files(directory), [])
+            tasks.flush_buffers()
+            filenames = tasks.output.list_record_files(directory)
+            self.assertEqual(len(filenames), 1)
+            messages = list(tasks.output.read_record_file(filenames[0]))
+            self.assertEqual([type(message) for message in messages], [adsmsg.DenormalizedRecord, adsmsg.NonBibRecord])
+            self.assertEqual(messages[0].citation, citations)
+        shutil.rmtree(directory)
+
+    def test_task_maintenance_canonical(self):
+        doi_id = "10.5281/zenodo.11020" # software
+        registered_records = [
+                {'bibcode': '2014zndo.....11020F', 'alternate_bibcode': [], 'content': doi_id, 'content_type': 'DOI'},
+                {'bibcode': '2015zndo.....27878D', 'alternate_bibcode': [], 'content': '10.5281/zenodo.27878', 'content_type': 'DOI'},
+                ]
+        citations_by_content = {
+                doi_id: ['2015arXiv151003579A', '2019arXiv190105505T'],
+                '10.5281/zenodo.27878': ['2015arXiv151003579A'],
+                }
+        canonical_bibcodes_mapping = {'2015arXiv151003579A': '2015ApJ...815L..10L', '2019arXiv190105505T': None}
+        with TestBase.mock_multiple_targets({
+                'iter_citation_targets': patch.object(db, 'iter_citation_targets', return_value=iter(registered_records)), \
+                'get_citation_targets_by_doi': patch.object(db, 'get_citation_targets_by_doi', return_value=registered_records), \
+                'get_citations_by_content': patch.object(db, 'get_citations_by_content', return_value=citations_by_content), \
+                'get_citations_by_bibcode': patch.object(db, 'get_citations_by_bibcode', return_value=[]), \
+                'get_citation_target_metadata': patch.object(db, 'get_citation_target_metadata', return_value=self.mock_data[doi_id]), \
+                'get_canonical_bibcodes': patch.object(api, 'get_canonical_bibcodes', return_value=[]), \
+                'get_canonical_bibcodes_mapping': patch.object(api, 'get_canonical_bibcodes_mapping', return_value=canonical_bibcodes_mapping), \
+                'finish_maintenance_run_chunk': patch.object(db, 'finish_maintenance_run_chunk', wraps=db.finish_maintenance_run_chunk), \
+                'task_output_results': patch.object(tasks.task_output_results, 'delay', return_value=None)}) as mocked:
+            tasks.task_maintenance_canonical([], [])
+            self.assertTrue(mocked['iter_citation_targets'].called)
+            self.assertFalse(mocked['get_citations_by_bibcode'].called)
+            self.assertFalse(mocked['get_canonical_bibcodes'].called)
+            # All the citing bibcodes of the run are refreshed in one bulk request
+            # when it is dispatched, then the chunk reads them from the cache
+            self.assertEqual(mocked['get_citations_by_content'].call_count, 2)
+            self.assertEqual(mocked['get_canonical_bibcodes_mapping'].call_count, 2)
+            bulk_call, chunk_call = mocked['get_canonical_bibcodes_mapping'].call_args_list
+            self.assertEqual(sorted(bulk_call[0][1]), ['2015arXiv151003579A', '2019arXiv190105505T'])
+            self.assertTrue(bulk_call[1]['refresh'])
+            self.assertFalse(chunk_call[1].get('refresh', False))
+            self.assertEqual(mocked['task_output_results'].call_count, 2)
+            forwarded_citations = [args[0][2] for args in mocked['task_output_results'].call_args_list]
+            self.assertEqual(forwarded_citations, [['2015ApJ...815L..10L'], ['2015ApJ...815L..10L']])
+            # Progress is tracked in the maintenance run
+            self.assertEqual(mocked['finish_maintenance_run_chunk'].call_count, 1)
+            run_id = mocked['finish_maintenance_run_chunk'].call_args[0][1]
+            maintenance_run = db.get_maintenance_run(self.app, run_id)
+            self.assertEqual(maintenance_run['status'], 'FINISHED')
+            self.assertEqual((maintenance_run['n_targets'], maintenance_run['n_done'], maintenance_run['n_failed'], maintenance_run['n_skipped']), (2, 2, 0, 0))
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,11 +1,17 @@
+import os
+import shutil
+import tempfile
 import unittest
 import httpretty
+import requests
 import datetime
 import json
 import adsmsg
 from ADSCitationCapture import app, tasks
 from ADSCitationCapture import webhook
+from ADSCitationCapture import output
 from .test_base import TestBase
+from mock import patch
 
 now = datetime.datetime.now()
 
@@ -462,5 +468,65 @@ class TestWorkers(TestBase):
         #emitted = webhook.emit_event(self.app.conf['ADS_WEBHOOK_URL'], self.app.conf['ADS_WEBHOOK_AUTH_TOKEN'], event_data, timeout=30)
         #self.assertFalse(emitted, "Agreed citation change was NOT assigned to an agreed event")
 
+    def test_emit_events(self):
+        requests_events_data = []
+        def _callback(request, uri, response_headers):
+            # The broker rejects any request that contains the malformed event
+            events_data = json.loads(request.body)
+            requests_events_data.append(events_data)
+            if any(event_data['Source']['Identifier']['ID'] == 'malformed' for event_data in events_data):
+                return [400, response_headers, ""]
+            return [200, response_headers, ""]
+        httpretty.register_uri(httpretty.POST, self.app.conf['ADS_WEBHOOK_URL'], body=_callback, content_type="application/json")
+        events_data = [webhook.identical_bibcodes_event_data(source_bibcode, '2015ApJ...815L..10L') for source_bibcode in ('2015arXiv151003579A', 'malformed', '2019arXiv190105505T', '2019arXiv190105505X')]
+        events = list(enumerate(events_data))
+        self.assertEqual(webhook.emit_events(self.app.conf['ADS_WEBHOOK_URL'], self.app.conf['ADS_WEBHOOK_AUTH_TOKEN'], events[:1] + events[2:], timeout=30), [])
+        self.assertEqual([len(x) for x in requests_events_data], [3])
+        # Failed batches are split until the malformed event is isolated
+        requests_events_data = []
+        failed_event_keys = webhook.emit_events(self.app.conf['ADS_WEBHOOK_URL'], self.app.conf['ADS_WEBHOOK_AUTH_TOKEN'], events, timeout=30)
+        self.assertEqual(failed_event_keys, [1])
+        self.assertEqual([len(x) for x in requests_events_data], [4, 2, 1, 1, 2])
+
+    def test_emit_events_server_error(self):
+        requests_events_data = []
+        def _callback(request, uri, response_headers):
+            # The broker rejects the malformed event and it fails with the last one
+            events_data = json.loads(request.body)
+            requests_events_data.append(events_data)
+            if any(event_data['Source']['Identifier']['ID'] == 'malformed' for event_data in events_data):
+                return [400, response_headers, ""]
+            if any(event_data['Source']['Identifier']['ID'] == '2019arXiv190105505X' for event_data in events_data):
+                return [503, response_headers, ""]
+            return [200, response_headers, ""]
+        httpretty.register_uri(httpretty.POST, self.app.conf['ADS_WEBHOOK_URL'], body=_callback, content_type="application/json")
+        events_data = [webhook.identical_bibcodes_event_data(source_bibcode, '2015ApJ...815L..10L') for source_bibcode in ('2015arXiv151003579A', 'malformed', '2019arXiv190105505T', '2019arXiv190105505X')]
+        events = list(enumerate(events_data))
+        # Server errors are not split, the events that were not emitted fail
+        failed_event_keys = webhook.emit_events(self.app.conf['ADS_WEBHOOK_URL'], self.app.conf['ADS_WEBHOOK_AUTH_TOKEN'], events, timeout=30)
+        self.assertEqual(failed_event_keys, [1, 2, 3])
+        self.assertEqual([len(x) for x in requests_events_data], [4, 2, 1, 1, 2])
+        # Transport errors make the whole batch fail
+        with patch.object(webhook.http_session, 'post', side_effect=requests.exceptions.ConnectionError()) as post:
+            failed_event_keys = webhook.emit_events(self.app.conf['ADS_WEBHOOK_URL'], self.app.conf['ADS_WEBHOOK_AUTH_TOKEN'], events, timeout=30)
+        self.assertEqual(failed_event_keys, [0, 1, 2, 3])
+        self.assertEqual(post.call_count, 1)
+
+    def test_dump_event(self):
+        directory = tempfile.mkdtemp()
+        events_data = [webhook.identical_bibcodes_event_data(source_bibcode, '2015ApJ...815L..10L') for source_bibcode in ('2015arXiv151003579A', '2019arXiv190105505T')]
+        with patch.object(webhook, '_event_archive', output.JSONLinesArchive(directory)):
+            for event_data in events_data:
+                self.assertTrue(webhook.dump_event(event_data, prefix="emitted", day="20190101"))
+            webhook.close_event_archive()
+        # One stream per prefix, relationship and day
+        filenames = [filename for dirpath, dirnames, filenames in os.walk(directory) for filename in filenames]
+        self.assertEqual(len(filenames), 2)
+        self.assertTrue(os.path.isdir(os.path.join(directory, "emitted", "IsIdenticalTo", "20190101")))
+        self.assertEqual(list(output.search_archive(directory, '2019arXiv190105505T')), events_data[1:])
+        self.assertEqual(list(output.search_archive(directory, '2015ApJ...815L..10L')), events_data)
+        self.assertEqual(list(output.search_archive(directory, '2015ApJ')), [])
+        shutil.rmtree(directory)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,11 +1,12 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
 from adsputils import setup_logging
 import adsmsg
 import datetime
 import os
-import errno
 import re
+import ADSCitationCapture.output as output
 
 # ============================= INITIALIZATION ==================================== #
 # - Use app logger:
@@ -19,6 +20,11 @@ logger = setup_logging(__name__, proj_home=proj_home,
                         level=config.get('LOGGING_LEVEL', 'INFO'),
                         attach_stdout=config.get('LOG_STDOUT', False))
 
+# Connections to the broker are kept alive and reused among requests
+http_session = requests.Session()
+http_session.mount('http://', HTTPAdapter(pool_maxsize=config.get('ADS_WEBHOOK_POOL_SIZE', 4)))
+http_session.mount('https://', HTTPAdapter(pool_maxsize=config.get('ADS_WEBHOOK_POOL_SIZE', 4)))
+
 
 # =============================== FUNCTIONS ======================================= #
 def _build_data(event_type, original_relationship_name, source_bibcode, target_id, target_id_schema, target_id_url):
@@ -143,63 +149,136 @@ def identical_bibcode_and_doi_event_data(source_bibcode, target_doi, deleted=Fal
     return data
 
 
+class RejectedEventsError(Exception):
+    """
+    The broker rejected the events of the request (client error), as opposed
+    to transport errors or server errors that are not due to the events
+    """
+    pass
+
+def _post_events(ads_webhook_url, ads_webhook_auth_token, data, timeout=30):
+    headers = {}
+    headers["Content-Type"] = "application/json"
+    headers["Authorization"] = "Bearer {}".format(ads_webhook_auth_token)
+    r = http_session.post(ads_webhook_url, data=json.dumps(data), headers=headers, timeout=timeout)
+    if not r.ok:
+        logger.error("Emit event failed with status code '{}': {}".format(r.status_code, r.content))
+        if 400 <= r.status_code < 500:
+            raise RejectedEventsError("HTTP Post to '{}' was rejected: {}".format(ads_webhook_url, json.dumps(data)))
+        raise Exception("HTTP Post to '{}' failed: {}".format(ads_webhook_url, json.dumps(data)))
+
 def emit_event(ads_webhook_url, ads_webhook_auth_token, event_data, timeout=30):
     emitted = False
     if event_data:
-        data = [event_data]
-        headers = {}
-        headers["Content-Type"] = "application/json"
-        headers["Authorization"] = "Bearer {}".format(ads_webhook_auth_token)
-        r = requests.post(ads_webhook_url, data=json.dumps(data), headers=headers, timeout=timeout)
-        if not r.ok:
-            logger.error("Emit event failed with status code '{}': {}".format(r.status_code, r.content))
-            raise Exception("HTTP Post to '{}' failed: {}".format(ads_webhook_url, json.dumps(data)))
-        else:
-            relationship = event_data.get("RelationshipType", {}).get("SubType", None)
-            source_id = event_data.get("Source", {}).get("Identifier", {}).get("ID", None)
-            target_id = event_data.get("Target", {}).get("Identifier", {}).get("ID", None)
-            logger.info("Emitted event (relationship '%s', source '%s' and target '%s')", relationship, source_id, target_id)
-            emitted = True
+        _post_events(ads_webhook_url, ads_webhook_auth_token, [event_data], timeout=timeout)
+        relationship = event_data.get("RelationshipType", {}).get("SubType", None)
+        source_id = event_data.get("Source", {}).get("Identifier", {}).get("ID", None)
+        target_id = event_data.get("Target", {}).get("Identifier", {}).get("ID", None)
+        logger.info("Emitted event (relationship '%s', source '%s' and target '%s')", relationship, source_id, target_id)
+        emitted = True
     return emitted
 
-def _mkdir_p(path):
+def _emit_events(ads_webhook_url, ads_webhook_auth_token, events, emitted_keys, timeout=30):
     """
-    Creates a directory. Same behaviour as 'mkdir -p'.
+    Emit the events and split them in halves while the broker rejects them,
+    the keys of the emitted events are appended to `emitted_keys`. Return the
+    keys of the rejected events, other errors are raised.
     """
+    if len(events) == 0:
+        return []
     try:
-        os.makedirs(path)
-    except OSError as exc: # Python >2.5
-        if exc.errno == errno.EEXIST:
-            pass
+        _post_events(ads_webhook_url, ads_webhook_auth_token, [event_data for key, event_data in events], timeout=timeout)
+    except RejectedEventsError:
+        if len(events) == 1:
+            logger.error("Event was rejected by the broker: %s", json.dumps(events[0][1]))
+            return [events[0][0]]
+        logger.warning("Emission of '%i' events was rejected, they will be split and emitted again", len(events))
+        middle = len(events) // 2
+        return _emit_events(ads_webhook_url, ads_webhook_auth_token, events[:middle], emitted_keys, timeout=timeout) \
+                + _emit_events(ads_webhook_url, ads_webhook_auth_token, events[middle:], emitted_keys, timeout=timeout)
+    else:
+        logger.info("Emitted '%i' events", len(events))
+        emitted_keys.extend(key for key, event_data in events)
+        return []
+
+def emit_events(ads_webhook_url, ads_webhook_auth_token, events, timeout=30):
+    """
+    Emit a list of events (pairs of key and event data, e.g., the primary key
+    of the event in the outbox) in one request. If the broker rejects it
+    (client error), the list is split in halves that are emitted separately
+    until the rejected events are isolated. Transport and server errors are
+    not due to the events, hence the emission stops and all the events that
+    were not emitted yet are considered failed. Return the keys of the events
+    that could not be emitted.
+    """
+    events = [(key, event_data) for key, event_data in events if event_data]
+    if len(events) == 1:
+        key, event_data = events[0]
+        try:
+            emit_event(ads_webhook_url, ads_webhook_auth_token, event_data, timeout=timeout)
+        except Exception:
+            logger.exception("Impossible to emit event")
+            return [key]
         else:
-            raise
+            return []
+    emitted_keys = []
+    try:
+        return _emit_events(ads_webhook_url, ads_webhook_auth_token, events, emitted_keys, timeout=timeout)
+    except Exception:
+        logger.exception("Emission of '%i' events failed", len(events) - len(emitted_keys))
+        return [key for key, event_data in events if key not in emitted_keys]
+
+def get_event_archive_directory():
+    """
+    Directory of the event archive (by default, 'events' in the log directory)
+    """
+    if config.get('EVENT_ARCHIVE_DIRECTORY'):
+        return config['EVENT_ARCHIVE_DIRECTORY']
+    try:
+        logs_dirname = os.path.dirname(logger.handlers[0].baseFilename)
+    except:
+        logger.exception("Logger's target directory not found")
+        return None
+    return os.path.join(logs_dirname, "events")
+
+_event_archive = None
 
-def dump_event(event_data, prefix="emitted"):
+def _get_event_archive():
+    global _event_archive
+    if _event_archive is None:
+        directory = get_event_archive_directory()
+        if directory is not None:
+            _event_archive = output.JSONLinesArchive(directory, max_file_size=config.get('EVENT_ARCHIVE_MAX_FILE_SIZE', 100*1024*1024))
+    return _event_archive
+
+def dump_event(event_data, prefix="emitted", day=None):
     """
-    Save the event in JSON format in the log directory
+    Save the event in the archive of the log directory, in the stream of its
+    prefix (e.g., emitted), relationship and day (by default, today)
     """
     dump_created = False
     if event_data:
-        try:
-            logs_dirname = os.path.dirname(logger.handlers[0].baseFilename)
-        except:
-            logger.exception("Logger's target directory not found")
-        else:
-            base_dirname = os.path.join(logs_dirname, prefix)
-            now = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        event_archive = _get_event_archive()
+        if event_archive is not None:
+            if day is None:
+                day = datetime.datetime.now().strftime("%Y%m%d")
             relationship = event_data.get("RelationshipType", {}).get("SubType", None)
             source_id = event_data.get("Source", {}).get("Identifier", {}).get("ID", "")
             target_id = event_data.get("Target", {}).get("Identifier", {}).get("ID", "")
-            source_id = re.sub(r'[^-\w\s]+', '-', source_id)
-            target_id = re.sub(r'[^-\w\s]+', '-', target_id)
-            logger.info("Dumped event (relationship '%s', source '%s' and target '%s')", relationship, source_id, target_id)
-            filename = "{}_{}_{}_{}.json".format(now, source_id, relationship, target_id)
             try:
-                if not os.path.exists(base_dirname):
-                    _mkdir_p(base_dirname)
-                json.dump(event_data, open(os.path.join(base_dirname, filename), "w"), indent=2)
+                # Identifiers cannot contain the separators of the index
+                identifiers = [re.sub(r'\s+', ' ', identifier) for identifier in (source_id, target_id)]
+                event_archive.append((prefix, str(relationship), day), event_data, identifiers)
             except:
                 logger.exception("Impossible to dump event")
             else:
+                logger.info("Dumped event (relationship '%s', source '%s' and target '%s')", relationship, source_id, target_id)
                 dump_created = True
     return dump_created
+
+def close_event_archive():
+    """
+    Write to disk the buffered events of the archive
+    """
+    if _event_archive is not None:
+        _event_archive.close()
@@ -0,0 +1,31 @@
+"""canonical_bibcode
+
+Revision ID: a3c1f9d2b7e4
+Revises: 5ba8c7af7acc
+Create Date: 2026-10-19 09:12:41.301822
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import adsputils
+
+# revision identifiers, used by Alembic.
+revision = 'a3c1f9d2b7e4'
+down_revision = '5ba8c7af7acc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('canonical_bibcode',
+    sa.Column('bibcode', sa.Text(), nullable=False),
+    sa.Column('canonical', sa.Text(), nullable=True),
+    sa.Column('created', adsputils.UTCDateTime(timezone=True), nullable=True),
+    sa.Column('updated', adsputils.UTCDateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('bibcode'),
+    schema='public'
+    )
+
+
+def downgrade():
+    op.drop_table('canonical_bibcode', schema='public')
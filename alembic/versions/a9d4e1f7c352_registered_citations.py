@@ -0,0 +1,32 @@
+"""registered_citations
+
+Revision ID: a9d4e1f7c352
+Revises: f83b2c6d9e41
+Create Date: 2026-10-19 15:10:52.284617
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'a9d4e1f7c352'
+down_revision = 'f83b2c6d9e41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('citation_target', sa.Column('registered_citation_count', sa.Integer(), nullable=True), schema='public')
+    op.add_column('citation_target', sa.Column('registered_citing', postgresql.ARRAY(sa.Text()), nullable=True), schema='public')
+    # Populate the denormalized columns from the existing citations (the update date is preserved)
+    op.execute("UPDATE public.citation_target SET \
+                    registered_citation_count = (SELECT count(*) FROM public.citation \
+                        WHERE citation.content = citation_target.content AND citation.status = 'REGISTERED'), \
+                    registered_citing = (SELECT coalesce(array_agg(citation.citing ORDER BY citation.citing), '{}'::text[]) FROM public.citation \
+                        WHERE citation.content = citation_target.content AND citation.status = 'REGISTERED')")
+
+
+def downgrade():
+    op.drop_column('citation_target', 'registered_citing', schema='public')
+    op.drop_column('citation_target', 'registered_citation_count', schema='public')
@@ -0,0 +1,36 @@
+"""event_outbox
+
+Revision ID: b2e7c4d9f610
+Revises: a9d4e1f7c352
+Create Date: 2026-10-19 16:08:42.731925
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2e7c4d9f610'
+down_revision = 'a9d4e1f7c352'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    event_status_type = postgresql.ENUM('PENDING', 'SENT', 'FAILED', name='event_status_type')
+    event_status_type.create(op.get_bind())
+    op.add_column('event', sa.Column('status', event_status_type, nullable=True), schema='public')
+    op.add_column('event', sa.Column('attempts', sa.Integer(), nullable=True), schema='public')
+    op.add_column('event', sa.Column('dump_prefix', sa.Text(), nullable=True), schema='public')
+    # Events stored before the outbox were already sent
+    op.execute("UPDATE public.event SET status = 'SENT', attempts = 0")
+    op.create_index('ix_public_event_pending', 'event', ['id'], unique=False, schema='public', postgresql_where=sa.text("status = 'PENDING'"))
+
+
+def downgrade():
+    op.drop_index('ix_public_event_pending', table_name='event', schema='public')
+    op.drop_column('event', 'dump_prefix', schema='public')
+    op.drop_column('event', 'attempts', schema='public')
+    op.drop_column('event', 'status', schema='public')
+    op.execute('DROP TYPE event_status_type')
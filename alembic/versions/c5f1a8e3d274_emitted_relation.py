@@ -0,0 +1,41 @@
+"""emitted_relation
+
+Revision ID: c5f1a8e3d274
+Revises: b2e7c4d9f610
+Create Date: 2026-10-19 17:24:10.482913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import adsputils
+
+# revision identifiers, used by Alembic.
+revision = 'c5f1a8e3d274'
+down_revision = 'b2e7c4d9f610'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('emitted_relation',
+    sa.Column('relationship', sa.Text(), nullable=False),
+    sa.Column('source_id', sa.Text(), nullable=False),
+    sa.Column('target_id', sa.Text(), nullable=False),
+    sa.Column('created', adsputils.UTCDateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('relationship', 'source_id', 'target_id'),
+    schema='public'
+    )
+    # Relations already stored in the event table were already emitted
+    op.execute("""
+        INSERT INTO public.emitted_relation (relationship, source_id, target_id, created)
+        SELECT data->'RelationshipType'->>'SubType', data->'Source'->'Identifier'->>'ID', data->'Target'->'Identifier'->>'ID', min(created)
+        FROM public.event
+        WHERE data->'RelationshipType'->>'SubType' = 'IsIdenticalTo'
+            AND data->'Source'->'Identifier'->>'ID' IS NOT NULL
+            AND data->'Target'->'Identifier'->>'ID' IS NOT NULL
+        GROUP BY 1, 2, 3
+    """)
+
+
+def downgrade():
+    op.drop_table('emitted_relation', schema='public')
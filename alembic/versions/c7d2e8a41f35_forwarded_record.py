@@ -0,0 +1,31 @@
+"""forwarded_record
+
+Revision ID: c7d2e8a41f35
+Revises: a3c1f9d2b7e4
+Create Date: 2026-10-19 11:03:17.554310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import adsputils
+
+# revision identifiers, used by Alembic.
+revision = 'c7d2e8a41f35'
+down_revision = 'a3c1f9d2b7e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('forwarded_record',
+    sa.Column('content', sa.Text(), nullable=False),
+    sa.Column('fingerprint', sa.Text(), nullable=True),
+    sa.Column('created', adsputils.UTCDateTime(timezone=True), nullable=True),
+    sa.Column('updated', adsputils.UTCDateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('content'),
+    schema='public'
+    )
+
+
+def downgrade():
+    op.drop_table('forwarded_record', schema='public')
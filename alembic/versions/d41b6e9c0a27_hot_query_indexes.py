@@ -0,0 +1,30 @@
+"""hot_query_indexes
+
+Revision ID: d41b6e9c0a27
+Revises: c7d2e8a41f35
+Create Date: 2026-10-19 11:03:17.552918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41b6e9c0a27'
+down_revision = 'c7d2e8a41f35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_public_citation_content_status', 'citation', ['content', 'status'], unique=False, schema='public')
+    op.create_index('ix_public_citation_target_status', 'citation_target', ['status'], unique=False, schema='public')
+    op.create_index('ix_public_citation_target_bibcode', 'citation_target', [sa.text("(parsed_cited_metadata ->> 'bibcode')")], unique=False, schema='public')
+    op.create_index('ix_public_citation_target_alternate_bibcode', 'citation_target', [sa.text("(parsed_cited_metadata -> 'alternate_bibcode')")], unique=False, schema='public', postgresql_using='gin')
+
+
+def downgrade():
+    op.drop_index('ix_public_citation_target_alternate_bibcode', table_name='citation_target', schema='public')
+    op.drop_index('ix_public_citation_target_bibcode', table_name='citation_target', schema='public')
+    op.drop_index('ix_public_citation_target_status', table_name='citation_target', schema='public')
+    op.drop_index('ix_public_citation_content_status', table_name='citation', schema='public')
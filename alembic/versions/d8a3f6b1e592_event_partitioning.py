@@ -0,0 +1,87 @@
+"""event_partitioning
+
+Revision ID: d8a3f6b1e592
+Revises: c5f1a8e3d274
+Create Date: 2026-10-19 18:42:37.905614
+
+"""
+import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8a3f6b1e592'
+down_revision = 'c5f1a8e3d274'
+branch_labels = None
+depends_on = None
+
+
+def _month_start(date, months=0):
+    month = date.year * 12 + date.month - 1 + months
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+def upgrade():
+    # Requires PostgreSQL 11 or newer (default partitions and indexes on partitioned tables)
+    op.execute("ALTER TABLE public.event RENAME TO event_unpartitioned")
+    op.execute("ALTER TABLE public.event_unpartitioned RENAME CONSTRAINT event_pkey TO event_unpartitioned_pkey")
+    op.execute("DROP INDEX public.ix_public_event_pending")
+    op.execute("""
+        CREATE TABLE public.event (
+            id integer NOT NULL DEFAULT nextval('public.event_id_seq'::regclass),
+            data jsonb,
+            status event_status_type,
+            attempts integer,
+            dump_prefix text,
+            created timestamp with time zone NOT NULL,
+            updated timestamp with time zone,
+            PRIMARY KEY (id, created)
+        ) PARTITION BY RANGE (created)
+    """)
+    op.execute("ALTER TABLE public.event_unpartitioned ALTER COLUMN id DROP DEFAULT")
+    op.execute("ALTER SEQUENCE public.event_id_seq OWNED BY public.event.id")
+    op.execute("CREATE TABLE public.event_default PARTITION OF public.event DEFAULT")
+    # Monthly partitions from the oldest event up to two months from now
+    bind = op.get_bind()
+    oldest = bind.execute("SELECT min(coalesce(created, updated, now())) FROM public.event_unpartitioned").scalar()
+    today = datetime.datetime.utcnow().date()
+    start = _month_start(oldest.date() if oldest else today)
+    while start <= _month_start(today, 2):
+        end = _month_start(start, 1)
+        op.execute("CREATE TABLE public.event_{} PARTITION OF public.event FOR VALUES FROM ('{} 00:00:00+00') TO ('{} 00:00:00+00')".format(start.strftime("%Y%m"), start, end))
+        start = end
+    op.execute("""
+        INSERT INTO public.event (id, data, status, attempts, dump_prefix, created, updated)
+        SELECT id, data, status, attempts, dump_prefix, coalesce(created, updated, now()), updated
+        FROM public.event_unpartitioned
+    """)
+    op.execute("DROP TABLE public.event_unpartitioned")
+    op.create_index('ix_public_event_pending', 'event', ['id'], unique=False, schema='public', postgresql_where=sa.text("status = 'PENDING'"))
+    op.create_index('ix_public_event_source_id', 'event', [sa.text("(data #>> '{Source, Identifier, ID}')")], unique=False, schema='public')
+    op.create_index('ix_public_event_target_id', 'event', [sa.text("(data #>> '{Target, Identifier, ID}')")], unique=False, schema='public')
+
+
+def downgrade():
+    # Archived partitions are not restored
+    op.execute("ALTER TABLE public.event RENAME TO event_partitioned")
+    op.execute("""
+        CREATE TABLE public.event (
+            id integer NOT NULL DEFAULT nextval('public.event_id_seq'::regclass),
+            data jsonb,
+            status event_status_type,
+            attempts integer,
+            dump_prefix text,
+            created timestamp with time zone,
+            updated timestamp with time zone,
+            CONSTRAINT event_pkey PRIMARY KEY (id)
+        )
+    """)
+    op.execute("ALTER TABLE public.event_partitioned ALTER COLUMN id DROP DEFAULT")
+    op.execute("ALTER SEQUENCE public.event_id_seq OWNED BY public.event.id")
+    op.execute("""
+        INSERT INTO public.event (id, data, status, attempts, dump_prefix, created, updated)
+        SELECT id, data, status, attempts, dump_prefix, created, updated
+        FROM public.event_partitioned
+    """)
+    op.execute("DROP TABLE public.event_partitioned CASCADE")
+    op.create_index('ix_public_event_pending', 'event', ['id'], unique=False, schema='public', postgresql_where=sa.text("status = 'PENDING'"))
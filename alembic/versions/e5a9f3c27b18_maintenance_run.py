@@ -0,0 +1,54 @@
+"""maintenance_run
+
+Revision ID: e5a9f3c27b18
+Revises: d41b6e9c0a27
+Create Date: 2026-10-19 12:21:05.118406
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+import adsputils
+
+# revision identifiers, used by Alembic.
+revision = 'e5a9f3c27b18'
+down_revision = 'd41b6e9c0a27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('maintenance_run',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('task', sa.Text(), nullable=True),
+    sa.Column('arguments', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('status', postgresql.ENUM('DISPATCHING', 'RUNNING', 'FINISHED', name='maintenance_run_status_type'), nullable=True),
+    sa.Column('n_targets', sa.Integer(), nullable=True),
+    sa.Column('n_done', sa.Integer(), nullable=True),
+    sa.Column('n_failed', sa.Integer(), nullable=True),
+    sa.Column('n_skipped', sa.Integer(), nullable=True),
+    sa.Column('created', adsputils.UTCDateTime(timezone=True), nullable=True),
+    sa.Column('updated', adsputils.UTCDateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    schema='public'
+    )
+    op.create_table('maintenance_run_chunk',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('run_id', sa.Integer(), nullable=True),
+    sa.Column('contents', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('status', postgresql.ENUM('PENDING', 'DONE', name='maintenance_run_chunk_status_type'), nullable=True),
+    sa.Column('created', adsputils.UTCDateTime(timezone=True), nullable=True),
+    sa.Column('updated', adsputils.UTCDateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['run_id'], ['public.maintenance_run.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    schema='public'
+    )
+    op.create_index(op.f('ix_public_maintenance_run_chunk_run_id'), 'maintenance_run_chunk', ['run_id'], unique=False, schema='public')
+
+
+def downgrade():
+    op.drop_index(op.f('ix_public_maintenance_run_chunk_run_id'), table_name='maintenance_run_chunk', schema='public')
+    op.drop_table('maintenance_run_chunk', schema='public')
+    op.drop_table('maintenance_run', schema='public')
+    op.execute('DROP TYPE maintenance_run_chunk_status_type')
+    op.execute('DROP TYPE maintenance_run_status_type')
@@ -0,0 +1,36 @@
+"""output_request
+
+Revision ID: f83b2c6d9e41
+Revises: e5a9f3c27b18
+Create Date: 2026-10-19 14:02:41.730215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+import adsputils
+
+# revision identifiers, used by Alembic.
+revision = 'f83b2c6d9e41'
+down_revision = 'e5a9f3c27b18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('output_request',
+    sa.Column('content', sa.Text(), nullable=False),
+    sa.Column('citation_change', sa.LargeBinary(), nullable=True),
+    sa.Column('parsed_metadata', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('citations', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('bibcode_replaced', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('force', sa.Boolean(), nullable=True),
+    sa.Column('created', adsputils.UTCDateTime(timezone=True), nullable=True),
+    sa.Column('updated', adsputils.UTCDateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('content'),
+    schema='public'
+    )
+
+
+def downgrade():
+    op.drop_table('output_request', schema='public')
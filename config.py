@@ -20,6 +20,96 @@ ASCL_URL = "http://ascl.net/"
 ADS_API_TOKEN = "<secret>"
 ADS_API_URL = "https://ui.adsabs.harvard.edu/v1/"
 
+# Canonical bibcode cache (bibcode -> canonical bibcode or not found):
+# - in-process LRU with a maximum number of entries per worker
+# - shared database table ('canonical_bibcode')
+# Entries older than the TTL (in seconds) are requested again to the API,
+# bibcodes not found expire sooner since they may be ingested soon
+CANONICAL_BIBCODE_CACHE_SIZE = 100000
+CANONICAL_BIBCODE_CACHE_TTL = 7*24*60*60
+CANONICAL_BIBCODE_CACHE_NOT_FOUND_TTL = 24*60*60
+# Number of parallel requests to the API when canonicalizing large lists of
+# bibcodes in bulk (e.g., canonical maintenance)
+CANONICAL_BIBCODE_PARALLEL_REQUESTS = 4
+
+# Number of citation targets whose metadata is kept in memory by each worker
+# (entries are validated against the database row update date before use)
+CITATION_TARGET_METADATA_CACHE_SIZE = 1000
+
+# Number of citation targets whose forwarded record template (the fields
+# that only depend on the metadata) is kept in memory by each worker
+RECORD_TEMPLATE_CACHE_SIZE = 1000
+
+# Maximum number of seconds that a worker waits for another worker that is
+# storing the same new citation target (only database writes are done while
+# holding the lock, metadata is fetched before)
+CITATION_TARGET_LOCK_TIMEOUT = 30
+
+# Number of seconds during which output requests for the same citation target
+# are coalesced so that only the latest state is forwarded to master (0 to
+# forward every request immediately)
+OUTPUT_COALESCING_WINDOW = 0
+
+# Records forwarded to master are published in batches (NonBibRecordList)
+# once this number of records is buffered in a worker (1 to publish every
+# record immediately) or once the oldest buffered record has waited for
+# OUTPUT_BATCH_MAX_DELAY seconds (a timer enforces it even if the worker is
+# idle). Buffers are also flushed on worker shutdown. Tasks are acknowledged
+# before their records are published: if a worker is killed, the records
+# buffered during the last OUTPUT_BATCH_MAX_DELAY seconds are lost, but
+# their fingerprints are only stored once they are published and hence they
+# are forwarded again the next time their citation targets change (or with
+# a maintenance run)
+OUTPUT_BATCH_SIZE = 100
+OUTPUT_BATCH_MAX_DELAY = 5
+
+# Destination of the records forwarded to master: 'broker' publishes them to
+# OUTPUT_CELERY_BROKER while 'file' writes them to gzip compressed files in
+# OUTPUT_SINK_DIRECTORY (default: 'records' in the project directory), which
+# are rotated every OUTPUT_SINK_MAX_FILE_SIZE bytes and can be published
+# later at a controlled rate with 'run.py REPLAY' (e.g., for large
+# maintenance runs)
+OUTPUT_SINK = 'broker'
+OUTPUT_SINK_DIRECTORY = None
+OUTPUT_SINK_MAX_FILE_SIZE = 100*1024*1024
+
+# Events are stored as pending in the 'event' table (outbox) and the sender
+# task emits them to the broker in batches of this number of events (the
+# broker accepts a list of events per request). Batches rejected by the
+# broker (client errors) are split until the rejected events are isolated,
+# while transport and server errors make the whole batch fail. Failed events
+# stay pending until they fail EMIT_EVENT_MAX_ATTEMPTS times (then they are
+# marked as failed). Each worker keeps up to ADS_WEBHOOK_POOL_SIZE
+# connections to the broker
+EMIT_EVENT_BATCH_SIZE = 100
+EMIT_EVENT_MAX_ATTEMPTS = 5
+# Seconds after which the sender is queued again when events could not be
+# sent, doubled with every attempt of the events
+EMIT_EVENT_RETRY_DELAY = 60
+ADS_WEBHOOK_POOL_SIZE = 4
+
+# Relationships whose events are only emitted once per source and target
+# (registered in the 'emitted_relation' table)
+EMIT_ONCE_RELATIONSHIPS = ['IsIdenticalTo']
+
+# Sent events are archived in gzip compressed JSON lines files (one stream
+# per relationship and day) with an index by source and target identifier
+# (see 'run.py EVENTS') in EVENT_ARCHIVE_DIRECTORY (default: 'events' in the
+# log directory), files are rotated every EVENT_ARCHIVE_MAX_FILE_SIZE bytes
+EVENT_ARCHIVE_DIRECTORY = None
+EVENT_ARCHIVE_MAX_FILE_SIZE = 100*1024*1024
+
+# The event table is partitioned by month: 'run.py MAINTENANCE
+# --event-partitions' creates the partitions of the next
+# EVENT_PARTITIONS_AHEAD months and moves the partitions older than
+# EVENT_RETENTION_MONTHS to the event archive
+EVENT_PARTITIONS_AHEAD = 2
+EVENT_RETENTION_MONTHS = 24
+
+# Maintenance runs are split in subtasks that process chunks of this number
+# of citation targets (progress is tracked in the 'maintenance_run' table)
+MAINTENANCE_CHUNK_SIZE = 100
+
 # When 'True', no events are emitted to the broker via the webhook
 TESTING_MODE = True
 # When 'True', it converts all the asynchronous calls into synchronous,
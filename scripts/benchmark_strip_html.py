@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of the HTML stripping used to clean abstracts and titles in
+forward.build_record: compare `forward.strip_html` with the BeautifulSoup
+implementation on the DataCite test fixtures (outputs must be identical).
+
+Usage (from the project root directory):
+
+    python scripts/benchmark_strip_html.py [--repeat N]
+"""
+import os
+import sys
+import glob
+import json
+import timeit
+import argparse
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '../')))
+from ADSCitationCapture import forward
+
+
+def _fixtures():
+    texts = []
+    data_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '../ADSCitationCapture/tests/data/'))
+    for filename in sorted(glob.glob(os.path.join(data_dir, 'datacite_parsed_metadata*.json'))):
+        with open(filename) as f:
+            parsed_metadata = json.load(f)
+        name = os.path.basename(filename)
+        texts.append(("{} (abstract)".format(name), parsed_metadata.get('abstract', "")))
+        texts.append(("{} (title)".format(name), parsed_metadata.get('title', "")))
+    return texts
+
+def benchmark(repeat=1000):
+    total_beautifulsoup, total_strip_html = 0., 0.
+    for name, text in _fixtures():
+        if forward.strip_html(text) != forward._strip_html_with_beautifulsoup(text):
+            raise Exception("Different output for '{}'".format(name))
+        elapsed_beautifulsoup = timeit.timeit(lambda: forward._strip_html_with_beautifulsoup(text), number=repeat)
+        elapsed_strip_html = timeit.timeit(lambda: forward.strip_html(text), number=repeat)
+        total_beautifulsoup += elapsed_beautifulsoup
+        total_strip_html += elapsed_strip_html
+        print("{:<60} {:>10.1f} us {:>10.1f} us {:>8.1f}x".format(name, 1e6*elapsed_beautifulsoup/repeat, 1e6*elapsed_strip_html/repeat, elapsed_beautifulsoup/elapsed_strip_html))
+    print("{:<60} {:>10.1f} us {:>10.1f} us {:>8.1f}x".format("Total", 1e6*total_beautifulsoup/repeat, 1e6*total_strip_html/repeat, total_beautifulsoup/total_strip_html))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare strip_html with BeautifulSoup')
+    parser.add_argument('--repeat', dest='repeat', action='store', type=int, default=1000, help='Number of calls per fixture')
+    args = parser.parse_args()
+    print("{:<60} {:>13} {:>13} {:>9}".format("Fixture", "BeautifulSoup", "strip_html", "Speedup"))
+    benchmark(repeat=args.repeat)
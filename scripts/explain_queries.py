@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Run EXPLAIN ANALYZE on the most frequent lookups of the pipeline, it can be
+used to compare query plans and timings before and after a database migration
+(e.g., `alembic upgrade head`). Sample values are taken from the database
+unless they are specified.
+
+Note that on small tables postgres prefers sequential scans even if an index
+exists, use `--disable-seqscan` to verify that the indexes can be used.
+
+Usage (from the project root directory):
+
+    python scripts/explain_queries.py [--bibcode BIBCODE] [--content DOI] [--disable-seqscan]
+"""
+import os
+import sys
+import time
+import argparse
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '../')))
+from sqlalchemy import text, any_
+from sqlalchemy.dialects.postgresql import array
+from ADSCitationCapture import tasks
+from ADSCitationCapture.models import Citation, CitationTarget
+
+
+def _sample(session, bibcode, content):
+    if bibcode is None or content is None:
+        citation_target = session.query(CitationTarget).filter_by(status='REGISTERED').first()
+        if citation_target is None:
+            raise Exception("No registered citation target found in the database, specify '--bibcode' and '--content'")
+        if bibcode is None:
+            bibcode = citation_target.parsed_cited_metadata.get('bibcode')
+        if content is None:
+            content = citation_target.content
+    return bibcode, content
+
+def _queries(session, bibcode, content):
+    # Same filters as the lookups in ADSCitationCapture/db.py
+    return {
+        'citation_target by bibcode': session.query(CitationTarget.content).filter(CitationTarget.parsed_cited_metadata['bibcode'].astext == any_(array([bibcode]))),
+        'citation_target by alternate bibcode': session.query(CitationTarget.content).filter(CitationTarget.parsed_cited_metadata['alternate_bibcode'].has_any(array([bibcode]))),
+        'citation_target by status': session.query(CitationTarget.content).filter_by(status='DISCARDED'),
+        'citation by content and status': session.query(Citation.citing).filter_by(content=content, status='REGISTERED'),
+    }
+
+def explain(bibcode=None, content=None, disable_seqscan=False):
+    with tasks.app.session_scope() as session:
+        bibcode, content = _sample(session, bibcode, content)
+        print("Sample bibcode '{}' and content '{}'".format(bibcode, content))
+        if disable_seqscan:
+            session.execute(text("SET LOCAL enable_seqscan = off"))
+        for name, query in _queries(session, bibcode, content).items():
+            statement = str(query.statement.compile(dialect=session.bind.dialect, compile_kwargs={"literal_binds": True}))
+            start = time.time()
+            plan = [row[0] for row in session.execute(text("EXPLAIN (ANALYZE, BUFFERS) " + statement))]
+            elapsed = time.time() - start
+            scans = sorted(set(node for node in ('Seq Scan', 'Index Scan', 'Index Only Scan', 'Bitmap Index Scan') if any(node in line for line in plan)))
+            print("\n=== {} ({:.3f} s, {}) ===".format(name, elapsed, ", ".join(scans)))
+            print("\n".join(plan))
+        session.rollback()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Explain the most frequent database lookups')
+    parser.add_argument('--bibcode', dest='bibcode', action='store', default=None, help='Citation target bibcode')
+    parser.add_argument('--content', dest='content', action='store', default=None, help='Citation target content (e.g., DOI)')
+    parser.add_argument('--disable-seqscan', dest='disable_seqscan', action='store_true', default=False, help='Discourage sequential scans to verify that indexes can be used')
+    args = parser.parse_args()
+    explain(bibcode=args.bibcode, content=args.content, disable_seqscan=args.disable_seqscan)